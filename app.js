@@ -196,38 +196,57 @@ if (adminBtn) {
       //Clear input box after entry is sent
       textArea.value = "";
 
-      //Gemini call
+      //Assistant reply, streamed: tokens are shown as they are generated
+      const reply = { role: "bot", text: "", ts: new Date().toISOString() };
+      chat.messages.push(reply);
+      renderChat();
       try {
-        //Send message to FastAPI
-        const response = await fetch("http://localhost:8000/chat", {
+        //Send message to FastAPI (Server-Sent Events over a POST response)
+        const response = await fetch("http://localhost:8000/chat/stream", {
           method: "POST",
           headers: {
             "Content-Type": "application/json"
           },
-          body: JSON.stringify({ message: text })
+          body: JSON.stringify({ message: text, session_id: chat.sessionId || null })
         });
-      
+
         if (!response.ok) {
-          throw new Error("Gemini API error");
+          throw new Error("Assistant API error");
         }
 
-        //Parse Gemini output into json format
-        const data = await response.json();
-
-        // Add Gemini reply to chat
-        chat.messages.push({
-          role: "bot",
-          text: data.reply,
-          ts: new Date().toISOString()
-        });
+        //Events are separated by a blank line: "event: <name>\ndata: <json>"
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        for (;;) {
+          const { value, done } = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, { stream: true });
+          let end;
+          while ((end = buffer.indexOf("\n\n")) >= 0) {
+            const block = buffer.slice(0, end);
+            buffer = buffer.slice(end + 2);
+            const event = (block.match(/^event: (.*)$/m) || [])[1];
+            const data = JSON.parse((block.match(/^data: (.*)$/m) || [])[1] || "null");
+            if (event === "session") {
+              chat.sessionId = data.session_id;
+            } else if (event === "token") {
+              reply.text += data.text;
+            } else if (event === "abort") {
+              //A guardrail tripped: drop the partial answer, a ticket follows
+              reply.text = "";
+            } else if (event === "done") {
+              reply.text = data.type === "ticket" ? data.rendered : data.message;
+            } else if (event === "error") {
+              throw new Error(data.detail);
+            }
+            renderChat();
+          }
+        }
 
       } catch (err) {
         console.error(err);
-        chat.messages.push({
-          role: "bot",
-          text: "Sorry — I ran into an issue contacting the assistant.",
-          ts: new Date().toISOString()
-        });
+        reply.text = "Sorry — I ran into an issue contacting the assistant.";
       }
 
       saveState();
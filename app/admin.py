@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import base64
+import binascii
+import json
+import secrets
+import sqlite3
+from typing import Any, AsyncIterator, Callable, Literal, TypeVar
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+
+from app.core import repository
+from app.core.config import settings
+from app.core.db import db_executor, get_pool, org_db_path, use_org_db
+from app.core.maintenance import load_archived_session, maintenance
+from app.core.message_log import message_log
+from app.core.provision import ProvisionError, provision, read_roster_text
+from app.llm.cache import answer_cache
+from app.llm.providers import LLMError, get_llm
+from app.rag.index import resident_index, retrieval_cache
+
+T = TypeVar("T")
+
+
+def require_admin(
+    authorization: str | None = Header(default=None), x_admin_token: str | None = Header(default=None)
+) -> None:
+    """Admin endpoints need ``TIER1_ADMIN_TOKEN``, sent as ``Authorization: Bearer <token>`` or ``X-Admin-Token``.
+
+    They provision users and export every transcript and ticket of any org,
+    so without a configured token they are off rather than open.
+    """
+    token = settings.admin_token
+    if not token:
+        raise HTTPException(status_code=403, detail="Admin API is disabled; set TIER1_ADMIN_TOKEN to enable it.")
+    given = x_admin_token
+    if given is None and authorization and authorization[:7].lower() == "bearer ":
+        given = authorization[7:].strip()
+    if not given or not secrets.compare_digest(given.encode("utf-8"), token.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid admin token.", headers={"WWW-Authenticate": "Bearer"})
+
+
+router = APIRouter(prefix="/admin", tags=["admin"], dependencies=[Depends(require_admin)])
+
+
+@router.post("/rag/reload")
+def reload_rag_index() -> dict[str, str]:
+    """Reload the KB index from disk (e.g. right after running ingest_kb.py)."""
+    try:
+        index = resident_index.reload()
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"version": index.version}
+
+
+@router.get("/rag/status")
+def rag_status() -> dict[str, str | None]:
+    return {"version": resident_index.version}
+
+
+@router.get("/rag/cache")
+def rag_cache_stats() -> dict[str, Any]:
+    """Retrieval cache counters, for tuning ``rag_cache_size`` / ``rag_cache_ttl_s``."""
+    return retrieval_cache.stats()
+
+
+@router.delete("/rag/cache")
+def clear_rag_cache() -> dict[str, Any]:
+    retrieval_cache.clear()
+    return retrieval_cache.stats()
+
+
+@router.get("/db/status")
+def db_status() -> dict[str, Any]:
+    return {"pool": get_pool().stats(), "message_log": message_log.stats(), "maintenance": maintenance.stats()}
+
+
+@router.get("/llm/status")
+def llm_status() -> dict[str, Any]:
+    """Request counters and HTTP connection pool state of the LLM provider."""
+    try:
+        return get_llm().stats()
+    except LLMError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+@router.get("/llm/cache")
+def llm_cache_stats() -> dict[str, Any]:
+    """Answer cache counters, for tuning ``llm_cache_size`` / ``llm_cache_ttl_s``."""
+    return answer_cache.stats()
+
+
+@router.delete("/llm/cache")
+def purge_llm_cache(
+    category: str | None = None, source_id: str | None = None, index_version: str | None = None
+) -> dict[str, Any]:
+    """Drop cached answers, e.g. those citing ``source_id`` after that KB article was edited.
+
+    Filters combine; without any, the whole cache is cleared.
+    """
+    purged = answer_cache.purge(category=category, source_id=source_id, index_version=index_version)
+    return {"purged": purged, **answer_cache.stats()}
+
+
+@router.get("/archive/sessions/{session_id}")
+async def archived_session(session_id: str, org_id: str) -> dict[str, Any]:
+    """A session moved to the archive by maintenance, with its transcript and tickets."""
+    found = await _in_org(org_id, load_archived_session, session_id)
+    if found is None:
+        raise HTTPException(status_code=404, detail="session not in the archive")
+    return found
+
+
+@router.post("/provision")
+async def provision_users(request: Request, org_id: str, org_name: str | None = None) -> dict[str, int]:
+    """Bulk-load departments and users for an org from a CSV/LDAP export sent as the request body."""
+    text = (await request.body()).decode("utf-8-sig")
+    try:
+        roster = read_roster_text(text)
+        return await _in_org(org_id, provision, org_id, roster, org_name=org_name, write=True)
+    except (ProvisionError, ValueError, sqlite3.IntegrityError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def encode_cursor(key: tuple[str, str]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[str, str]:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError) as e:
+        raise HTTPException(status_code=400, detail="invalid cursor") from e
+    if not (isinstance(key, list) and len(key) == 2 and all(isinstance(v, str) for v in key)):
+        raise HTTPException(status_code=400, detail="invalid cursor")
+    return key[0], key[1]
+
+
+async def _in_org(org_id: str, fn: Callable[..., T], /, *args: Any, write: bool = False, **kwargs: Any) -> T:
+    """Run ``fn`` against ``org_id``'s database on the DB executor (400 if the id can't name a file).
+
+    Entering ``use_org_db`` can create the org file and its schema, so that
+    happens on the DB thread too, never on the event loop.
+    """
+    try:
+        org_db_path(org_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    def run() -> T:
+        with use_org_db(org_id):
+            return fn(*args, **kwargs)
+
+    return await (db_executor.write if write else db_executor.read)(run)
+
+
+async def _org_paths(org_id: str, paths_fn: Callable[[], list[str]]) -> list[str]:
+    # May create shard files and their schema (DDL): on the writer thread.
+    return await _in_org(org_id, paths_fn, write=True)
+
+
+async def _listing(
+    page_fn: Callable[..., list[dict[str, Any]]],
+    key_cols: tuple[str, str],
+    *,
+    paths: list[str],
+    limit: int,
+    cursor: str | None,
+    fmt: str,
+    filters: dict[str, Any],
+) -> Any:
+    """Keyset-paginated listing: one JSON page, or every remaining row streamed as NDJSON."""
+    after = decode_cursor(cursor) if cursor else None
+
+    async def fetch(after: tuple[str, str] | None, n: int) -> list[dict[str, Any]]:
+        return await db_executor.read(page_fn, limit=n, after=after, paths=paths, **filters)
+
+    if fmt == "json":
+        items = await fetch(after, limit)
+        last = items[-1] if len(items) == limit else None
+        next_cursor = encode_cursor((last[key_cols[0]], last[key_cols[1]])) if last else None
+        return {"items": items, "next_cursor": next_cursor}
+
+    async def lines() -> AsyncIterator[bytes]:
+        key = after
+        while True:
+            page = await fetch(key, limit)
+            for row in page:
+                yield (json.dumps(row) + "\n").encode()
+            if len(page) < limit:
+                return
+            key = (page[-1][key_cols[0]], page[-1][key_cols[1]])
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@router.get("/sessions")
+async def list_sessions(
+    org_id: str,
+    status: str | None = "open",
+    limit: int = Query(50, ge=1, le=500),
+    cursor: str | None = None,
+    format: Literal["json", "ndjson"] = "json",
+) -> Any:
+    """Sessions newest-first. Pass ``next_cursor`` back as ``cursor`` for the next page;
+    ``format=ndjson`` streams every matching session (``limit`` is then the fetch batch)."""
+    paths = await _org_paths(org_id, repository.session_db_paths)
+    return await _listing(
+        repository.page_sessions,
+        ("updated_at", "session_id"),
+        paths=paths,
+        limit=limit,
+        cursor=cursor,
+        fmt=format,
+        filters={"org_id": org_id, "status": status},
+    )
+
+
+@router.get("/tickets")
+async def list_tickets(
+    org_id: str,
+    status: str | None = None,
+    since: str | None = None,
+    until: str | None = None,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: str | None = None,
+    format: Literal["json", "ndjson"] = "json",
+) -> Any:
+    """Tickets newest-first, optionally within ``[since, until)``; paging as for ``/admin/sessions``."""
+    paths = await _org_paths(org_id, repository.ticket_db_paths)
+    return await _listing(
+        repository.page_tickets,
+        ("created_at", "ticket_id"),
+        paths=paths,
+        limit=limit,
+        cursor=cursor,
+        fmt=format,
+        filters={"org_id": org_id, "status": status, "since": since, "until": until},
+    )
+
+
+@router.get("/search")
+async def search(
+    org_id: str,
+    q: str,
+    scope: Literal["tickets", "messages"] = "tickets",
+    category: str | None = None,
+    since: str | None = None,
+    until: str | None = None,
+    limit: int = Query(20, ge=1, le=200),
+    raw: bool = False,
+) -> dict[str, Any]:
+    """Full-text search over tickets or chat transcripts, with snippets.
+
+    Best match first; with session sharding, newest first (``order`` says which).
+    """
+    paths = await _org_paths(org_id, repository.ticket_db_paths if scope == "tickets" else repository.session_db_paths)
+    try:
+        items = await db_executor.read(
+            repository.search,
+            org_id,
+            q,
+            scope=scope,
+            category=category,
+            since=since,
+            until=until,
+            limit=limit,
+            raw=raw,
+            paths=paths,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"items": items, "order": repository.search_order(paths)}
@@ -0,0 +1,49 @@
+"""Async repository API for ``async def`` handlers.
+
+Same functions as ``app.core.repository`` / ``app.core.session``, but each call
+runs on ``db_executor`` (reads on the reader pool, writes on the single writer
+thread) and is awaited, so sqlite3 never blocks the event loop.
+"""
+from __future__ import annotations
+
+from typing import Any
+
+from app.core import repository, session
+from app.core.db import db_executor
+from app.core.session import SessionState
+
+
+async def load_session(session_id: str) -> SessionState:
+    return await db_executor.read(session.load_session, session_id)
+
+
+async def save_session(state: SessionState) -> None:
+    await db_executor.write(session.save_session, state)
+
+
+async def new_session(*, org_id: str, user_id: str) -> SessionState:
+    return await db_executor.write(session.new_session, org_id=org_id, user_id=user_id)
+
+
+async def ensure_org(org_id: str, name: str | None = None) -> None:
+    await db_executor.write(repository.ensure_org, org_id, name=name)
+
+
+async def ensure_user(**kwargs: Any) -> None:
+    await db_executor.write(repository.ensure_user, **kwargs)
+
+
+async def insert_message(**kwargs: Any) -> str:
+    return await db_executor.write(repository.insert_message, **kwargs)
+
+
+async def insert_ticket(**kwargs: Any) -> str:
+    return await db_executor.write(repository.insert_ticket, **kwargs)
+
+
+async def list_open_sessions(org_id: str, limit: int = 50) -> list[dict[str, Any]]:
+    return await db_executor.read(repository.list_open_sessions, org_id, limit)
+
+
+async def list_tickets(org_id: str, status: str, limit: int = 50) -> list[dict[str, Any]]:
+    return await db_executor.read(repository.list_tickets, org_id, status, limit)
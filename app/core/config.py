@@ -22,16 +22,63 @@ class Settings(BaseSettings):
     # App
     app_name: str = "Tier0/1 Support Assistant"
     environment: str = "dev"
+    admin_token: str | None = None  # required by every /admin endpoint; unset = admin API disabled
 
     # Paths
     kb_dir: str = "knowledge"
-    rag_index_path: str = "data/rag_index.pkl"
+    rag_index_path: str = "data/rag_index"  # directory (memory-mapped) or legacy .pkl file
+    rag_legacy_index_path: str = "data/rag_index.pkl"  # served (tfidf) while rag_index_path doesn't exist yet
     flow_config_path: str = "configs/flows.yaml"
     sqlite_path: str = "data/pin.db"
 
+    # SQLite connection pool (one long-lived connection per thread)
+    sqlite_cached_statements: int = 256  # per-connection prepared statement cache
+    sqlite_health_check_s: float = 30.0  # idle time after which a pooled connection is probed before reuse
+    sqlite_async: bool = True  # run DB calls from async handlers on the DB executor instead of the event loop
+    sqlite_reader_threads: int = 4
+    sqlite_routing: str = "single"  # single (sqlite_path) | per_org (<org_db_dir>/<org_id>.db)
+    org_db_dir: str = "data/orgs"
+    sqlite_max_open_dbs: int = 64  # databases with open connections kept per process (LRU)
+    session_shards: int = 1  # >1: sessions/messages/tickets spread over N shard files by hash(session_id)
+
+    # Session state cache (per worker, write-through)
+    session_cache_size: int = 10_000  # 0 disables
+    session_cache_ttl_s: float = 900.0
+    session_cache_validate: bool = True  # confirm cache hits against sessions.version (needed with >1 worker)
+
+    # Known orgs/users (lets /chat skip ensure_org/ensure_user upserts)
+    identity_cache_size: int = 100_000  # 0 disables
+    identity_cache_ttl_s: float = 3600.0
+
+    # Transcript messages
+    message_log_mode: str = "write_behind"  # write_behind | sync (committed with the turn)
+    message_log_batch: int = 500  # rows per group commit
+    message_log_flush_ms: float = 50.0  # max time a queued message waits before its batch is written
+    message_log_max_queue: int = 10_000  # producers block when this many messages are pending
+
+    # Maintenance (idle-session sweeper, archival, vacuum/analyze); see app/core/maintenance.py
+    maintenance_interval_s: float = 0.0  # >0 runs the job in the API process; enable on one worker only
+    maintenance_batch: int = 500  # rows/sessions per transaction
+    session_idle_ttl_s: float = 86_400.0  # open sessions idle this long are closed; 0 disables
+    archive_after_days: float = 90.0  # closed sessions untouched this long are archived; 0 disables
+    archive_dir: str = "data/archive"  # <archive_dir>/<db stem>.<YYYY-MM>.db
+    vacuum_pages: int = 2000  # free pages returned to the OS per run (incremental vacuum)
+
     # RAG
+    rag_backend: str = "tfidf"  # tfidf | bm25 | hashed
+    rag_bm25_index_path: str = "data/rag_index_bm25"
+    rag_hashed_index_path: str = "data/rag_index_hashed"
+    rag_search_threads: int = 4  # thread pool used to search shards of the hashed index concurrently
     rag_top_k: int = 5
-    rag_min_score: float = 0.12  # cosine similarity threshold for TF-IDF
+    rag_min_score: float = 0.12  # cosine similarity threshold for TF-IDF (tfidf and hashed backends)
+    # bm25 scores are a fraction of the query's best achievable score, a different scale
+    rag_bm25_min_score: float = 0.5
+    rag_reload_check_s: float = 2.0  # how often the resident index stats its file for changes
+    rag_cache_size: int = 2048  # retrieval results cached per (query, index version); 0 disables
+    rag_cache_ttl_s: float = 300.0
+    rag_context_cache_size: int = 4096  # sessions whose encoded collected-fields vector is kept
+    rag_message_weight: float = 1.0  # query = message_weight * message + context_weight * collected fields
+    rag_context_weight: float = 0.5
 
     # LLM provider
     llm_provider: str = "mock"  # mock | openai
@@ -39,6 +86,18 @@ class Settings(BaseSettings):
     openai_model: str = "gpt-4o-mini"  # change as desired
     openai_base_url: str | None = None
     llm_timeout_s: float = 30.0
+    llm_connect_timeout_s: float = 5.0
+    # Shared HTTP client of the OpenAI-compatible provider (one per worker, created at startup)
+    llm_max_connections: int = 100  # concurrent requests to the LLM endpoint; more wait for a free connection
+    llm_max_keepalive: int = 20  # idle connections kept open for reuse
+    llm_keepalive_expiry_s: float = 30.0  # idle connections are closed after this long
+    llm_http2: bool = False  # needs the h2 package (pip install "httpx[http2]")
+    # Answer cache: same org, category, prompt, cited sources, index version and model -> same answer
+    llm_cache_size: int = 0  # answers kept in memory; 0 (default) disables the cache
+    llm_cache_ttl_s: float = 900.0
+    llm_cache_persist: bool = False  # also keep answers in llm_cache_path, so they survive restarts
+    llm_cache_path: str = "data/llm_cache.db"
+    mock_llm_latency_s: float = 0.0  # simulated response time of the mock provider (benchmarks)
 
     # Guardrails
     max_turns_before_escalate: int = 6
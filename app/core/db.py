@@ -1,38 +1,392 @@
 from __future__ import annotations
 
+import asyncio
+import contextvars
+import functools
+import os
+import re
 import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
 from pathlib import Path
+from typing import Any, Callable, Iterator, TypeVar
 
 from app.core.config import settings
 
+T = TypeVar("T")
 
-def connect() -> sqlite3.Connection:
+
+def connect(path: str | None = None) -> sqlite3.Connection:
     """Open a SQLite connection with safe defaults.
 
     Notes
     -----
     - WAL mode improves concurrency for read/write workloads typical of chat apps.
     - Foreign keys must be enabled per connection in SQLite.
+    - New files use incremental auto-vacuum, so maintenance can return freed pages a few at a time.
+    - Application code should go through ``connection()`` (pooled) instead.
     """
-    Path(settings.sqlite_path).parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(settings.sqlite_path)
+    path = path or settings.sqlite_path
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    # check_same_thread=False only so close_all() can close other threads' connections;
+    # each connection is otherwise used by the thread that opened it.
+    conn = sqlite3.connect(path, cached_statements=settings.sqlite_cached_statements, check_same_thread=False)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON;")
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")  # only takes effect on a new (empty) file
     conn.execute("PRAGMA journal_mode = WAL;")
     conn.execute("PRAGMA synchronous = NORMAL;")
     return conn
 
 
-def init_schema(schema_path: str = "data/schema.sql") -> None:
-    """Create/upgrade the DB schema for a freshly deployed org site."""
+class ConnectionPool:
+    """Long-lived SQLite connections for one database file, one per thread.
+
+    sqlite3 connections are cheap to keep but not to open (file open, WAL
+    setup, PRAGMAs), so each thread opens its connection once and reuses it;
+    the per-connection statement cache then keeps prepared statements warm.
+    A connection idle for more than ``health_check_s`` is probed with
+    ``SELECT 1`` before reuse and reopened if the probe fails.
+    """
+
+    def __init__(self, path: str, *, health_check_s: float | None = None):
+        self.path = path
+        self.health_check_s = settings.sqlite_health_check_s if health_check_s is None else health_check_s
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._all: set[sqlite3.Connection] = set()
+        self.opened = 0
+        self.reopened = 0
+        self.active = 0  # open connection() blocks, guarded by the module's _pools_lock
+
+    def _open(self) -> sqlite3.Connection:
+        conn = connect(self.path)
+        with self._lock:
+            self._all.add(conn)
+            self.opened += 1
+        return conn
+
+    def _discard(self, conn: sqlite3.Connection) -> None:
+        with self._lock:
+            self._all.discard(conn)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _healthy(self, conn: sqlite3.Connection) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _acquire(self) -> sqlite3.Connection:
+        local = self._local
+        conn: sqlite3.Connection | None = getattr(local, "conn", None)
+        now = time.monotonic()
+        if conn is not None and now - local.used_at > self.health_check_s and not self._healthy(conn):
+            self._discard(conn)
+            self.reopened += 1
+            conn = None
+        if conn is None:
+            conn = self._open()
+            local.conn = conn
+            local.depth = 0
+        local.used_at = now
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Yield this thread's connection; commit on success, roll back on error.
+
+        Nested ``with`` blocks share the outermost transaction: only the
+        outermost block commits or rolls back.
+        """
+        conn = self._acquire()
+        local = self._local
+        local.depth += 1
+        try:
+            yield conn
+        except BaseException:
+            if local.depth == 1 and conn.in_transaction:
+                conn.rollback()
+            raise
+        else:
+            if local.depth == 1 and conn.in_transaction:
+                conn.commit()
+        finally:
+            local.depth -= 1
+
+    def close_all(self) -> None:
+        with self._lock:
+            conns, self._all = self._all, set()
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+    def stats(self) -> dict[str, int | str]:
+        with self._lock:
+            return {"path": self.path, "open": len(self._all), "opened": self.opened, "reopened": self.reopened}
+
+
+# Org database of the current request/task (set by ``use_org_db``); None = settings.sqlite_path.
+_org_db: ContextVar[str | None] = ContextVar("org_db", default=None)
+# Explicit override of the database ``connection()`` uses (``use_db``), e.g. a session shard.
+_current_db: ContextVar[str | None] = ContextVar("current_db", default=None)
+
+# path -> pool, least recently used first. Bounded by sqlite_max_open_dbs.
+_pools: OrderedDict[str, ConnectionPool] = OrderedDict()
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+
+
+def base_path() -> str:
+    """The org's main database in this context (orgs, users, departments, session-less tickets)."""
+    return _org_db.get() or settings.sqlite_path
+
+
+def current_path() -> str:
+    """The SQLite file that ``connection()`` uses in this context."""
+    return _current_db.get() or base_path()
+
+
+def session_db_path(session_id: str) -> str:
+    """Database holding ``session_id``, its messages and tickets.
+
+    With ``session_shards`` > 1, sessions are spread over that many shard
+    files next to the org database by a stable hash of the id (so changing
+    the shard count requires moving existing sessions). Otherwise it's the
+    org database itself. Shard files get their schema on first use.
+    """
+    base = base_path()
+    n = settings.session_shards
+    if n <= 1:
+        return base
+    path = _shard_file(base, zlib.crc32(session_id.encode("utf-8")) % n)
+    ensure_schema(path)
+    return path
+
+
+def session_db_paths() -> list[str]:
+    """Every database that can hold sessions in this context (for scatter-gather reads)."""
+    base = base_path()
+    n = settings.session_shards
+    if n <= 1:
+        return [base]
+    paths = [_shard_file(base, i) for i in range(n)]
+    for path in paths:
+        ensure_schema(path)
+    return paths
+
+
+def _shard_file(base: str, i: int) -> str:
+    p = Path(base)
+    return str(p.with_name(f"{p.stem}.shard-{i:02d}{p.suffix}"))
+
+
+def _get_pool_locked(path: str) -> ConnectionPool:
+    global _pools_pid
+    if _pools_pid != os.getpid():
+        # Forked worker: never reuse the parent's sqlite handles.
+        _pools.clear()
+        _pools_pid = os.getpid()
+    pool = _pools.get(path)
+    if pool is None:
+        pool = _pools[path] = ConnectionPool(path)
+        _evict_idle_locked()
+    _pools.move_to_end(path)
+    return pool
+
+
+def _evict_idle_locked() -> None:
+    # Close the least recently used databases that nobody is using right now;
+    # a busy one is skipped, so the cap can be exceeded briefly under load.
+    excess = len(_pools) - max(1, settings.sqlite_max_open_dbs)
+    for path in list(_pools):
+        if excess <= 0:
+            break
+        pool = _pools[path]
+        if pool.active == 0:
+            del _pools[path]
+            pool.close_all()
+            excess -= 1
+
+
+def get_pool(path: str | None = None) -> ConnectionPool:
+    """Return the process-wide pool for ``path`` (default: ``current_path()``)."""
+    with _pools_lock:
+        return _get_pool_locked(path or current_path())
+
+
+@contextmanager
+def connection(path: str | None = None) -> Iterator[sqlite3.Connection]:
+    """Pooled connection for the org database (see ``ConnectionPool.connection``).
+
+    Without ``path``, uses the database selected by ``use_org_db`` for this
+    context, else ``settings.sqlite_path``.
+    """
+    with _pools_lock:
+        pool = _get_pool_locked(path or current_path())
+        pool.active += 1  # pinned: not evicted while in use
+    try:
+        with pool.connection() as conn:
+            yield conn
+    finally:
+        with _pools_lock:
+            pool.active -= 1
+
+
+def close_pools() -> None:
+    db_executor.shutdown()
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close_all()
+
+
+_ORG_ID = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]{0,63}")
+_initialized: set[str] = set()
+_init_lock = threading.Lock()
+
+
+def org_db_path(org_id: str) -> str:
+    """SQLite file for ``org_id``: ``<org_db_dir>/<org_id>.db`` in per-org mode, else the shared file."""
+    if settings.sqlite_routing != "per_org":
+        return settings.sqlite_path
+    if not _ORG_ID.fullmatch(org_id) or ".." in org_id:
+        raise ValueError(f"org_id {org_id!r} cannot be mapped to a database file")
+    return str(Path(settings.org_db_dir) / f"{org_id}.db")
+
+
+def ensure_schema(path: str) -> None:
+    """Run ``init_schema`` for ``path`` once per process (creates a new org's file on first use)."""
+    if path in _initialized:
+        return
+    with _init_lock:
+        if path not in _initialized:
+            init_schema(path=path)
+            _initialized.add(path)
+
+
+@contextmanager
+def use_org_db(org_id: str) -> Iterator[str]:
+    """Route ``connection()`` calls in this context (and DB executor jobs it starts) to ``org_id``'s database."""
+    path = org_db_path(org_id)
+    if settings.sqlite_routing == "per_org":
+        ensure_schema(path)
+    token = _org_db.set(path)
+    try:
+        yield path
+    finally:
+        _org_db.reset(token)
+
+
+@contextmanager
+def use_db(path: str) -> Iterator[str]:
+    """Point ``connection()`` at ``path`` in this context (creating its schema on first use)."""
+    ensure_schema(path)
+    token = _current_db.set(path)
+    try:
+        yield path
+    finally:
+        _current_db.reset(token)
+
+
+class DbExecutor:
+    """Runs blocking sqlite3 calls off the event loop.
+
+    Writes go to a single writer thread, so they are serialized in-process and
+    never contend with each other for SQLite's write lock; reads go to a small
+    reader pool and, with WAL, proceed while a write is in flight. Each thread
+    uses its own pooled connection (``ConnectionPool`` is per thread).
+
+    With ``sqlite_async`` off, calls run inline on the caller's thread (the
+    old blocking behavior, kept for benchmarks and debugging).
+    """
+
+    def __init__(self, reader_threads: int | None = None):
+        self.reader_threads = reader_threads or settings.sqlite_reader_threads
+        self._writer: ThreadPoolExecutor | None = None
+        self._readers: ThreadPoolExecutor | None = None
+        self._lock = threading.Lock()
+
+    def _pools(self) -> tuple[ThreadPoolExecutor, ThreadPoolExecutor]:
+        with self._lock:
+            if self._writer is None or self._readers is None:
+                self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+                self._readers = ThreadPoolExecutor(max_workers=self.reader_threads, thread_name_prefix="db-reader")
+            return self._writer, self._readers
+
+    async def _run(self, pool: ThreadPoolExecutor, fn: Callable[..., T], args: Any, kwargs: Any) -> T:
+        if not settings.sqlite_async:
+            return fn(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        # Carry context variables (the routed org database) over to the DB thread.
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(pool, functools.partial(ctx.run, fn, *args, **kwargs))
+
+    async def read(self, fn: Callable[..., T], /, *args: Any, **kwargs: Any) -> T:
+        return await self._run(self._pools()[1], fn, args, kwargs)
+
+    async def write(self, fn: Callable[..., T], /, *args: Any, **kwargs: Any) -> T:
+        return await self._run(self._pools()[0], fn, args, kwargs)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            pools = [p for p in (self._writer, self._readers) if p is not None]
+            self._writer = self._readers = None
+        for p in pools:
+            p.shutdown(wait=True)
+
+
+db_executor = DbExecutor()
+
+
+# Columns added after the first release: ``CREATE TABLE IF NOT EXISTS`` in
+# schema.sql won't add them to an existing org DB, so init_schema does.
+# table -> {column: column definition}
+ADDED_COLUMNS: dict[str, dict[str, str]] = {
+    "sessions": {"version": "INTEGER NOT NULL DEFAULT 1"},
+}
+
+# External-content FTS5 tables in schema.sql; rebuilt from their content table when first created,
+# so rows written before the upgrade are searchable too.
+FTS_TABLES = ("tickets_fts", "messages_fts")
+
+
+def ensure_columns(conn: sqlite3.Connection, table: str, columns: dict[str, str]) -> list[str]:
+    """``ALTER TABLE ... ADD COLUMN`` each of ``columns`` that ``table`` lacks. Returns the added names."""
+    existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+    added = []
+    for name, ddl in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}")
+            added.append(name)
+    return added
+
+
+def init_schema(schema_path: str = "data/schema.sql", path: str | None = None) -> None:
+    """Create/upgrade the DB schema for a freshly deployed org site (``path``: default database)."""
     sql_path = Path(schema_path)
     if not sql_path.exists():
         raise FileNotFoundError(f"Schema file not found: {schema_path}")
 
     sql = sql_path.read_text(encoding="utf-8")
-    conn = connect()
-    try:
+    with connection(path) as conn:
+        existing = {row["name"] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
         conn.executescript(sql)
-        conn.commit()
-    finally:
-        conn.close()
+        for table, columns in ADDED_COLUMNS.items():
+            ensure_columns(conn, table, columns)
+        for table in FTS_TABLES:
+            if table not in existing:
+                conn.execute(f"INSERT INTO {table}({table}) VALUES('rebuild')")
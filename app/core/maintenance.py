@@ -0,0 +1,438 @@
+"""Database maintenance: idle-session sweeper, transcript archival, vacuum/analyze.
+
+``run_maintenance`` runs these steps against every live database: sessions, shards and per-org files.
+
+0. Move citations still stored inline (``citations_json`` of rows written before
+   citations were normalized) into ``kb_chunks`` and the link tables.
+
+1. Close open sessions idle for longer than ``session_idle_ttl_s``.
+2. Move closed sessions last touched more than ``archive_after_days`` ago out of
+   the live database, together with their messages and tickets. They go into
+   per-month archive files, ``<archive_dir>/<db stem>.<YYYY-MM>.db``, where text
+   and JSON columns are stored zlib-compressed. ``load_archived_session`` reads
+   them back.
+3. Delete ``kb_chunks`` rows no remaining message or ticket cites, return up to
+   ``vacuum_pages`` free pages to the OS (incremental vacuum), then ``PRAGMA
+   optimize``, which re-ANALYZEs tables whose statistics went stale.
+
+Every step works in batches of ``maintenance_batch`` rows, one short transaction
+each, so live writers only ever wait for one batch. A batch is written and
+committed to the archive before it is deleted from the live database. A crash
+between the two leaves the rows in both places, and the next run replaces them
+in the archive and deletes them. A session that changed after it was read is
+skipped and left for the next run.
+
+``scripts/maintain_db.py`` runs it from cron. Alternatively, one API worker can run it
+every ``maintenance_interval_s`` on a background thread (off by default).
+"""
+from __future__ import annotations
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import closing
+from pathlib import Path
+from typing import Any
+
+from app.core import repository
+from app.core.config import settings
+from app.core.db import connection, session_db_path
+from app.core.session import session_cache
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+  session_id           TEXT PRIMARY KEY,
+  org_id               TEXT NOT NULL,
+  user_id              TEXT NOT NULL,
+  turns                INTEGER NOT NULL,
+  category             TEXT,
+  status               TEXT NOT NULL,
+  collected_json       BLOB NOT NULL, -- zlib
+  steps_attempted_json BLOB NOT NULL, -- zlib
+  version              INTEGER NOT NULL,
+  created_at           TEXT NOT NULL,
+  updated_at           TEXT NOT NULL,
+  archived_at          TEXT NOT NULL DEFAULT (datetime('now'))
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_org_updated ON sessions(org_id, updated_at);
+
+CREATE TABLE IF NOT EXISTS messages (
+  message_id     TEXT PRIMARY KEY,
+  session_id     TEXT NOT NULL,
+  role           TEXT NOT NULL,
+  content        BLOB NOT NULL, -- zlib
+  citations_json BLOB NOT NULL, -- zlib
+  created_at     TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_session_time ON messages(session_id, created_at);
+
+CREATE TABLE IF NOT EXISTS tickets (
+  ticket_id            TEXT PRIMARY KEY,
+  org_id               TEXT NOT NULL,
+  user_id              TEXT NOT NULL,
+  session_id           TEXT,
+  summary              TEXT NOT NULL,
+  category             TEXT NOT NULL,
+  impact               TEXT NOT NULL,
+  urgency              TEXT NOT NULL,
+  status               TEXT NOT NULL,
+  escalation_reason    TEXT NOT NULL,
+  rendered_text        BLOB NOT NULL, -- zlib
+  diagnostics_json     BLOB NOT NULL, -- zlib
+  steps_attempted_json BLOB NOT NULL, -- zlib
+  citations_json       BLOB NOT NULL, -- zlib
+  created_at           TEXT NOT NULL,
+  closed_at            TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_tickets_session ON tickets(session_id);
+"""
+
+ARCHIVE_COLUMNS: dict[str, tuple[str, ...]] = {
+    "sessions": (
+        "session_id", "org_id", "user_id", "turns", "category", "status",
+        "collected_json", "steps_attempted_json", "version", "created_at", "updated_at",
+    ),
+    "messages": ("message_id", "session_id", "role", "content", "citations_json", "created_at"),
+    "tickets": (
+        "ticket_id", "org_id", "user_id", "session_id", "summary", "category", "impact", "urgency",
+        "status", "escalation_reason", "rendered_text", "diagnostics_json", "steps_attempted_json",
+        "citations_json", "created_at", "closed_at",
+    ),
+}
+COMPRESSED = {"collected_json", "steps_attempted_json", "content", "citations_json", "rendered_text", "diagnostics_json"}
+
+_PAUSE_S = 0.01  # between batches, so waiting writers get the lock
+
+
+def _deflate(row: dict[str, Any]) -> dict[str, Any]:
+    return {k: zlib.compress(v.encode("utf-8")) if k in COMPRESSED and v is not None else v for k, v in row.items()}
+
+
+def _inflate(row: sqlite3.Row) -> dict[str, Any]:
+    return {k: zlib.decompress(row[k]).decode("utf-8") if k in COMPRESSED else row[k] for k in row.keys()}
+
+
+def _in(ids: list[str]) -> str:
+    return ",".join("?" * len(ids))
+
+
+def archive_path(path: str, month: str) -> str:
+    return str(Path(settings.archive_dir) / f"{Path(path).stem}.{month}.db")
+
+
+def archive_files(path: str) -> list[str]:
+    """Archive files of the live database ``path``, newest month first."""
+    return sorted((str(p) for p in Path(settings.archive_dir).glob(f"{Path(path).stem}.????-??.db")), reverse=True)
+
+
+def _open_archive(path: str) -> sqlite3.Connection:
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path)  # rollback journal: an archive stays one self-contained file
+    conn.row_factory = sqlite3.Row
+    conn.executescript(ARCHIVE_SCHEMA)
+    return conn
+
+
+def maintenance_paths() -> list[str]:
+    """Every live database this process knows about."""
+    if settings.sqlite_routing == "per_org":
+        return sorted(str(p) for p in Path(settings.org_db_dir).glob("*.db"))
+    return repository.ticket_db_paths()
+
+
+def migrate_inline_citations(path: str, *, batch: int | None = None) -> int:
+    """Move inline ``citations_json`` into ``kb_chunks`` + link tables. Returns rows migrated."""
+    batch = batch or settings.maintenance_batch
+    migrated = 0
+    for kind, (table, key) in (("message", ("messages", "message_id")), ("ticket", ("tickets", "ticket_id"))):
+        while True:
+            with connection(path) as conn:
+                if not conn.in_transaction:
+                    conn.execute("BEGIN IMMEDIATE")
+                rows = conn.execute(
+                    f"SELECT {key}, citations_json FROM {table} WHERE citations_json != '[]' LIMIT ?", (batch,)
+                ).fetchall()
+                for owner_id, citations_json in rows:
+                    repository.write_citations(conn, kind, owner_id, json.loads(citations_json))
+                conn.executemany(f"UPDATE {table} SET citations_json='[]' WHERE {key}=?", [(r[0],) for r in rows])
+            migrated += len(rows)
+            if len(rows) < batch:
+                break
+            time.sleep(_PAUSE_S)
+    return migrated
+
+
+def close_idle_sessions(path: str, *, idle_s: float | None = None, batch: int | None = None) -> int:
+    """Close open sessions not updated for ``idle_s`` seconds. Returns how many were closed."""
+    idle_s = settings.session_idle_ttl_s if idle_s is None else idle_s
+    batch = batch or settings.maintenance_batch
+    if idle_s <= 0:
+        return 0
+    closed = 0
+    while True:
+        with connection(path) as conn:
+            ids = conn.execute(
+                """
+                UPDATE sessions
+                SET status='closed', version=version+1, updated_at=datetime('now')
+                WHERE session_id IN (
+                  SELECT session_id FROM sessions
+                  WHERE status='open' AND updated_at < datetime('now', ?)
+                  LIMIT ?
+                )
+                RETURNING session_id
+                """,
+                (f"-{idle_s} seconds", batch),
+            ).fetchall()
+        for (sid,) in ids:
+            session_cache.pop((path, sid))
+        closed += len(ids)
+        if len(ids) < batch:
+            return closed
+        time.sleep(_PAUSE_S)
+
+
+def archive_closed_sessions(path: str, *, after_days: float | None = None, batch: int | None = None) -> dict[str, int]:
+    """Move closed sessions older than ``after_days`` (and their messages/tickets) to the archive."""
+    after_days = settings.archive_after_days if after_days is None else after_days
+    batch = batch or settings.maintenance_batch
+    counts = {"sessions": 0, "messages": 0, "tickets": 0}
+    if after_days <= 0:
+        return counts
+    cols = ARCHIVE_COLUMNS
+    while True:
+        with connection(path) as conn:
+            sessions = [
+                dict(r)
+                for r in conn.execute(
+                    f"""
+                    SELECT {", ".join(cols["sessions"])} FROM sessions
+                    WHERE status='closed' AND updated_at < datetime('now', ?)
+                    ORDER BY updated_at
+                    LIMIT ?
+                    """,
+                    (f"-{after_days} days", batch),
+                )
+            ]
+            if not sessions:
+                return counts
+            ids = [s["session_id"] for s in sessions]
+            messages = [
+                dict(r)
+                for r in conn.execute(
+                    f"SELECT {', '.join(cols['messages'])} FROM messages WHERE session_id IN ({_in(ids)})", ids
+                )
+            ]
+            tickets = [
+                dict(r)
+                for r in conn.execute(
+                    f"SELECT {', '.join(cols['tickets'])} FROM tickets WHERE session_id IN ({_in(ids)})", ids
+                )
+            ]
+        # Archives keep citations inline (a self-contained file; no kb_chunks there).
+        for kind, rows, key in (("message", messages, "message_id"), ("ticket", tickets, "ticket_id")):
+            cites = repository.citations_for(kind, [r[key] for r in rows], path=path)
+            for r in rows:
+                if r[key] in cites:
+                    r["citations_json"] = json.dumps(cites[r[key]])
+
+        # 1. Archive (committed before anything is deleted from the live database).
+        month_of = {s["session_id"]: s["updated_at"][:7] for s in sessions}
+        by_month: dict[str, dict[str, list[dict[str, Any]]]] = {}
+        for table, rows in (("sessions", sessions), ("messages", messages), ("tickets", tickets)):
+            for row in rows:
+                by_month.setdefault(month_of[row["session_id"]], {}).setdefault(table, []).append(_deflate(row))
+        for month, tables in by_month.items():
+            with closing(_open_archive(archive_path(path, month))) as arc, arc:
+                for table, rows in tables.items():
+                    arc.executemany(
+                        f"INSERT OR REPLACE INTO {table}({', '.join(cols[table])}) "
+                        f"VALUES({', '.join(':' + c for c in cols[table])})",
+                        rows,
+                    )
+
+        # 2. Delete what was archived, skipping sessions that changed since they were read.
+        n_messages = {sid: 0 for sid in ids}
+        n_tickets = {sid: 0 for sid in ids}
+        for m in messages:
+            n_messages[m["session_id"]] += 1
+        for t in tickets:
+            n_tickets[t["session_id"]] += 1
+        deleted = 0
+        with connection(path) as conn:
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            for s in sessions:
+                sid = s["session_id"]
+                unchanged = conn.execute(
+                    """
+                    SELECT (SELECT version FROM sessions WHERE session_id=?) = ?
+                       AND (SELECT COUNT(*) FROM messages WHERE session_id=?) = ?
+                       AND (SELECT COUNT(*) FROM tickets WHERE session_id=?) = ?
+                    """,
+                    (sid, s["version"], sid, n_messages[sid], sid, n_tickets[sid]),
+                ).fetchone()[0]
+                if not unchanged:
+                    continue
+                conn.execute("DELETE FROM tickets WHERE session_id=?", (sid,))
+                conn.execute("DELETE FROM messages WHERE session_id=?", (sid,))
+                conn.execute("DELETE FROM sessions WHERE session_id=?", (sid,))
+                session_cache.pop((path, sid))
+                counts["sessions"] += 1
+                counts["messages"] += n_messages[sid]
+                counts["tickets"] += n_tickets[sid]
+                deleted += 1
+        if deleted == 0 or len(sessions) < batch:
+            return counts
+        time.sleep(_PAUSE_S)
+
+
+def prune_kb_chunks(path: str, *, batch: int | None = None) -> int:
+    """Delete ``kb_chunks`` rows no message or ticket links to any more (e.g. after archival). Returns how many.
+
+    Safe against concurrent writers: a new link and its chunk row are
+    inserted in one transaction, so a chunk deleted here is re-inserted by
+    the next message that cites it.
+    """
+    batch = batch or settings.maintenance_batch
+    pruned = 0
+    while True:
+        with connection(path) as conn:
+            n = conn.execute(
+                """
+                DELETE FROM kb_chunks WHERE chunk_id IN (
+                  SELECT k.chunk_id FROM kb_chunks k
+                  WHERE NOT EXISTS (SELECT 1 FROM message_citations m WHERE m.chunk_id = k.chunk_id)
+                    AND NOT EXISTS (SELECT 1 FROM ticket_citations t WHERE t.chunk_id = k.chunk_id)
+                  LIMIT ?
+                )
+                """,
+                (batch,),
+            ).rowcount
+        pruned += n
+        if n < batch:
+            return pruned
+        time.sleep(_PAUSE_S)
+
+
+def vacuum_and_analyze(path: str, *, pages: int | None = None) -> dict[str, int]:
+    """Prune orphaned KB chunks, free up to ``pages`` unused pages and refresh planner statistics."""
+    pages = settings.vacuum_pages if pages is None else pages
+    pruned = prune_kb_chunks(path)
+    freed = 0
+    with connection(path) as conn:
+        if pages > 0 and conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:  # incremental
+            before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+            freed = before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+        conn.execute("PRAGMA analysis_limit=400")  # bounds the sampling ANALYZE does per index
+        conn.execute("PRAGMA optimize")
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+    return {"pruned_chunks": pruned, "vacuumed_pages": freed}
+
+
+def run_maintenance(paths: list[str] | None = None) -> dict[str, dict[str, int]]:
+    """One maintenance pass over ``paths`` (default: ``maintenance_paths()``)."""
+    out = {}
+    for path in paths if paths is not None else maintenance_paths():
+        migrated = migrate_inline_citations(path)
+        archived = archive_closed_sessions(path)
+        out[path] = {
+            "migrated_citations": migrated,
+            "closed": close_idle_sessions(path),
+            "archived_sessions": archived["sessions"],
+            "archived_messages": archived["messages"],
+            "archived_tickets": archived["tickets"],
+            **vacuum_and_analyze(path),
+        }
+    return out
+
+
+def load_archived_session(session_id: str, *, path: str | None = None) -> dict[str, Any] | None:
+    """An archived session with its transcript and tickets (decompressed), or None.
+
+    ``path`` is the live database the session was archived from (default: where it would live now).
+    """
+    for file in archive_files(path or session_db_path(session_id)):
+        with closing(sqlite3.connect(f"file:{file}?mode=ro", uri=True)) as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM sessions WHERE session_id=?", (session_id,)).fetchone()
+            if row is None:
+                continue
+            messages = conn.execute(
+                "SELECT * FROM messages WHERE session_id=? ORDER BY created_at", (session_id,)
+            ).fetchall()
+            tickets = conn.execute("SELECT * FROM tickets WHERE session_id=? ORDER BY created_at", (session_id,))
+            return {
+                "session": _inflate(row),
+                "messages": [_inflate(m) for m in messages],
+                "tickets": [_inflate(t) for t in tickets],
+                "archive": file,
+            }
+    return None
+
+
+class Maintenance:
+    """Runs ``run_maintenance`` every ``interval_s`` on a daemon thread.
+
+    Off by default (``maintenance_interval_s=0``): every API worker would
+    start its own thread and repeat the same work against the same files.
+    Enable it on one worker only, or run ``scripts/maintain_db.py`` from cron.
+    """
+
+    def __init__(self, *, interval_s: float | None = None):
+        self.interval_s = settings.maintenance_interval_s if interval_s is None else interval_s
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.runs = 0
+        self.failures = 0
+        self.last_run_s: float | None = None
+        self.totals: dict[str, int] = {}
+
+    def start(self) -> None:
+        if self.interval_s <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="db-maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = 30.0) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            self.run_once()
+
+    def run_once(self) -> None:
+        t0 = time.perf_counter()
+        try:
+            result = run_maintenance()
+        except Exception:
+            self.failures += 1
+            logger.exception("Database maintenance failed")
+            return
+        self.runs += 1
+        self.last_run_s = time.perf_counter() - t0
+        for counts in result.values():
+            for name, n in counts.items():
+                self.totals[name] = self.totals.get(name, 0) + n
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "interval_s": self.interval_s,
+            "runs": self.runs,
+            "failures": self.failures,
+            "last_run_s": self.last_run_s,
+            **self.totals,
+        }
+
+
+maintenance = Maintenance()
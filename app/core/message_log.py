@@ -0,0 +1,211 @@
+"""Write-behind transcript log.
+
+Nothing in a chat turn reads its own transcript lines back, so they don't need
+to be committed on the request path. ``MessageLog.append`` puts the row on a
+bounded queue and returns; a background writer drains it and inserts each
+batch with one ``executemany`` in one transaction (group commit), flushing
+every ``message_log_flush_ms`` or every ``message_log_batch`` rows, whichever
+comes first. A full queue blocks the producer (backpressure) instead of
+growing without bound. ``close()`` flushes everything on shutdown.
+
+``TIER1_MESSAGE_LOG_MODE=sync`` keeps transcript writes inside the turn's
+transaction for deployments that need them durable before the response.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Iterable
+
+from app.core import repository
+from app.core.config import settings
+from app.core.db import connection, session_db_path
+
+logger = logging.getLogger(__name__)
+
+INSERT_SQL = """
+INSERT INTO messages(message_id, session_id, role, content)
+VALUES(?,?,?,?)
+"""
+
+_STOP = object()
+
+
+@dataclass(frozen=True)
+class _Entry:
+    path: str
+    row: tuple[str, str, str, str]
+    citations: tuple[dict[str, Any], ...]
+    seq: int
+
+
+class MessageLog:
+    def __init__(self, *, max_queue: int | None = None, batch: int | None = None, flush_ms: float | None = None):
+        self.max_queue = max_queue or settings.message_log_max_queue
+        self.batch = batch or settings.message_log_batch
+        self.flush_ms = settings.message_log_flush_ms if flush_ms is None else flush_ms
+        self._lock = threading.Lock()
+        self._put_lock = threading.Lock()  # keeps queue order == sequence order
+        self._done = threading.Condition(self._lock)
+        self._queue: queue.Queue[Any] | None = None
+        self._thread: threading.Thread | None = None
+        self._pid = 0
+        self._seq = 0  # last sequence number handed out
+        self._written_seq = 0  # every entry up to here has been written (or dropped)
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+
+    def _ensure_started(self) -> queue.Queue[Any]:
+        # Called with self._lock held.
+        if self._thread is None or self._queue is None or self._pid != os.getpid():
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            self._pid = os.getpid()
+            self._start_writer(self._queue)
+        elif not self._thread.is_alive():
+            # The writer died; a new one drains the same queue, so nothing queued is lost.
+            logger.warning("Transcript writer thread died; restarting it")
+            self._start_writer(self._queue)
+        return self._queue
+
+    def _start_writer(self, q: queue.Queue[Any]) -> None:
+        self._thread = threading.Thread(target=self._run, args=(q,), name="message-log", daemon=True)
+        self._thread.start()
+
+    def append(
+        self,
+        *,
+        session_id: str,
+        role: str,
+        content: str,
+        citations: list[dict[str, Any]] | None = None,
+        message_id: str | None = None,
+    ) -> str:
+        """Queue one transcript row; blocks while the queue is full."""
+        message_id = message_id or str(uuid.uuid4())
+        row = (message_id, session_id, role, content)
+        with self._put_lock:
+            with self._lock:
+                q = self._ensure_started()
+                self._seq += 1
+                entry = _Entry(session_db_path(session_id), row, tuple(citations or ()), self._seq)
+            q.put(entry)  # may block (backpressure); the writer never takes _put_lock
+        return message_id
+
+    def append_many(self, messages: Iterable[dict[str, Any]]) -> None:
+        for m in messages:
+            self.append(**m)
+
+    def flush(self, timeout: float | None = 10.0) -> bool:
+        """Block until everything appended so far is written. Returns False on timeout."""
+        with self._lock:
+            target = self._seq
+            if self._written_seq < target and self._queue is not None:
+                self._ensure_started()
+            return self._done.wait_for(lambda: self._written_seq >= target, timeout=timeout)
+
+    def close(self, timeout: float | None = 30.0) -> None:
+        """Flush and stop the writer (API shutdown)."""
+        with self._put_lock:
+            with self._lock:
+                thread, q = self._thread, self._queue
+                self._thread = self._queue = None
+            if thread is None or q is None or not thread.is_alive():
+                return
+            q.put(_STOP)
+        thread.join(timeout)
+
+    def _run(self, q: queue.Queue[Any]) -> None:
+        stop = False
+        while not stop:
+            item = q.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_ms / 1000.0
+            while len(batch) < self.batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = q.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch: list[_Entry]) -> None:
+        written = failed = 0
+        try:
+            written, failed = self._write(batch)
+        except Exception:
+            # Never let the writer die over one batch: every row queued behind it would
+            # be stranded and producers would block once the queue fills.
+            logger.exception("Dropping %d transcript messages", len(batch))
+            failed = len(batch)
+        except BaseException:
+            failed = len(batch)
+            raise
+        finally:
+            with self._lock:
+                self.written += written
+                self.failed += failed
+                self.batches += 1
+                self._written_seq = max(self._written_seq, batch[-1].seq)
+                self._done.notify_all()
+
+    def _write(self, batch: list[_Entry]) -> tuple[int, int]:
+        """Insert ``batch``; returns (written, failed) row counts."""
+        by_path: dict[str, list[_Entry]] = {}
+        for e in batch:
+            by_path.setdefault(e.path, []).append(e)
+        written = failed = 0
+        for path, entries in by_path.items():
+            try:
+                chunks, links = [], []
+                for e in entries:
+                    entry_chunks, entry_links = repository.citation_rows(e.row[0], e.citations)
+                    chunks += entry_chunks
+                    links += entry_links
+                with connection(path) as conn:
+                    conn.executemany(INSERT_SQL, [e.row for e in entries])
+                    conn.executemany(repository.KB_CHUNK_INSERT_SQL, chunks)
+                    conn.executemany(repository.CITATION_LINK_SQL["message"], links)
+                written += len(entries)
+            except Exception:
+                # One bad row (e.g. a session that never got saved, or a malformed
+                # citation) must not lose the rest of the batch; retry row by row and
+                # log the rejects.
+                for e in entries:
+                    try:
+                        with connection(path) as conn:
+                            conn.execute(INSERT_SQL, e.row)
+                            repository.write_citations(conn, "message", e.row[0], e.citations)
+                        written += 1
+                    except Exception:
+                        failed += 1
+                        logger.exception("Dropping transcript message %s for session %s", e.row[0], e.row[1])
+        return written, failed
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            q = self._queue
+            return {
+                "mode": settings.message_log_mode,
+                "queued": q.qsize() if q is not None else 0,
+                "max_queue": self.max_queue,
+                "written": self.written,
+                "batches": self.batches,
+                "failed": self.failed,
+            }
+
+
+message_log = MessageLog()
@@ -0,0 +1,125 @@
+"""Bulk org/department/user provisioning (onboarding a new org site).
+
+Rows are upserted with the same statements as ``ensure_org`` /
+``ensure_department`` / ``ensure_user``, but with ``executemany`` in a single
+transaction per database, and every provisioned identity is added to the
+identity cache. With session sharding each shard file holds its own copies
+of the org/user rows its sessions reference, so provisioning writes through
+to every shard as well as the org database.
+
+CSV input accepts our own column names or the attribute names of a typical
+LDAP/AD export (``uid``/``sAMAccountName``, ``givenName``, ``sn``, ``mail``,
+``departmentNumber``, ``department``).
+"""
+from __future__ import annotations
+
+import csv
+import io
+from dataclasses import dataclass, field
+from typing import Any, Iterable, TextIO
+
+from app.core import repository
+from app.core.db import base_path, connection, session_db_paths, use_db
+
+# canonical column -> accepted header names (compared case-insensitively)
+COLUMN_ALIASES: dict[str, tuple[str, ...]] = {
+    "user_id": ("user_id", "uid", "samaccountname", "userprincipalname"),
+    "first_name": ("first_name", "givenname"),
+    "last_name": ("last_name", "sn", "surname"),
+    "email": ("email", "mail"),
+    "role": ("role",),
+    "dept_id": ("dept_id", "departmentnumber"),
+    "dept_name": ("dept_name", "department"),
+}
+
+ROLES = {"end_user", "admin", "agent"}
+
+
+class ProvisionError(ValueError):
+    pass
+
+
+@dataclass
+class Roster:
+    departments: dict[int, str] = field(default_factory=dict)
+    users: list[dict[str, Any]] = field(default_factory=list)
+
+
+def _header_map(fieldnames: Iterable[str]) -> dict[str, str]:
+    lookup = {name.strip().lower(): name for name in fieldnames}
+    out = {}
+    for column, aliases in COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in lookup:
+                out[column] = lookup[alias]
+                break
+    if "user_id" not in out:
+        raise ProvisionError("CSV needs a user id column (user_id, uid or sAMAccountName)")
+    return out
+
+
+def read_roster(f: TextIO) -> Roster:
+    """Parse a user CSV/LDAP export into departments and user rows."""
+    reader = csv.DictReader(f)
+    cols = _header_map(reader.fieldnames or [])
+    roster = Roster()
+    for line, raw in enumerate(reader, start=2):
+        row = {c: (raw.get(h) or "").strip() or None for c, h in cols.items()}
+        if not row["user_id"]:
+            raise ProvisionError(f"line {line}: missing user id")
+        dept_id = row.get("dept_id")
+        if dept_id is not None:
+            try:
+                dept_id = int(dept_id)
+            except ValueError:
+                raise ProvisionError(f"line {line}: dept_id must be an integer, got {dept_id!r}")
+            if row.get("dept_name"):
+                roster.departments[dept_id] = row["dept_name"]
+        role = (row.get("role") or "end_user").lower()
+        if role not in ROLES:
+            raise ProvisionError(f"line {line}: unknown role {role!r}")
+        roster.users.append(
+            {
+                "user_id": row["user_id"],
+                "first_name": row.get("first_name"),
+                "last_name": row.get("last_name"),
+                "email": row.get("email"),
+                "role": role,
+                "dept_id": dept_id,
+            }
+        )
+    return roster
+
+
+def read_roster_text(text: str) -> Roster:
+    return read_roster(io.StringIO(text))
+
+
+def provision(org_id: str, roster: Roster, *, org_name: str | None = None) -> dict[str, int]:
+    """Upsert the org, its departments and users into the org database and every session shard.
+
+    One transaction per database, the org database first. Returns row counts.
+    """
+    base = base_path()
+    for path in [base, *(p for p in session_db_paths() if p != base)]:
+        with use_db(path):
+            _provision_db(org_id, roster, org_name)
+    return {"orgs": 1, "departments": len(roster.departments), "users": len(roster.users)}
+
+
+def _provision_db(org_id: str, roster: Roster, org_name: str | None) -> None:
+    with connection() as conn:
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        conn.execute(repository.ORG_UPSERT_SQL, (org_id, org_name, org_id))
+        conn.executemany(repository.DEPARTMENT_UPSERT_SQL, sorted(roster.departments.items()))
+        conn.executemany(
+            repository.USER_UPSERT_SQL,
+            (
+                (u["user_id"], org_id, u["first_name"], u["last_name"], u["email"], u["role"], u["dept_id"])
+                for u in roster.users
+            ),
+        )
+    repository.remember_org(org_id)
+    for u in roster.users:
+        repository.remember_user(org_id, u["user_id"])
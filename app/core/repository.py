@@ -1,10 +1,74 @@
 from __future__ import annotations
 
+import hashlib
+import heapq
+import itertools
 import json
+import re
+import sqlite3
 import uuid
-from typing import Any, Iterable
+from typing import Any, Iterable, Iterator
 
-from app.core.db import connect
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.core.db import base_path, connection, current_path, session_db_path, session_db_paths
+
+ORG_UPSERT_SQL = """
+INSERT INTO orgs(org_id, name)
+VALUES(?, COALESCE(?, ?))
+ON CONFLICT(org_id) DO UPDATE SET
+  name=COALESCE(excluded.name, orgs.name)
+"""
+
+DEPARTMENT_UPSERT_SQL = """
+INSERT INTO departments(dept_id, dept_name)
+VALUES(?, ?)
+ON CONFLICT(dept_id) DO UPDATE SET
+  dept_name=excluded.dept_name
+"""
+
+USER_UPSERT_SQL = """
+INSERT INTO users(user_id, org_id, first_name, last_name, email, role, dept_id)
+VALUES(?,?,?,?,?,?,?)
+ON CONFLICT(user_id) DO UPDATE SET
+  org_id=excluded.org_id,
+  first_name=COALESCE(excluded.first_name, users.first_name),
+  last_name=COALESCE(excluded.last_name, users.last_name),
+  email=COALESCE(excluded.email, users.email),
+  role=COALESCE(excluded.role, users.role),
+  dept_id=COALESCE(excluded.dept_id, users.dept_id)
+"""
+
+# Orgs/users known to exist in a database, so the chat hot path can skip the
+# ensure_* upserts. Keys are ("org", db path, org_id) / ("user", db path, org_id, user_id);
+# entries are only added once the row is committed.
+identity_cache: TTLCache[tuple[str, ...], bool] = TTLCache(settings.identity_cache_size, settings.identity_cache_ttl_s)
+
+
+def _org_key(org_id: str) -> tuple[str, ...]:
+    return ("org", current_path(), org_id)
+
+
+def _user_key(org_id: str, user_id: str) -> tuple[str, ...]:
+    return ("user", current_path(), org_id, user_id)
+
+
+def org_known(org_id: str) -> bool:
+    return identity_cache.get(_org_key(org_id)) is not None
+
+
+def user_known(org_id: str, user_id: str) -> bool:
+    return identity_cache.get(_user_key(org_id, user_id)) is not None
+
+
+def remember_org(org_id: str) -> None:
+    """Mark ``org_id`` as existing; call only once its row is committed."""
+    identity_cache.put(_org_key(org_id), True)
+
+
+def remember_user(org_id: str, user_id: str) -> None:
+    """Mark ``user_id`` as existing in ``org_id``; call only once its row is committed."""
+    identity_cache.put(_user_key(org_id, user_id), True)
 
 
 def ensure_org(org_id: str, name: str | None = None) -> None:
@@ -13,37 +77,15 @@ def ensure_org(org_id: str, name: str | None = None) -> None:
     In a per-org DB deployment, this should be called once at install time,
     but it's harmless to call on demand (idempotent).
     """
-    conn = connect()
-    try:
-        conn.execute(
-            """
-            INSERT INTO orgs(org_id, name)
-            VALUES(?, COALESCE(?, ?))
-            ON CONFLICT(org_id) DO UPDATE SET
-              name=COALESCE(excluded.name, orgs.name)
-            """,
-            (org_id, name, org_id),
-        )
-        conn.commit()
-    finally:
-        conn.close()
+    with connection() as conn:
+        conn.execute(ORG_UPSERT_SQL, (org_id, name, org_id))
+    if not conn.in_transaction:  # committed (not nested in a caller's transaction)
+        remember_org(org_id)
 
 
 def ensure_department(dept_id: int, dept_name: str) -> None:
-    conn = connect()
-    try:
-        conn.execute(
-            """
-            INSERT INTO departments(dept_id, dept_name)
-            VALUES(?, ?)
-            ON CONFLICT(dept_id) DO UPDATE SET
-              dept_name=excluded.dept_name
-            """,
-            (int(dept_id), dept_name),
-        )
-        conn.commit()
-    finally:
-        conn.close()
+    with connection() as conn:
+        conn.execute(DEPARTMENT_UPSERT_SQL, (int(dept_id), dept_name))
 
 
 def ensure_user(
@@ -57,25 +99,87 @@ def ensure_user(
     dept_id: int | None = None,
 ) -> None:
     """Ensure a user row exists."""
-    conn = connect()
-    try:
-        conn.execute(
-            """
-            INSERT INTO users(user_id, org_id, first_name, last_name, email, role, dept_id)
-            VALUES(?,?,?,?,?,?,?)
-            ON CONFLICT(user_id) DO UPDATE SET
-              org_id=excluded.org_id,
-              first_name=COALESCE(excluded.first_name, users.first_name),
-              last_name=COALESCE(excluded.last_name, users.last_name),
-              email=COALESCE(excluded.email, users.email),
-              role=COALESCE(excluded.role, users.role),
-              dept_id=COALESCE(excluded.dept_id, users.dept_id)
+    with connection() as conn:
+        conn.execute(USER_UPSERT_SQL, (user_id, org_id, first_name, last_name, email, role, dept_id))
+    if not conn.in_transaction:
+        remember_user(org_id, user_id)
+
+
+# Citations are stored once per KB chunk (kb_chunks) and linked to messages/tickets
+# with their rank and score, instead of a full JSON copy per row.
+KB_CHUNK_INSERT_SQL = """
+INSERT OR IGNORE INTO kb_chunks(chunk_id, source_id, title, snippet)
+VALUES(?,?,?,?)
+"""
+
+CITATION_TABLES = {"message": ("message_citations", "message_id"), "ticket": ("ticket_citations", "ticket_id")}
+
+CITATION_LINK_SQL = {
+    kind: f"INSERT OR REPLACE INTO {table}({owner}, rank, chunk_id, score) VALUES(?,?,?,?)"
+    for kind, (table, owner) in CITATION_TABLES.items()
+}
+
+_SCORE_PREFIX = re.compile(r"^\[(-?\d+(?:\.\d+)?)\] ")
+
+
+def chunk_id(source_id: str, title: str, snippet: str) -> str:
+    """Content address of a cited chunk: the same KB text shares one row across index rebuilds."""
+    return hashlib.sha1(f"{source_id}\0{title}\0{snippet}".encode("utf-8")).hexdigest()[:16]
+
+
+def citation_rows(
+    owner_id: str, citations: Iterable[dict[str, Any]]
+) -> tuple[list[tuple[str, str, str, str]], list[tuple[str, int, str, float | None]]]:
+    """Split ``Citation`` dicts into ``kb_chunks`` rows and link rows for ``owner_id``.
+
+    The snippet's per-hit ``"[0.42] "`` prefix is not part of the chunk; it is
+    rebuilt from the link's score (``score``, or the prefix for older dicts).
+    """
+    chunks, links = [], []
+    for rank, c in enumerate(citations):
+        snippet = c["snippet"]
+        score = c.get("score")
+        m = _SCORE_PREFIX.match(snippet)
+        if m:
+            snippet = snippet[m.end() :]
+            if score is None:
+                score = float(m.group(1))
+        cid = chunk_id(c["source_id"], c["title"], snippet)
+        chunks.append((cid, c["source_id"], c["title"], snippet))
+        links.append((owner_id, rank, cid, score))
+    return chunks, links
+
+
+def write_citations(conn: sqlite3.Connection, kind: str, owner_id: str, citations: Iterable[dict[str, Any]]) -> None:
+    chunks, links = citation_rows(owner_id, citations)
+    if links:
+        conn.executemany(KB_CHUNK_INSERT_SQL, chunks)
+        conn.executemany(CITATION_LINK_SQL[kind], links)
+
+
+def citations_for(kind: str, owner_ids: list[str], *, path: str | None = None) -> dict[str, list[dict[str, Any]]]:
+    """Re-hydrate the ``Citation`` dicts of messages (``kind="message"``) or tickets, by owner id."""
+    table, owner = CITATION_TABLES[kind]
+    out: dict[str, list[dict[str, Any]]] = {}
+    if not owner_ids:
+        return out
+    with connection(path) as conn:
+        rows = conn.execute(
+            f"""
+            SELECT l.{owner} AS owner_id, l.score, c.source_id, c.title, c.snippet
+            FROM {table} l
+            JOIN kb_chunks c ON c.chunk_id = l.chunk_id
+            WHERE l.{owner} IN ({",".join("?" * len(owner_ids))})
+            ORDER BY l.{owner}, l.rank
             """,
-            (user_id, org_id, first_name, last_name, email, role, dept_id),
+            owner_ids,
         )
-        conn.commit()
-    finally:
-        conn.close()
+        for r in rows:
+            snippet = r["snippet"] if r["score"] is None else f"[{r['score']:.2f}] {r['snippet']}"
+            out.setdefault(r["owner_id"], []).append(
+                {"source_id": r["source_id"], "title": r["title"], "snippet": snippet, "score": r["score"]}
+            )
+    return out
 
 
 def insert_message(
@@ -84,21 +188,42 @@ def insert_message(
     role: str,
     content: str,
     citations: list[dict[str, Any]] | None = None,
+    message_id: str | None = None,
 ) -> str:
-    message_id = str(uuid.uuid4())
-    conn = connect()
-    try:
+    message_id = message_id or str(uuid.uuid4())
+    with connection(session_db_path(session_id)) as conn:
         conn.execute(
             """
-            INSERT INTO messages(message_id, session_id, role, content, citations_json)
-            VALUES(?,?,?,?,?)
+            INSERT INTO messages(message_id, session_id, role, content)
+            VALUES(?,?,?,?)
             """,
-            (message_id, session_id, role, content, json.dumps(citations or [])),
+            (message_id, session_id, role, content),
         )
-        conn.commit()
+        write_citations(conn, "message", message_id, citations or [])
         return message_id
-    finally:
-        conn.close()
+
+
+def list_messages(session_id: str) -> list[dict[str, Any]]:
+    """A session's transcript, oldest first, with citations re-hydrated."""
+    path = session_db_path(session_id)
+    with connection(path) as conn:
+        rows = [
+            dict(r)
+            for r in conn.execute(
+                """
+                SELECT message_id, role, content, citations_json, created_at
+                FROM messages
+                WHERE session_id=?
+                ORDER BY created_at, rowid
+                """,
+                (session_id,),
+            )
+        ]
+    cites = citations_for("message", [r["message_id"] for r in rows], path=path)
+    for r in rows:
+        legacy = r.pop("citations_json")  # rows written before citations were normalized
+        r["citations"] = cites.get(r["message_id"]) or json.loads(legacy)
+    return rows
 
 
 def insert_ticket(
@@ -115,18 +240,19 @@ def insert_ticket(
     diagnostics: dict[str, Any] | None = None,
     steps_attempted: list[str] | None = None,
     citations: list[dict[str, Any]] | None = None,
+    ticket_id: str | None = None,
 ) -> str:
-    ticket_id = str(uuid.uuid4())
-    conn = connect()
-    try:
+    ticket_id = ticket_id or str(uuid.uuid4())
+    # A session's tickets live with the session (its shard, if sessions are sharded).
+    with connection(session_db_path(session_id) if session_id else None) as conn:
         conn.execute(
             """
             INSERT INTO tickets(
               ticket_id, org_id, user_id, session_id, summary, category, impact, urgency,
               status, escalation_reason, rendered_text,
-              diagnostics_json, steps_attempted_json, citations_json
+              diagnostics_json, steps_attempted_json
             )
-            VALUES(?,?,?,?,?,?,?,?, 'created', ?, ?, ?, ?, ?)
+            VALUES(?,?,?,?,?,?,?,?, 'created', ?, ?, ?, ?)
             """,
             (
                 ticket_id,
@@ -141,46 +267,230 @@ def insert_ticket(
                 rendered_text,
                 json.dumps(diagnostics or {}),
                 json.dumps(steps_attempted or []),
-                json.dumps(citations or []),
             ),
         )
-        conn.commit()
+        write_citations(conn, "ticket", ticket_id, citations or [])
         return ticket_id
-    finally:
-        conn.close()
+
+
+SESSION_LIST_COLUMNS = "session_id, user_id, turns, category, status, created_at, updated_at"
+TICKET_LIST_COLUMNS = (
+    "ticket_id, user_id, session_id, summary, category, impact, urgency, status, created_at, closed_at"
+)
+
+
+def _gather(
+    paths: list[str],
+    sql: str,
+    params: tuple[Any, ...],
+    sort_keys: tuple[str, ...],
+    limit: int,
+    *,
+    reverse: bool = True,
+) -> list[dict[str, Any]]:
+    """Run ``sql`` (ordered by ``sort_keys``, DESC unless ``reverse=False``, LIMITed) on each database
+    and merge the top ``limit``."""
+    per_db = []
+    for path in paths:
+        with connection(path) as conn:
+            per_db.append([dict(r) for r in conn.execute(sql, params)])
+    if len(per_db) == 1:
+        return per_db[0]
+    merged = heapq.merge(*per_db, key=lambda r: tuple(r[k] for k in sort_keys), reverse=reverse)
+    return list(itertools.islice(merged, limit))
+
+
+def ticket_db_paths() -> list[str]:
+    """Every database that can hold tickets in this context."""
+    paths = session_db_paths()
+    if base_path() not in paths:
+        paths.append(base_path())  # tickets raised outside a session
+    return paths
+
+
+def page_sessions(
+    org_id: str,
+    *,
+    status: str | None = "open",
+    limit: int = 50,
+    after: tuple[str, str] | None = None,
+    paths: list[str] | None = None,
+) -> list[dict[str, Any]]:
+    """One page of sessions, newest ``updated_at`` first.
+
+    Keyset pagination: ``after`` is the ``(updated_at, session_id)`` of the
+    last row of the previous page, so every page is an index seek however
+    deep it is (``idx_sessions_org_status_updated``).
+    """
+    where, params = ["org_id=?"], [org_id]
+    if status is not None:
+        where.append("status=?")
+        params.append(status)
+    if after is not None:
+        where.append("(updated_at, session_id) < (?, ?)")
+        params.extend(after)
+    sql = f"""
+        SELECT {SESSION_LIST_COLUMNS}
+        FROM sessions
+        WHERE {" AND ".join(where)}
+        ORDER BY updated_at DESC, session_id DESC
+        LIMIT ?
+        """
+    return _gather(paths or session_db_paths(), sql, (*params, int(limit)), ("updated_at", "session_id"), int(limit))
+
+
+def page_tickets(
+    org_id: str,
+    *,
+    status: str | None = None,
+    since: str | None = None,
+    until: str | None = None,
+    limit: int = 50,
+    after: tuple[str, str] | None = None,
+    paths: list[str] | None = None,
+) -> list[dict[str, Any]]:
+    """One page of tickets, newest ``created_at`` first; ``after`` is the last ``(created_at, ticket_id)``.
+
+    ``since``/``until`` bound ``created_at`` (``YYYY-MM-DD[ HH:MM:SS]``, until exclusive).
+    """
+    where, params = ["org_id=?"], [org_id]
+    if status is not None:
+        where.append("status=?")
+        params.append(status)
+    if since is not None:
+        where.append("created_at >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("created_at < ?")
+        params.append(until)
+    if after is not None:
+        where.append("(created_at, ticket_id) < (?, ?)")
+        params.extend(after)
+    sql = f"""
+        SELECT {TICKET_LIST_COLUMNS}
+        FROM tickets
+        WHERE {" AND ".join(where)}
+        ORDER BY created_at DESC, ticket_id DESC
+        LIMIT ?
+        """
+    return _gather(paths or ticket_db_paths(), sql, (*params, int(limit)), ("created_at", "ticket_id"), int(limit))
+
+
+def iter_sessions(org_id: str, *, batch: int = 500, **filters: Any) -> Iterator[dict[str, Any]]:
+    """Every matching session, fetched page by page (constant memory)."""
+    after = None
+    while True:
+        page = page_sessions(org_id, limit=batch, after=after, **filters)
+        yield from page
+        if len(page) < batch:
+            return
+        after = (page[-1]["updated_at"], page[-1]["session_id"])
+
+
+def iter_tickets(org_id: str, *, batch: int = 500, **filters: Any) -> Iterator[dict[str, Any]]:
+    """Every matching ticket, fetched page by page (constant memory)."""
+    after = None
+    while True:
+        page = page_tickets(org_id, limit=batch, after=after, **filters)
+        yield from page
+        if len(page) < batch:
+            return
+        after = (page[-1]["created_at"], page[-1]["ticket_id"])
 
 
 def list_open_sessions(org_id: str, limit: int = 50) -> list[dict[str, Any]]:
-    conn = connect()
-    try:
-        cur = conn.execute(
-            """
-            SELECT session_id, user_id, turns, category, status, created_at, updated_at
-            FROM sessions
-            WHERE org_id=? AND status='open'
-            ORDER BY updated_at DESC
-            LIMIT ?
-            """,
-            (org_id, int(limit)),
-        )
-        return [dict(r) for r in cur.fetchall()]
-    finally:
-        conn.close()
+    return page_sessions(org_id, status="open", limit=limit)
 
 
 def list_tickets(org_id: str, status: str, limit: int = 50) -> list[dict[str, Any]]:
-    conn = connect()
+    return page_tickets(org_id, status=status, limit=limit)
+
+
+SEARCH_SQL = {
+    # bm25() is lower-is-better; a summary hit counts twice a hit in the rendered ticket body.
+    # {order} is the relevance or the recency order, see ``search``.
+    "tickets": """
+        SELECT t.ticket_id, t.session_id, t.user_id, t.category, t.status, t.created_at, t.summary,
+               snippet(tickets_fts, -1, '[', ']', '…', 16) AS snippet,
+               bm25(tickets_fts, 2.0, 1.0) AS score
+        FROM tickets_fts
+        JOIN tickets t ON t.rowid = tickets_fts.rowid
+        WHERE tickets_fts MATCH ? AND t.org_id=? {filters}
+        ORDER BY {order}
+        LIMIT ?
+        """,
+    "messages": """
+        SELECT m.message_id, m.session_id, s.user_id, s.category, m.role, m.created_at,
+               snippet(messages_fts, 0, '[', ']', '…', 16) AS snippet,
+               bm25(messages_fts) AS score
+        FROM messages_fts
+        JOIN messages m ON m.rowid = messages_fts.rowid
+        JOIN sessions s ON s.session_id = m.session_id
+        WHERE messages_fts MATCH ? AND s.org_id=? {filters}
+        ORDER BY {order}
+        LIMIT ?
+        """,
+}
+_SEARCH_ALIAS = {"tickets": "t", "messages": "m"}
+
+
+def fts_query(text: str) -> str:
+    """Quote each whitespace-separated term, so user input is matched literally (all terms, any order)."""
+    terms = ['"' + t.replace('"', '""') + '"' for t in text.split()]
+    if not terms:
+        raise ValueError("empty search query")
+    return " ".join(terms)
+
+
+def search_order(paths: list[str]) -> str:
+    """How ``search`` over ``paths`` ranks: ``"relevance"`` (one database) or ``"recent"``."""
+    return "relevance" if len(paths) == 1 else "recent"
+
+
+def search(
+    org_id: str,
+    query: str,
+    *,
+    scope: str = "tickets",
+    category: str | None = None,
+    since: str | None = None,
+    until: str | None = None,
+    limit: int = 20,
+    raw: bool = False,
+    paths: list[str] | None = None,
+) -> list[dict[str, Any]]:
+    """Full-text search over ticket summaries/bodies (``scope="tickets"``) or transcripts (``"messages"``).
+
+    Each row has a ``snippet`` (hits in ``[...]``). ``category`` is the ticket's or the session's;
+    ``since``/``until`` bound ``created_at`` (until exclusive). ``raw=True`` passes ``query`` through
+    as FTS5 syntax (``"error 809" OR vpn*``). Raises ValueError for a bad query.
+
+    Over one database the best match comes first. bm25() depends on each database's own term
+    statistics, so scores from different shards don't compare; over several databases (session
+    sharding) the matches are newest ``created_at`` first instead (see ``search_order``).
+    """
+    if scope not in SEARCH_SQL:
+        raise ValueError(f"unknown search scope {scope!r}")
+    a = _SEARCH_ALIAS[scope]
+    where, params = [], []
+    if category is not None:
+        where.append(f"AND {'t' if scope == 'tickets' else 's'}.category=?")
+        params.append(category)
+    if since is not None:
+        where.append(f"AND {a}.created_at >= ?")
+        params.append(since)
+    if until is not None:
+        where.append(f"AND {a}.created_at < ?")
+        params.append(until)
+    match = query if raw else fts_query(query)
+    if paths is None:
+        paths = ticket_db_paths() if scope == "tickets" else session_db_paths()
+    if search_order(paths) == "relevance":
+        order, sort_keys, reverse = "score", ("score",), False
+    else:
+        order, sort_keys, reverse = f"{a}.created_at DESC, score", ("created_at",), True
+    sql = SEARCH_SQL[scope].format(filters=" ".join(where), order=order)
     try:
-        cur = conn.execute(
-            """
-            SELECT ticket_id, user_id, session_id, summary, category, impact, urgency, status, created_at, closed_at
-            FROM tickets
-            WHERE org_id=? AND status=?
-            ORDER BY created_at DESC
-            LIMIT ?
-            """,
-            (org_id, status, int(limit)),
-        )
-        return [dict(r) for r in cur.fetchall()]
-    finally:
-        conn.close()
+        return _gather(paths, sql, (match, org_id, *params, int(limit)), sort_keys, int(limit), reverse=reverse)
+    except sqlite3.OperationalError as e:
+        raise ValueError(f"bad search query: {e}") from e
@@ -2,13 +2,19 @@ from __future__ import annotations
 
 import json
 import uuid
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Any
 
-from app.core.db import connect
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.core.db import connection, session_db_path
 
 
-@dataclass
+class StaleSessionError(RuntimeError):
+    """The session row changed (another worker saved it) since this state was loaded."""
+
+
+@dataclass(slots=True)
 class SessionState:
     session_id: str
     org_id: str
@@ -18,9 +24,67 @@ class SessionState:
     status: str
     collected: dict[str, Any]
     steps_attempted: list[str]
+    version: int = 0  # sessions.version this state was loaded/saved at; 0 = never saved
+    # Column values as last loaded/saved, for dirty checking. Replaced, never mutated.
+    _saved: dict[str, Any] | None = field(default=None, repr=False, compare=False)
+
+    def copy(self) -> SessionState:
+        return SessionState(
+            session_id=self.session_id,
+            org_id=self.org_id,
+            user_id=self.user_id,
+            turns=self.turns,
+            category=self.category,
+            status=self.status,
+            collected=dict(self.collected),
+            steps_attempted=list(self.steps_attempted),
+            version=self.version,
+            _saved=self._saved,
+        )
+
+    def _mark_clean(self) -> None:
+        self._saved = {
+            "org_id": self.org_id,
+            "user_id": self.user_id,
+            "turns": self.turns,
+            "category": self.category,
+            "status": self.status,
+            "collected": dict(self.collected),
+            "steps_attempted": list(self.steps_attempted),
+        }
+
+    def dirty_columns(self) -> dict[str, Any]:
+        """Columns whose value changed since the last load/save (JSON only serialized if changed)."""
+        saved = self._saved or {}
+        out: dict[str, Any] = {}
+        for name in ("org_id", "user_id", "turns", "category", "status"):
+            value = getattr(self, name)
+            if name not in saved or saved[name] != value:
+                out[name] = value
+        if saved.get("collected") != self.collected:
+            out["collected_json"] = json.dumps(self.collected)
+        if saved.get("steps_attempted") != self.steps_attempted:
+            out["steps_attempted_json"] = json.dumps(self.steps_attempted)
+        return out
+
+
+# (database path, session_id) -> last loaded/saved state. Callers always get a copy,
+# so two turns of one session in flight on this worker never share (and mutate) one object.
+session_cache: TTLCache[tuple[str, str], SessionState] = TTLCache(
+    settings.session_cache_size, settings.session_cache_ttl_s
+)
+
+
+def _cache_key(session_id: str) -> tuple[str, str]:
+    return session_db_path(session_id), session_id
 
 
-def new_session(*, org_id: str, user_id: str) -> SessionState:
+def evict_session(session_id: str) -> None:
+    session_cache.pop(_cache_key(session_id))
+
+
+def new_session(*, org_id: str, user_id: str, save: bool = True) -> SessionState:
+    """Create a session; with ``save=False`` the caller persists it (e.g. via a UnitOfWork)."""
     sid = str(uuid.uuid4())
     state = SessionState(
         session_id=sid,
@@ -32,16 +96,33 @@ def new_session(*, org_id: str, user_id: str) -> SessionState:
         collected={},
         steps_attempted=[],
     )
-    save_session(state)
+    if save:
+        save_session(state)
     return state
 
 
 def load_session(session_id: str) -> SessionState:
-    conn = connect()
-    try:
+    """Return the session, from the cache when it is still current.
+
+    Another worker may have saved the session since it was cached, so a hit
+    is confirmed with a primary-key lookup of ``version`` (no JSON decoding)
+    unless ``session_cache_validate`` is off.
+    """
+    key = _cache_key(session_id)
+    cached = session_cache.get(key)
+    if cached is not None:
+        if not settings.session_cache_validate:
+            return cached.copy()
+        with connection(key[0]) as conn:
+            row = conn.execute("SELECT version FROM sessions WHERE session_id=?", (session_id,)).fetchone()
+        if row is not None and int(row["version"]) == cached.version:
+            return cached.copy()
+        session_cache.pop(key)
+
+    with connection(key[0]) as conn:
         cur = conn.execute(
             """
-            SELECT session_id, org_id, user_id, turns, category, status, collected_json, steps_attempted_json
+            SELECT session_id, org_id, user_id, turns, category, status, collected_json, steps_attempted_json, version
             FROM sessions
             WHERE session_id=?
             """,
@@ -51,7 +132,7 @@ def load_session(session_id: str) -> SessionState:
         if not row:
             raise KeyError(session_id)
 
-        return SessionState(
+        state = SessionState(
             session_id=row["session_id"],
             org_id=row["org_id"],
             user_id=row["user_id"],
@@ -60,41 +141,58 @@ def load_session(session_id: str) -> SessionState:
             status=row["status"],
             collected=json.loads(row["collected_json"]),
             steps_attempted=json.loads(row["steps_attempted_json"]),
+            version=int(row["version"]),
         )
-    finally:
-        conn.close()
+    state._mark_clean()
+    session_cache.put(key, state.copy())
+    return state
 
 
 def save_session(state: SessionState) -> None:
-    conn = connect()
-    try:
-        conn.execute(
-            """
-            INSERT INTO sessions(
-              session_id, org_id, user_id, turns, category, status, collected_json, steps_attempted_json, updated_at
+    """Persist ``state`` (write-through to the cache).
+
+    A saved session is updated column-wise with an optimistic version check:
+    only dirty columns are written, and ``StaleSessionError`` is raised if
+    another writer bumped ``version`` since ``state`` was loaded.
+    """
+    key = _cache_key(state.session_id)
+    with connection(key[0]) as conn:
+        if state.version == 0:
+            conn.execute(
+                """
+                INSERT INTO sessions(
+                  session_id, org_id, user_id, turns, category, status, collected_json, steps_attempted_json,
+                  version, updated_at
+                )
+                VALUES(?,?,?,?,?,?,?,?, 1, datetime('now'))
+                """,
+                (
+                    state.session_id,
+                    state.org_id,
+                    state.user_id,
+                    int(state.turns),
+                    state.category,
+                    state.status,
+                    json.dumps(state.collected),
+                    json.dumps(state.steps_attempted),
+                ),
             )
-            VALUES(?,?,?,?,?,?,?,?, datetime('now'))
-            ON CONFLICT(session_id) DO UPDATE SET
-              org_id=excluded.org_id,
-              user_id=excluded.user_id,
-              turns=excluded.turns,
-              category=excluded.category,
-              status=excluded.status,
-              collected_json=excluded.collected_json,
-              steps_attempted_json=excluded.steps_attempted_json,
-              updated_at=datetime('now')
-            """,
-            (
-                state.session_id,
-                state.org_id,
-                state.user_id,
-                int(state.turns),
-                state.category,
-                state.status,
-                json.dumps(state.collected),
-                json.dumps(state.steps_attempted),
-            ),
-        )
-        conn.commit()
-    finally:
-        conn.close()
\ No newline at end of file
+        else:
+            changes = state.dirty_columns()
+            if not changes:
+                return
+            assignments = ", ".join(f"{col}=?" for col in changes)
+            cur = conn.execute(
+                f"""
+                UPDATE sessions
+                SET {assignments}, version=version+1, updated_at=datetime('now')
+                WHERE session_id=? AND version=?
+                """,
+                (*changes.values(), state.session_id, state.version),
+            )
+            if cur.rowcount != 1:
+                evict_session(state.session_id)
+                raise StaleSessionError(state.session_id)
+    state.version += 1
+    state._mark_clean()
+    session_cache.put(key, state.copy())
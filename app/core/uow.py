@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import uuid
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from functools import partial
+from typing import Any, AsyncIterator, Callable, ContextManager, Iterator
+
+from app.core import repository
+from app.core.config import settings
+from app.core.db import connection, db_executor, session_db_path, use_db
+from app.core.message_log import message_log
+from app.core.session import SessionState, evict_session, save_session
+
+
+class UnitOfWork:
+    """Collects the writes of one /chat turn and applies them in a single transaction.
+
+    Writes are queued, not executed, so nothing touches the database while the
+    turn is still running (in particular across the awaited LLM call, where
+    other requests share the event-loop thread and its pooled connection).
+    ``commit()`` replays the queue inside one ``BEGIN IMMEDIATE`` transaction
+    on the pooled connection: one commit/fsync per turn, and the ticket and
+    session row land together or not at all. Transcript messages join that
+    transaction in ``sync`` message-log mode; in ``write_behind`` mode they
+    are handed to ``message_log`` once the transaction has committed.
+
+    Reads (``load_session`` etc.) go straight to the database; the turn's own
+    pending state is already in memory.
+
+    ``bind(session_id)`` pins the unit to the session's database, so with
+    sharded sessions the org/user upserts land in the same shard file as the
+    session rows that reference them and the turn is still one transaction.
+    """
+
+    def __init__(self) -> None:
+        self.db: str | None = None
+        self._ops: list[Callable[[], Any]] = []
+        self._sessions: set[str] = set()
+        self._messages: list[dict[str, Any]] = []  # write-behind mode: handed to message_log after commit
+        self._identities: list[Callable[[], None]] = []  # identity-cache entries to add after commit
+
+    def bind(self, session_id: str) -> None:
+        self.db = session_db_path(session_id)
+
+    def _scope(self) -> ContextManager[Any]:
+        return use_db(self.db) if self.db else nullcontext()
+
+    def add(self, fn: Callable[..., Any], /, *args: Any, **kwargs: Any) -> None:
+        self._ops.append(partial(fn, *args, **kwargs))
+
+    def ensure_org(self, org_id: str, name: str | None = None) -> None:
+        """Queue the org upsert unless the org is already known to exist."""
+        with self._scope():
+            if repository.org_known(org_id):
+                return
+        self.add(repository.ensure_org, org_id, name=name)
+        self._identities.append(partial(repository.remember_org, org_id))
+
+    def ensure_user(self, *, org_id: str, user_id: str, **profile: Any) -> None:
+        """Queue the user upsert unless the user is known and no profile fields are given."""
+        with self._scope():
+            if not profile and repository.user_known(org_id, user_id):
+                return
+        self.add(repository.ensure_user, org_id=org_id, user_id=user_id, **profile)
+        self._identities.append(partial(repository.remember_user, org_id, user_id))
+
+    def insert_message(self, **kwargs: Any) -> str:
+        message_id = str(uuid.uuid4())
+        if settings.message_log_mode == "sync":
+            self.add(repository.insert_message, message_id=message_id, **kwargs)
+        else:
+            self._messages.append({"message_id": message_id, **kwargs})
+        return message_id
+
+    def insert_ticket(self, **kwargs: Any) -> str:
+        ticket_id = str(uuid.uuid4())
+        self.add(repository.insert_ticket, ticket_id=ticket_id, **kwargs)
+        return ticket_id
+
+    def save_session(self, state: SessionState) -> None:
+        """Queue an upsert of ``state`` as it is at commit time.
+
+        Only the first call per session queues a write, so queue a new
+        session right after creating it and the row exists before any message
+        that references it.
+        """
+        if state.session_id in self._sessions:
+            return
+        self._sessions.add(state.session_id)
+        self.add(save_session, state)
+
+    @property
+    def pending(self) -> int:
+        return len(self._ops) + len(self._messages)
+
+    def commit(self) -> None:
+        ops, self._ops = self._ops, []
+        messages, self._messages = self._messages, []
+        sessions, self._sessions = self._sessions, set()
+        identities, self._identities = self._identities, []
+        with self._scope():
+            if ops:
+                try:
+                    with connection() as conn:
+                        if not conn.in_transaction:
+                            conn.execute("BEGIN IMMEDIATE")
+                        for op in ops:
+                            op()
+                except BaseException:
+                    # save_session writes through to the session cache before the
+                    # transaction commits; don't let a rolled-back state linger there.
+                    for session_id in sessions:
+                        evict_session(session_id)
+                    raise
+            for remember in identities:
+                remember()
+        # After the commit, so the session rows the messages reference exist.
+        message_log.append_many(messages)
+
+    async def commit_async(self) -> None:
+        """``commit()`` on the DB writer thread, for async handlers."""
+        if self.pending:
+            await db_executor.write(self.commit)
+
+    def rollback(self) -> None:
+        self._ops.clear()
+        self._identities.clear()
+        self._messages.clear()
+        self._sessions.clear()
+
+
+@contextmanager
+def unit_of_work() -> Iterator[UnitOfWork]:
+    """Commit the queued writes if the block succeeds; drop them if it raises."""
+    uow = UnitOfWork()
+    try:
+        yield uow
+    except BaseException:
+        uow.rollback()
+        raise
+    uow.commit()
+
+
+@asynccontextmanager
+async def unit_of_work_async() -> AsyncIterator[UnitOfWork]:
+    """Async ``unit_of_work``: the commit runs on the DB writer thread."""
+    uow = UnitOfWork()
+    try:
+        yield uow
+    except BaseException:
+        uow.rollback()
+        raise
+    await uow.commit_async()
@@ -0,0 +1,231 @@
+"""Answer cache in front of the LLM (opt-in: ``llm_cache_size`` > 0).
+
+During an outage many users ask the same question: same category, same
+intake answers, and retrieval cites the same KB articles. ``answer_key``
+fingerprints the org, the category, the prompt exactly as sent (the user's
+message, every collected field and the KB excerpts), the cited
+``source_id``s, the RAG index version and the model, and ``AnswerCache``
+keeps the guardrail-approved answer for it, in memory (LRU + TTL) and
+optionally in a SQLite file (``llm_cache_persist``) so a restart doesn't
+start cold.
+
+Because the whole prompt is in the key, a hit only answers a turn that asks
+the model exactly what an earlier one asked, and answers are never shared
+across orgs. A new index version changes every key; ``purge`` drops answers
+by category or cited source when an article is edited without a reindex.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Iterable
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.core.db import connection, db_executor
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_answers (
+  key TEXT PRIMARY KEY,
+  content TEXT NOT NULL,
+  category TEXT NOT NULL,
+  source_ids_json TEXT NOT NULL,
+  index_version TEXT NOT NULL,
+  model TEXT NOT NULL,
+  created_at REAL NOT NULL,
+  expires_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_llm_answers_expires ON llm_answers(expires_at);
+"""
+
+_SWEEP_EVERY = 256  # persisted puts between deletes of expired rows
+
+
+@dataclass(frozen=True, slots=True)
+class CachedAnswer:
+    content: str
+    category: str
+    source_ids: tuple[str, ...]
+    index_version: str
+    model: str
+
+
+def model_name(llm: Any) -> str:
+    """Provider and model, so switching either never serves the other's answers."""
+    return f"{type(llm).__name__}:{getattr(llm, 'model', '')}"
+
+
+def answer_key(
+    *,
+    org_id: str,
+    category: str,
+    messages: list[dict[str, Any]],
+    source_ids: Iterable[str],
+    index_version: str,
+    model: str,
+) -> str:
+    """Fingerprint of everything the answer depends on (sha256 hex).
+
+    ``messages`` is the prompt as sent, so the key covers every input it was
+    built from.
+    """
+    payload = [org_id, category, messages, list(source_ids), index_version, model]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    def __init__(
+        self,
+        max_size: int | None = None,
+        ttl_s: float | None = None,
+        *,
+        persist: bool | None = None,
+        path: str | None = None,
+    ):
+        self.memory: TTLCache[str, CachedAnswer] = TTLCache(
+            settings.llm_cache_size if max_size is None else max_size,
+            settings.llm_cache_ttl_s if ttl_s is None else ttl_s,
+        )
+        self.persist = settings.llm_cache_persist if persist is None else persist
+        self.path = path or settings.llm_cache_path
+        self._lock = threading.Lock()
+        self._schema_ready = False
+        self._puts = 0
+        self.stores = 0
+        self.disk_hits = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.memory.max_size > 0
+
+    def _ready(self, conn: sqlite3.Connection) -> sqlite3.Connection:
+        if not self._schema_ready:
+            conn.executescript(SCHEMA)
+            self._schema_ready = True
+        return conn
+
+    def get(self, key: str) -> CachedAnswer | None:
+        if not self.enabled:
+            return None
+        hit = self.memory.get(key)
+        if hit is not None or not self.persist:
+            return hit
+        return self._load(key)
+
+    def _load(self, key: str) -> CachedAnswer | None:
+        with connection(self.path) as conn:
+            row = self._ready(conn).execute(
+                """
+                SELECT content, category, source_ids_json, index_version, model, expires_at
+                FROM llm_answers WHERE key=? AND expires_at > ?
+                """,
+                (key, time.time()),
+            ).fetchone()
+        if row is None:
+            return None
+        hit = CachedAnswer(
+            content=row["content"],
+            category=row["category"],
+            source_ids=tuple(json.loads(row["source_ids_json"])),
+            index_version=row["index_version"],
+            model=row["model"],
+        )
+        self.memory.put(key, hit)
+        with self._lock:
+            self.disk_hits += 1
+        return hit
+
+    def put(self, key: str, answer: CachedAnswer) -> None:
+        if not self.enabled:
+            return
+        self.memory.put(key, answer)
+        with self._lock:
+            self.stores += 1
+            self._puts += 1
+            sweep = self._puts % _SWEEP_EVERY == 0
+        if not self.persist:
+            return
+        now = time.time()
+        ttl = self.memory.ttl_s if self.memory.ttl_s > 0 else 10 * 365 * 86_400.0
+        with connection(self.path) as conn:
+            self._ready(conn).execute(
+                """
+                INSERT OR REPLACE INTO llm_answers(
+                  key, content, category, source_ids_json, index_version, model, created_at, expires_at
+                )
+                VALUES(?,?,?,?,?,?,?,?)
+                """,
+                (
+                    key,
+                    answer.content,
+                    answer.category,
+                    json.dumps(list(answer.source_ids)),
+                    answer.index_version,
+                    answer.model,
+                    now,
+                    now + ttl,
+                ),
+            )
+            if sweep:
+                conn.execute("DELETE FROM llm_answers WHERE expires_at <= ?", (now,))
+
+    async def aget(self, key: str) -> CachedAnswer | None:
+        """``get`` for async handlers: memory inline, the SQLite lookup on a DB reader thread."""
+        if not self.persist or not self.enabled:
+            return self.get(key)
+        hit = self.memory.get(key)
+        return hit if hit is not None else await db_executor.read(self._load, key)
+
+    async def aput(self, key: str, answer: CachedAnswer) -> None:
+        if self.persist and self.enabled:
+            await db_executor.write(self.put, key, answer)
+        else:
+            self.put(key, answer)
+
+    def purge(
+        self, *, category: str | None = None, source_id: str | None = None, index_version: str | None = None
+    ) -> int:
+        """Drop the answers matching every given filter (all answers without filters); returns how many."""
+
+        def match(_: str, a: CachedAnswer) -> bool:
+            return (
+                (category is None or a.category == category)
+                and (source_id is None or source_id in a.source_ids)
+                and (index_version is None or a.index_version == index_version)
+            )
+
+        purged = self.memory.discard_where(match)
+        if not self.persist:
+            return purged
+        where, params = ["1=1"], []
+        if category is not None:
+            where.append("category=?")
+            params.append(category)
+        if source_id is not None:
+            where.append("EXISTS (SELECT 1 FROM json_each(source_ids_json) WHERE value=?)")
+            params.append(source_id)
+        if index_version is not None:
+            where.append("index_version=?")
+            params.append(index_version)
+        with connection(self.path) as conn:
+            cur = self._ready(conn).execute(f"DELETE FROM llm_answers WHERE {' AND '.join(where)}", params)
+        # An answer usually sits in both tiers; report the larger count, not the sum.
+        return max(purged, cur.rowcount)
+
+    def clear(self) -> None:
+        self.purge()
+
+    def stats(self) -> dict[str, Any]:
+        out = {**self.memory.stats(), "stores": self.stores, "persist": self.persist}
+        if self.persist:
+            out["disk_hits"] = self.disk_hits
+            with connection(self.path) as conn:
+                out["persisted"] = self._ready(conn).execute("SELECT COUNT(*) FROM llm_answers").fetchone()[0]
+        return out
+
+
+answer_cache = AnswerCache()
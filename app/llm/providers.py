@@ -1,12 +1,19 @@
 from __future__ import annotations
 
+import asyncio
+import importlib.util
 import json
-from typing import Any
+import logging
+import re
+import time
+from typing import Any, AsyncIterator
 
 import httpx
 
 from app.core.config import settings
 
+logger = logging.getLogger(__name__)
+
 
 class LLMError(RuntimeError):
     pass
@@ -16,10 +23,39 @@ class BaseLLM:
     async def chat(self, messages: list[dict[str, Any]], *, response_format: dict[str, Any] | None = None) -> str:
         raise NotImplementedError
 
+    async def stream(
+        self, messages: list[dict[str, Any]], *, response_format: dict[str, Any] | None = None
+    ) -> AsyncIterator[str]:
+        """Yield the completion in pieces as it is generated (by default: all at once, from ``chat``)."""
+        yield await self.chat(messages, response_format=response_format)
+
+    async def aclose(self) -> None:
+        """Release network resources (API shutdown)."""
+
+    def stats(self) -> dict[str, Any]:
+        return {"provider": type(self).__name__}
+
 
 class MockLLM(BaseLLM):
     async def chat(self, messages: list[dict[str, Any]], *, response_format: dict[str, Any] | None = None) -> str:
         # For offline/dev runs. Produces something deterministic.
+        if settings.mock_llm_latency_s > 0:
+            await asyncio.sleep(settings.mock_llm_latency_s)
+        return self._reply(messages)
+
+    async def stream(
+        self, messages: list[dict[str, Any]], *, response_format: dict[str, Any] | None = None
+    ) -> AsyncIterator[str]:
+        # Word by word, spread over mock_llm_latency_s like a model generating tokens.
+        words = re.findall(r"\s*\S+\s*", self._reply(messages))
+        delay = settings.mock_llm_latency_s / max(len(words), 1)
+        for word in words:
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield word
+
+    @staticmethod
+    def _reply(messages: list[dict[str, Any]]) -> str:
         user_text = ""
         for m in reversed(messages):
             if m.get("role") == "user":
@@ -28,18 +64,68 @@ class MockLLM(BaseLLM):
         return f"(MOCK) I can help. Based on what you said: {user_text}\n\nIf I don't have enough documented steps, I'll escalate to a ticket."
 
 
+def build_http_client() -> httpx.AsyncClient:
+    """The pooled, keep-alive client shared by every call of a provider."""
+    http2 = settings.llm_http2
+    if http2 and importlib.util.find_spec("h2") is None:
+        logger.warning("TIER1_LLM_HTTP2 is set but the h2 package is missing; using HTTP/1.1")
+        http2 = False
+    return httpx.AsyncClient(
+        http2=http2,
+        timeout=httpx.Timeout(settings.llm_timeout_s, connect=settings.llm_connect_timeout_s),
+        limits=httpx.Limits(
+            max_connections=settings.llm_max_connections,
+            max_keepalive_connections=settings.llm_max_keepalive,
+            keepalive_expiry=settings.llm_keepalive_expiry_s,
+        ),
+    )
+
+
 class OpenAICompatibleLLM(BaseLLM):
-    def __init__(self, api_key: str, model: str, base_url: str | None = None):
+    """Chat completions over one long-lived ``httpx.AsyncClient``.
+
+    Connections stay open between calls (keep-alive), so only the first call
+    to the endpoint, and calls beyond the pooled connections, pay for the
+    TCP/TLS handshake. The client is created on first use. ``aclose()``
+    closes it at shutdown.
+    """
+
+    def __init__(self, api_key: str, model: str, base_url: str | None = None, *, client: httpx.AsyncClient | None = None):
         self.api_key = api_key
         self.model = model
         self.base_url = base_url or "https://api.openai.com/v1"
+        self._client = client
+        self._owns_client = client is None
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.connects = 0  # new TCP connections (handshakes) opened for our requests
+        self.total_s = 0.0
+        self.streams = 0
+        self.ttft_s = 0.0  # summed time to first token of streamed completions
 
-    async def chat(self, messages: list[dict[str, Any]], *, response_format: dict[str, Any] | None = None) -> str:
-        url = self.base_url.rstrip("/") + "/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = build_http_client()
+        return self._client
+
+    async def _trace(self, event: str, info: dict[str, Any]) -> None:
+        if event == "connection.connect_tcp.complete":
+            self.connects += 1
+
+    def _request_args(self, path: str, payload: dict[str, Any]) -> dict[str, Any]:
+        return {
+            "url": self.base_url.rstrip("/") + path,
+            "headers": {
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json",
+            },
+            "json": payload,
+            "extensions": {"trace": self._trace},
         }
+
+    def _payload(self, messages: list[dict[str, Any]], response_format: dict[str, Any] | None) -> dict[str, Any]:
         payload: dict[str, Any] = {
             "model": self.model,
             "messages": messages,
@@ -48,12 +134,26 @@ class OpenAICompatibleLLM(BaseLLM):
         # Some OpenAI-compatible endpoints support JSON schema via response_format; optional.
         if response_format is not None:
             payload["response_format"] = response_format
+        return payload
 
-        timeout = httpx.Timeout(settings.llm_timeout_s)
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            r = await client.post(url, headers=headers, json=payload)
+    async def _post(self, path: str, payload: dict[str, Any]) -> httpx.Response:
+        self.requests += 1
+        self.in_flight += 1
+        t0 = time.perf_counter()
+        try:
+            return await self.client.post(**self._request_args(path, payload))
+        except httpx.HTTPError as e:
+            self.errors += 1
+            raise LLMError(f"LLM call failed: {type(e).__name__}: {e}") from e
+        finally:
+            self.in_flight -= 1
+            self.total_s += time.perf_counter() - t0
+
+    async def chat(self, messages: list[dict[str, Any]], *, response_format: dict[str, Any] | None = None) -> str:
+        r = await self._post("/chat/completions", self._payload(messages, response_format))
 
         if r.status_code >= 400:
+            self.errors += 1
             raise LLMError(f"LLM call failed: {r.status_code} {r.text[:500]}")
 
         data = r.json()
@@ -62,8 +162,101 @@ class OpenAICompatibleLLM(BaseLLM):
         except Exception as e:
             raise LLMError(f"Unexpected LLM response format: {json.dumps(data)[:800]}") from e
 
+    async def stream(
+        self, messages: list[dict[str, Any]], *, response_format: dict[str, Any] | None = None
+    ) -> AsyncIterator[str]:
+        """Chat completion with ``stream: true``: yields the content delta of each server-sent event.
+
+        Closing the generator early (e.g. a guardrail tripped) closes the response, so the
+        endpoint stops generating.
+        """
+        payload = {**self._payload(messages, response_format), "stream": True}
+        self.requests += 1
+        self.in_flight += 1
+        t0 = time.perf_counter()
+        first = True
+        try:
+            async with self.client.stream("POST", **self._request_args("/chat/completions", payload)) as r:
+                if r.status_code >= 400:
+                    self.errors += 1
+                    body = (await r.aread()).decode("utf-8", "replace")
+                    raise LLMError(f"LLM call failed: {r.status_code} {body[:500]}")
+                async for line in r.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue  # blank separators, comments, event names
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        choices = json.loads(data).get("choices") or []
+                        delta = choices[0].get("delta", {}).get("content") if choices else None
+                    except (ValueError, AttributeError) as e:
+                        self.errors += 1
+                        raise LLMError(f"Unexpected LLM stream event: {data[:800]}") from e
+                    if delta:
+                        if first:
+                            first = False
+                            self.streams += 1
+                            self.ttft_s += time.perf_counter() - t0
+                        yield delta
+        except httpx.HTTPError as e:
+            self.errors += 1
+            raise LLMError(f"LLM call failed: {type(e).__name__}: {e}") from e
+        finally:
+            self.in_flight -= 1
+            self.total_s += time.perf_counter() - t0
+
+    async def aclose(self) -> None:
+        if self._client is not None and self._owns_client:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict[str, Any]:
+        out: dict[str, Any] = {
+            "provider": type(self).__name__,
+            "base_url": self.base_url,
+            "requests": self.requests,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "connects": self.connects,
+            "avg_s": round(self.total_s / self.requests, 4) if self.requests else None,
+            "streams": self.streams,
+            "avg_ttft_s": round(self.ttft_s / self.streams, 4) if self.streams else None,
+        }
+        # Connection pool state (httpcore internals; absent until the first request).
+        pool = getattr(getattr(self._client, "_transport", None), "_pool", None)
+        if pool is not None:
+            connections = list(pool.connections)
+            out["pool"] = {
+                "connections": len(connections),
+                "idle": sum(1 for c in connections if c.is_idle()),
+                "http2": sum(1 for c in connections if "HTTP/2" in c.info()),
+                "max_connections": settings.llm_max_connections,
+                "max_keepalive": settings.llm_max_keepalive,
+            }
+        return out
+
+
+_llm: BaseLLM | None = None
+
 
 def get_llm() -> BaseLLM:
+    """The process-wide provider, created on first use (normally at startup)."""
+    global _llm
+    if _llm is None:
+        _llm = _make_llm()
+    return _llm
+
+
+async def close_llm() -> None:
+    """Close the provider's connections (API shutdown). The next ``get_llm()`` creates a new one."""
+    global _llm
+    llm, _llm = _llm, None
+    if llm is not None:
+        await llm.aclose()
+
+
+def _make_llm() -> BaseLLM:
     if settings.llm_provider.lower() == "openai":
         if not settings.openai_api_key:
             raise LLMError("TIER1_OPENAI_API_KEY is required when TIER1_LLM_PROVIDER=openai")
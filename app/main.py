@@ -1,27 +1,62 @@
 from __future__ import annotations
 
+import json
+import logging
 import re
-from typing import Any
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator
 
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 
+from app.admin import router as admin_router
+from app.core import aio
 from app.core.config import settings
-from app.core.db import init_schema
-from app.core.repository import ensure_org, ensure_user, insert_message, insert_ticket
-from app.core.session import SessionState, load_session, new_session, save_session
+from app.core.db import close_pools, db_executor, init_schema, org_db_path, session_db_paths, use_org_db
+from app.core.maintenance import maintenance
+from app.core.message_log import message_log
+from app.core.session import SessionState, StaleSessionError, new_session
+from app.core.uow import UnitOfWork, unit_of_work_async
 from app.flows.engine import question_for, registry, next_missing_field
-from app.llm.providers import LLMError, get_llm
-from app.models.schemas import AnswerResponse, ChatRequest, ChatResponse, Ticket, TicketResponse
-from app.policies.guardrails import check_response, should_escalate
-from app.rag.index import load_index, retrieve
-
-app = FastAPI(title=settings.app_name)
+from app.llm.cache import CachedAnswer, answer_cache, answer_key, model_name
+from app.llm.providers import BaseLLM, LLMError, close_llm, get_llm
+from app.models.schemas import AnswerResponse, ChatRequest, ChatResponse, Citation, Ticket, TicketResponse
+from app.policies.guardrails import GuardrailResult, StreamGuard, check_response, should_escalate
+from app.rag.index import Retriever, get_index, retrieve, session_context
+
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    # Create/upgrade schema for this org site's SQLite database (per-org files are created on first use).
+    if settings.sqlite_routing != "per_org":
+        init_schema()
+        session_db_paths()  # create the shard files now, not on a chat turn's first touch
+    # Warm the resident RAG index so the first chat turn doesn't pay for it.
+    try:
+        get_index()
+    except FileNotFoundError as e:
+        logger.warning("%s", e)
+    # One provider (and HTTP connection pool) per worker, reused by every request.
+    try:
+        get_llm()
+    except LLMError as e:
+        logger.warning("%s", e)
+    maintenance.start()
+    try:
+        yield
+    finally:
+        maintenance.stop()
+        await close_llm()
+        message_log.close()  # flush queued transcript messages before the connections go away
+        close_pools()
 
 
-@app.on_event("startup")
-def _startup() -> None:
-    # Create/upgrade schema for this org site's SQLite database.
-    init_schema()
+app = FastAPI(title=settings.app_name, lifespan=lifespan)
+app.include_router(admin_router)
 
 
 def _extract_kv(message: str) -> dict[str, str]:
@@ -126,14 +161,192 @@ def create_session() -> dict[str, str]:
     return {"session_id": s.session_id}
 
 
+_ready_dbs: set[str] = set()  # org databases whose file and shard schemas exist
+
+
+def _prepare_org_dbs(org_id: str) -> None:
+    with use_org_db(org_id):  # per-org: creates the org's file
+        session_db_paths()  # and its shard files
+
+
+async def _ensure_org_db(org_id: str) -> None:
+    # Per-org deployments keep each org in its own SQLite file.
+    try:
+        path = org_db_path(org_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if path not in _ready_dbs:
+        # Schema creation is DDL on new files: on the DB writer thread, once per worker.
+        await db_executor.write(_prepare_org_dbs, org_id)
+        _ready_dbs.add(path)
+
+
 @app.post("/chat", response_model=ChatResponse)
 async def chat(req: ChatRequest):
-    # Ensure org/user exist (idempotent). In a per-org DB deployment, org_id is typically constant.
-    ensure_org(req.org_id, name=req.org_id)
-    ensure_user(org_id=req.org_id, user_id=req.user_id)
+    await _ensure_org_db(req.org_id)
+
+    # All writes of the turn commit together at the end, or not at all if it fails.
+    with use_org_db(req.org_id):
+        try:
+            async with unit_of_work_async() as uow:
+                return await _chat_turn(req, uow)
+        except StaleSessionError:
+            raise HTTPException(status_code=409, detail="Session was updated concurrently; please retry.")
+
+
+@app.post("/chat/stream")
+async def chat_stream(req: ChatRequest) -> StreamingResponse:
+    """``/chat`` as Server-Sent Events, so the answer shows up while it is being generated.
+
+    Events: ``session`` (``{"session_id"}``, pass it back to continue the session), ``token``
+    (``{"text"}``, one per generated piece), ``abort`` (``{"reason"}``: a guardrail
+    tripped; discard the tokens shown so far), and finally ``done`` with the same
+    body ``/chat`` returns, sent once the turn is committed. Failures after the
+    stream has started are sent as ``error`` (``{"status", "detail"}``).
+    """
+    await _ensure_org_db(req.org_id)
+    return StreamingResponse(
+        _chat_turn_events(req),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _chat_turn_events(req: ChatRequest) -> AsyncIterator[str]:
+    with use_org_db(req.org_id):
+        try:
+            async with unit_of_work_async() as uow:
+                state, turn = await _prepare_turn(req, uow)
+                yield _sse("session", {"session_id": state.session_id})
+                if isinstance(turn, _LlmTurn):
+                    llm = get_llm()
+                    key = _answer_key(turn, llm)
+                    cached = await answer_cache.aget(key) if key else None
+                    if cached is not None:
+                        # Already guardrail-checked when it was cached: send it whole.
+                        yield _sse("token", {"text": cached.content})
+                        response = _finish_turn(req, uow, turn, cached.content)
+                    else:
+                        guard = StreamGuard()
+                        parts: list[str] = []
+                        blocked = None
+                        stream = llm.stream(turn.messages)
+                        try:
+                            async for piece in stream:
+                                parts.append(piece)
+                                result = guard.feed(piece)
+                                if not result.ok:
+                                    blocked = result  # stop generating; the turn becomes a ticket
+                                    break
+                                yield _sse("token", {"text": piece})
+                        finally:
+                            await stream.aclose()
+                        if blocked is not None:
+                            yield _sse("abort", {"reason": blocked.reason})
+                        response = _finish_turn(req, uow, turn, "".join(parts), blocked=blocked)
+                        await _remember_answer(key, turn, llm, response)
+                else:
+                    response = turn
+            yield _sse("done", response.model_dump())
+        except StaleSessionError:
+            yield _sse("error", {"status": 409, "detail": "Session was updated concurrently; please retry."})
+        except LLMError as e:
+            yield _sse("error", {"status": 502, "detail": str(e)})
+        except HTTPException as e:
+            yield _sse("error", {"status": e.status_code, "detail": e.detail})
+        except Exception:
+            # The 200 and earlier events are already sent; end with an error event so the client stops waiting.
+            logger.exception("Chat stream failed for org %s", req.org_id)
+            yield _sse("error", {"status": 500, "detail": "Internal server error"})
+
+
+@dataclass
+class _LlmTurn:
+    """A turn that needs the LLM: the prompt, and what finishing the turn needs."""
+
+    state: SessionState
+    citations: list[Citation]
+    messages: list[dict[str, Any]]
+    index_version: str | None
+
+
+async def _chat_turn(req: ChatRequest, uow: UnitOfWork) -> ChatResponse:
+    _, turn = await _prepare_turn(req, uow)
+    if not isinstance(turn, _LlmTurn):
+        return turn
+    try:
+        llm = get_llm()
+        key = _answer_key(turn, llm)
+        cached = await answer_cache.aget(key) if key else None
+        if cached is not None:
+            return _finish_turn(req, uow, turn, cached.content)
+        content = await llm.chat(turn.messages)
+    except LLMError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    response = _finish_turn(req, uow, turn, content)
+    await _remember_answer(key, turn, llm, response)
+    return response
+
+
+def _answer_key(turn: _LlmTurn, llm: BaseLLM) -> str | None:
+    """Answer-cache key of the turn; None while the cache is off or the index is unversioned.
 
-    # Load or create session
-    state = load_session(req.session_id) if req.session_id else new_session(org_id=req.org_id, user_id=req.user_id)
+    The key hashes the whole prompt as sent, so every input the prompt is built from (the
+    message, every collected field, the KB excerpts) is covered and a hit only answers a
+    turn that asks the model exactly the same question.
+    """
+    if not answer_cache.enabled or not turn.index_version:
+        return None
+    return answer_key(
+        org_id=turn.state.org_id,
+        category=turn.state.category or "fallback",
+        messages=turn.messages,
+        source_ids=[c.source_id for c in turn.citations],
+        index_version=turn.index_version,
+        model=model_name(llm),
+    )
+
+
+async def _remember_answer(key: str | None, turn: _LlmTurn, llm: BaseLLM, response: ChatResponse) -> None:
+    # Only answers that passed the guardrails; a blocked one became a ticket.
+    if key is None or not isinstance(response, AnswerResponse):
+        return
+    await answer_cache.aput(
+        key,
+        CachedAnswer(
+            content=response.message,
+            category=turn.state.category or "fallback",
+            source_ids=tuple(c.source_id for c in turn.citations),
+            index_version=turn.index_version or "",
+            model=model_name(llm),
+        ),
+    )
+
+
+async def _prepare_turn(req: ChatRequest, uow: UnitOfWork) -> tuple[SessionState, ChatResponse | _LlmTurn]:
+    """Everything up to the LLM call: the session, and a response if the turn ends before it, else the prompt."""
+    # Load or create session; the turn's writes go to the session's database (shard).
+    if req.session_id:
+        try:
+            state = await aio.load_session(req.session_id)
+        except KeyError:
+            raise HTTPException(status_code=404, detail="Unknown session (it may have been archived); start a new one.")
+        if state.status != "open":
+            # Closed by the idle sweeper: don't silently reopen it.
+            raise HTTPException(status_code=409, detail=f"Session is {state.status}; start a new one.")
+    else:
+        state = new_session(org_id=req.org_id, user_id=req.user_id, save=False)
+    uow.bind(state.session_id)
+
+    # Ensure org/user exist (idempotent). In a per-org DB deployment, org_id is typically constant.
+    uow.ensure_org(req.org_id, name=req.org_id)
+    uow.ensure_user(org_id=req.org_id, user_id=req.user_id)
+    if not req.session_id:
+        uow.save_session(state)  # queued after its org/user and ahead of the messages that reference it
     state.turns += 1
 
     # Categorize once (sticky)
@@ -146,64 +359,42 @@ async def chat(req: ChatRequest):
     _merge_collected(state, req)
 
     # Persist user message (chat transcript)
-    insert_message(session_id=state.session_id, role='user', content=req.message)
+    uow.insert_message(session_id=state.session_id, role='user', content=req.message)
 
     # Gate: required fields
     missing = next_missing_field(flow, state.collected)
     if missing:
         q = question_for(flow, missing)
         # Persist assistant prompt/question
-        insert_message(session_id=state.session_id, role='assistant', content=q)
-        save_session(state)
-        return AnswerResponse(
+        uow.insert_message(session_id=state.session_id, role='assistant', content=q)
+        uow.save_session(state)
+        return state, AnswerResponse(
             message=q,
             citations=[],
             next_question=q,
             collected=state.collected,
         )
 
-    # Load RAG index
+    # Retrieve docs based on message + collected context, off the event loop
     try:
-        index = load_index()
+        index, citations, best_score = await run_in_threadpool(
+            _retrieve, state.session_id, dict(state.collected), req.message
+        )
     except FileNotFoundError as e:
         raise HTTPException(status_code=500, detail=str(e))
-
-    # Retrieve docs based on message + collected context
-    query = req.message + "\n" + "\n".join([f"{k}: {v}" for k, v in sorted(state.collected.items())])
-    citations, best_score = retrieve(index, query)
+    logger.debug("session=%s rag_index_version=%s", state.session_id, index.version)
 
     # Decide escalation
     esc, esc_reason = should_escalate(state.turns, best_score)
     if esc:
-        ticket = Ticket(
-            summary=state.collected.get("summary") or req.message.strip()[:120],
-            category=state.category or "unknown",
+        return state, _escalate(
+            req,
+            uow,
+            state,
+            citations,
+            reason=esc_reason or "Escalated",
             user={"org_id": req.org_id, "user_id": req.user_id, **{k: v for k, v in req.context.items() if k.startswith("user_")}},
-            device={k: v for k, v in req.context.items() if k.startswith("device_")},
-            diagnostics=state.collected,
-            steps_attempted=state.steps_attempted,
-            error_text=str(state.collected.get("error_message") or "") or None,
-            escalation_reason=esc_reason or "Escalated",
-            citations=citations,
-        )
-        rendered = _render_ticket(ticket)
-        insert_ticket(
-            org_id=req.org_id,
-            user_id=req.user_id,
-            session_id=state.session_id,
-            summary=ticket.summary,
-            category=ticket.category,
-            impact=ticket.impact,
-            urgency=ticket.urgency,
-            escalation_reason=ticket.escalation_reason,
-            rendered_text=rendered,
-            diagnostics=ticket.diagnostics,
-            steps_attempted=ticket.steps_attempted,
-            citations=[c.model_dump() for c in ticket.citations],
         )
-        insert_message(session_id=state.session_id, role='assistant', content=rendered)
-        save_session(state)
-        return TicketResponse(ticket=ticket, rendered=rendered)
 
     # Compose prompt grounded in citations
     system = (
@@ -221,48 +412,81 @@ async def chat(req: ChatRequest):
         f"KB excerpts (use these, cite by SOURCE #):\n{kb_block}\n\n"
         "Respond with: (1) a short diagnosis, (2) numbered steps, (3) what to report back."
     )
-
-    llm = get_llm()
-    try:
-        content = await llm.chat([
+    return state, _LlmTurn(
+        state=state,
+        citations=citations,
+        messages=[
             {"role": "system", "content": system},
             {"role": "user", "content": user},
-        ])
-    except LLMError as e:
-        raise HTTPException(status_code=502, detail=str(e))
+        ],
+        index_version=index.version,
+    )
+
 
-    gr = check_response(content)
+def _retrieve(session_id: str, collected: dict[str, Any], message: str) -> tuple[Retriever, list[Citation], float]:
+    # Resident RAG index: a hot reload maps the new version's files; scoring is CPU work.
+    index = get_index()
+    context = session_context(index, session_id, collected)  # context vector cached per session
+    citations, best_score = retrieve(index, message, context=context)
+    return index, citations, best_score
+
+
+def _finish_turn(
+    req: ChatRequest, uow: UnitOfWork, turn: _LlmTurn, content: str, *, blocked: GuardrailResult | None = None
+) -> ChatResponse:
+    """Guardrail-check the LLM answer (``blocked``: already tripped mid-stream) and record the turn."""
+    state, citations = turn.state, turn.citations
+    gr = blocked or check_response(content)
     if not gr.ok:
-        ticket = Ticket(
-            summary=state.collected.get("summary") or req.message.strip()[:120],
-            category=state.category or "unknown",
+        return _escalate(
+            req,
+            uow,
+            state,
+            citations,
+            reason=f"Guardrail blocked response: {gr.reason}",
             user={"org_id": req.org_id, "user_id": req.user_id},
-            device={k: v for k, v in req.context.items() if k.startswith("device_")},
-            diagnostics=state.collected,
-            steps_attempted=state.steps_attempted,
-            error_text=str(state.collected.get("error_message") or "") or None,
-            escalation_reason=f"Guardrail blocked response: {gr.reason}",
-            citations=citations,
-        )
-        rendered = _render_ticket(ticket)
-        insert_ticket(
-            org_id=req.org_id,
-            user_id=req.user_id,
-            session_id=state.session_id,
-            summary=ticket.summary,
-            category=ticket.category,
-            impact=ticket.impact,
-            urgency=ticket.urgency,
-            escalation_reason=ticket.escalation_reason,
-            rendered_text=rendered,
-            diagnostics=ticket.diagnostics,
-            steps_attempted=ticket.steps_attempted,
-            citations=[c.model_dump() for c in ticket.citations],
         )
-        insert_message(session_id=state.session_id, role='assistant', content=rendered)
-        save_session(state)
-        return TicketResponse(ticket=ticket, rendered=rendered)
 
-    insert_message(session_id=state.session_id, role='assistant', content=content, citations=[c.model_dump() for c in citations])
-    save_session(state)
-    return AnswerResponse(message=content, citations=citations, collected=state.collected)
\ No newline at end of file
+    uow.insert_message(session_id=state.session_id, role='assistant', content=content, citations=[c.model_dump() for c in citations])
+    uow.save_session(state)
+    return AnswerResponse(message=content, citations=citations, collected=state.collected)
+
+
+def _escalate(
+    req: ChatRequest,
+    uow: UnitOfWork,
+    state: SessionState,
+    citations: list[Citation],
+    *,
+    reason: str,
+    user: dict[str, Any],
+) -> TicketResponse:
+    ticket = Ticket(
+        summary=state.collected.get("summary") or req.message.strip()[:120],
+        category=state.category or "unknown",
+        user=user,
+        device={k: v for k, v in req.context.items() if k.startswith("device_")},
+        diagnostics=state.collected,
+        steps_attempted=state.steps_attempted,
+        error_text=str(state.collected.get("error_message") or "") or None,
+        escalation_reason=reason,
+        citations=citations,
+    )
+    rendered = _render_ticket(ticket)
+    uow.insert_ticket(
+        org_id=req.org_id,
+        user_id=req.user_id,
+        session_id=state.session_id,
+        summary=ticket.summary,
+        category=ticket.category,
+        impact=ticket.impact,
+        urgency=ticket.urgency,
+        escalation_reason=ticket.escalation_reason,
+        rendered_text=rendered,
+        diagnostics=ticket.diagnostics,
+        steps_attempted=ticket.steps_attempted,
+        citations=[c.model_dump() for c in ticket.citations],
+    )
+    uow.insert_message(session_id=state.session_id, role='assistant', content=rendered)
+    uow.save_session(state)
+    return TicketResponse(ticket=ticket, rendered=rendered)
@@ -18,6 +18,7 @@ class Citation(BaseModel):
     source_id: str
     title: str
     snippet: str
+    score: float | None = None
 
 
 class AnswerResponse(BaseModel):
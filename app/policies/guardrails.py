@@ -22,19 +22,65 @@ BANNED_PHRASES = [
 ]
 
 
-def check_response(text: str) -> GuardrailResult:
+MAX_RESPONSE_CHARS = 5000
+_LONGEST_PHRASE = max(len(p) for p in BANNED_PHRASES)
+
+
+def _banned_phrase(text: str) -> str | None:
     t = text.lower()
     for p in BANNED_PHRASES:
         if p in t:
-            return GuardrailResult(False, f"Banned phrase detected: {p}")
-    if len(text) > 5000:
+            return p
+    return None
+
+
+def check_response(text: str) -> GuardrailResult:
+    phrase = _banned_phrase(text)
+    if phrase:
+        return GuardrailResult(False, f"Banned phrase detected: {phrase}")
+    if len(text) > MAX_RESPONSE_CHARS:
         return GuardrailResult(False, "Response too long")
     return GuardrailResult(True)
 
 
+class StreamGuard:
+    """``check_response`` for a response that arrives in pieces (token streaming).
+
+    ``feed`` only scans the new piece plus the tail of the previous text that
+    could start a banned phrase split across pieces, so checking a whole
+    stream costs about as much as one ``check_response`` over the full text.
+    Once tripped, it stays tripped.
+    """
+
+    def __init__(self) -> None:
+        self._tail = ""
+        self.length = 0
+        self.result = GuardrailResult(True)
+
+    def feed(self, piece: str) -> GuardrailResult:
+        if not self.result.ok:
+            return self.result
+        self.length += len(piece)
+        window = self._tail + piece
+        self._tail = window[-(_LONGEST_PHRASE - 1) :]
+        phrase = _banned_phrase(window)
+        if phrase:
+            self.result = GuardrailResult(False, f"Banned phrase detected: {phrase}")
+        elif self.length > MAX_RESPONSE_CHARS:
+            self.result = GuardrailResult(False, "Response too long")
+        return self.result
+
+
+def rag_min_score() -> float:
+    """Retrieval confidence below which a turn escalates, on the configured backend's score scale."""
+    if settings.rag_backend.lower() == "bm25":
+        return settings.rag_bm25_min_score
+    return settings.rag_min_score
+
+
 def should_escalate(turns: int, best_rag_score: float) -> tuple[bool, str | None]:
     if turns >= settings.max_turns_before_escalate:
         return True, f"Exceeded max turns ({settings.max_turns_before_escalate})"
-    if best_rag_score < settings.rag_min_score:
+    if best_rag_score < rag_min_score():
         return True, "Insufficient documentation coverage (low retrieval confidence)"
     return False, None
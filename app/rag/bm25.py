@@ -0,0 +1,157 @@
+"""BM25 retrieval over an inverted index (postings lists).
+
+Alternative to the TF-IDF cosine ``RagIndex`` for large KBs: each term owns a
+postings list of (chunk row, precomputed BM25 impact), so a query only reads
+the postings of its own terms. Search is term-at-a-time with max-score
+early termination: terms are visited in decreasing upper-bound order, and
+once the k-th best score so far beats what the unvisited terms could add,
+no new chunks are admitted and hopeless candidates are dropped; the
+remaining lists are only probed for the surviving candidates.
+
+Scores are divided by the query's upper bound (the sum of each term's best
+impact), which keeps ``best_score`` in [0, 1]. That is not a cosine: a chunk
+holding the query's only known term at its best weight scores 1.0, and
+terms outside the vocabulary don't lower it. Escalation therefore uses its
+own threshold, ``rag_bm25_min_score``, not the TF-IDF ``rag_min_score``.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Sequence
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import CountVectorizer
+
+from app.rag import store
+from app.rag.index import DocChunk, _top_k
+
+
+@dataclass
+class Bm25Index:
+    vectorizer: Any  # CountVectorizer, or store.MappedVectorizer emitting raw counts
+    post_ptr: np.ndarray  # term column -> slice of post_docs/post_w
+    post_docs: np.ndarray  # chunk rows, ascending within each term
+    post_w: np.ndarray  # BM25 impact of the term in that chunk
+    max_w: np.ndarray  # per-term upper bound (max impact)
+    chunks: Sequence[DocChunk]
+    k1: float = 1.2
+    b: float = 0.75
+    version: str = ""
+
+    def encode(self, texts: Sequence[str]) -> Any:
+        return sp.csr_matrix(self.vectorizer.transform(list(texts)))
+
+    def search(self, qv: Any, top_k: int) -> list[list[tuple[int, float]]]:
+        qv = sp.csr_matrix(qv)
+        out = []
+        for r in range(qv.shape[0]):
+            lo, hi = qv.indptr[r], qv.indptr[r + 1]
+            out.append(self._search_one(qv.indices[lo:hi], qv.data[lo:hi], top_k))
+        return out
+
+    def _postings(self, col: int) -> tuple[np.ndarray, np.ndarray]:
+        lo, hi = int(self.post_ptr[col]), int(self.post_ptr[col + 1])
+        return self.post_docs[lo:hi], self.post_w[lo:hi]
+
+    def _search_one(self, cols: np.ndarray, qw: np.ndarray, k: int) -> list[tuple[int, float]]:
+        if cols.size == 0:
+            return []
+        ub = qw * self.max_w[cols]
+        bound = float(ub.sum())
+        if bound <= 0:
+            return []
+
+        remaining = bound
+        docs = np.empty(0, dtype=np.int64)
+        scores = np.empty(0, dtype=np.float64)
+        admit = True
+        for t in np.argsort(-ub, kind="stable"):
+            pdocs, pw = self._postings(int(cols[t]))
+            contrib = qw[t] * pw.astype(np.float64)
+            remaining -= float(ub[t])
+            if admit:
+                docs, inv = np.unique(np.concatenate([docs, pdocs]), return_inverse=True)
+                scores = np.bincount(inv, weights=np.concatenate([scores, contrib]), minlength=docs.size)
+            elif pdocs.size:
+                pos = np.minimum(np.searchsorted(pdocs, docs), pdocs.size - 1)
+                hit = pdocs[pos] == docs
+                scores[hit] += contrib[pos[hit]]
+
+            if scores.size >= k:
+                theta = float(np.partition(scores, scores.size - k)[scores.size - k])
+                if theta >= remaining:
+                    # A chunk not seen yet can't reach the top-k any more.
+                    admit = False
+                if not admit:
+                    keep = scores + remaining >= theta
+                    docs, scores = docs[keep], scores[keep]
+        return _top_k(docs, scores / bound, k)
+
+
+def build_bm25(chunks: Sequence[DocChunk], *, k1: float = 1.2, b: float = 0.75, vectorizer: CountVectorizer | None = None) -> Bm25Index:
+    vec = vectorizer or CountVectorizer(lowercase=True, stop_words="english")
+    x = sp.csc_matrix(vec.fit_transform(store.iter_texts(chunks)), dtype=np.float64)
+    x.sort_indices()
+    n_docs = x.shape[0]
+    doc_len = np.asarray(x.sum(axis=1)).ravel()
+    avgdl = float(doc_len.mean()) if n_docs else 1.0
+    df = np.diff(x.indptr)
+    idf = np.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+
+    tf = x.data
+    term_of = np.repeat(np.arange(x.shape[1]), df)
+    norm = k1 * (1.0 - b + b * doc_len[x.indices] / (avgdl or 1.0))
+    w = (idf[term_of] * tf * (k1 + 1.0) / (tf + norm)).astype(np.float32)
+
+    max_w = np.zeros(x.shape[1], dtype=np.float32)
+    np.maximum.at(max_w, term_of, w)
+    return Bm25Index(
+        vectorizer=vec,
+        post_ptr=x.indptr.astype(np.int64),
+        post_docs=x.indices.astype(np.int32),
+        post_w=w,
+        max_w=max_w,
+        chunks=chunks,
+        k1=k1,
+        b=b,
+    )
+
+
+def write_bm25(root: str | Path, index: Bm25Index, keep: int = 3) -> str:
+    """Write a BM25 index version under ``root`` (see ``app.rag.store``). Returns the version id."""
+
+    def fill(w: store.VersionWriter) -> dict[str, Any]:
+        w.save("post_ptr", index.post_ptr)
+        w.save("post_docs", index.post_docs)
+        w.save("post_w", index.post_w)
+        w.save("max_w", index.max_w)
+        w.save_vocabulary(index.vectorizer.vocabulary_)
+        w.save_chunks(index.chunks)
+        return {
+            "kind": "bm25",
+            "n_rows": len(index.chunks),
+            "n_features": int(index.max_w.shape[0]),
+            "k1": index.k1,
+            "b": index.b,
+            "vectorizer": store.vectorizer_params(index.vectorizer),
+        }
+
+    return store.write_version(root, fill, keep=keep)
+
+
+def open_bm25(dirpath: Path, meta: dict[str, Any]) -> Bm25Index:
+    params = {**meta["vectorizer"], "use_idf": False, "norm": None}
+    vectorizer = store.MappedVectorizer(params, store.open_vocabulary(dirpath), np.empty(0), meta["n_features"])
+    return Bm25Index(
+        vectorizer=vectorizer,
+        post_ptr=store.load_array(dirpath, "post_ptr"),
+        post_docs=store.load_array(dirpath, "post_docs"),
+        post_w=store.load_array(dirpath, "post_w"),
+        max_w=store.load_array(dirpath, "max_w"),
+        chunks=store.ChunkStore(dirpath),
+        k1=float(meta["k1"]),
+        b=float(meta["b"]),
+        version=meta["version"],
+    )
@@ -0,0 +1,107 @@
+"""Index compaction helpers used by ``scripts/ingest_kb.py``.
+
+KB exports repeat the same boilerplate (footers, "contact the service desk"
+sections, copy-pasted procedures), and the chunker's overlap makes short
+articles produce near-identical chunks. Dropping those before fitting
+shrinks the matrix and stops duplicates from crowding the top-k.
+
+Exact duplicates are found by hashing whitespace/case-normalized text; near
+duplicates by MinHash signatures over word shingles, bucketed with LSH
+banding and confirmed by signature agreement.
+"""
+from __future__ import annotations
+
+import hashlib
+import re
+import zlib
+from typing import Iterable, Sequence
+
+import numpy as np
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_WS = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    return _WS.sub(" ", text).strip().lower()
+
+
+def shingles(text: str, k: int = 5) -> np.ndarray:
+    """CRC32 hashes of the word k-shingles of ``text`` (whole text if shorter)."""
+    words = normalize_text(text).split(" ")
+    grams = [" ".join(words[i : i + k]) for i in range(max(1, len(words) - k + 1))]
+    return np.unique(np.array([zlib.crc32(g.encode("utf-8")) for g in grams], dtype=np.uint64))
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = 64, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self._a = rng.integers(1, 1 << 31, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 31, size=num_perm, dtype=np.uint64)
+
+    def signature(self, hashes: np.ndarray) -> np.ndarray:
+        # (a*x + b) mod p for every permutation x shingle; operands stay < 2^63.
+        h = (np.outer(self._a, hashes) + self._b[:, None]) % _MERSENNE_PRIME
+        return h.min(axis=1).astype(np.uint64)
+
+
+def find_duplicates(
+    texts: Iterable[str],
+    *,
+    threshold: float = 0.9,
+    num_perm: int = 64,
+    bands: int = 16,
+    shingle_size: int = 5,
+) -> dict[int, int]:
+    """Map each duplicate row to the first (kept) row it duplicates.
+
+    Rows whose normalized text is identical are exact duplicates; otherwise a
+    row is a near duplicate when its MinHash signature agrees with an earlier
+    kept row's on at least ``threshold`` of the permutations (an estimate of
+    shingle Jaccard similarity).
+    """
+    if num_perm % bands:
+        raise ValueError("num_perm must be a multiple of bands")
+    rows_per_band = num_perm // bands
+    hasher = MinHasher(num_perm)
+    exact: dict[bytes, int] = {}
+    buckets: list[dict[bytes, list[int]]] = [{} for _ in range(bands)]
+    signatures: dict[int, np.ndarray] = {}
+    dup_of: dict[int, int] = {}
+
+    for row, text in enumerate(texts):
+        key = hashlib.blake2b(normalize_text(text).encode("utf-8"), digest_size=16).digest()
+        if key in exact:
+            dup_of[row] = exact[key]
+            continue
+        exact[key] = row
+
+        sig = hasher.signature(shingles(text, shingle_size))
+        band_keys = [sig[b * rows_per_band : (b + 1) * rows_per_band].tobytes() for b in range(bands)]
+        match = None
+        for b, bk in enumerate(band_keys):
+            for other in buckets[b].get(bk, ()):
+                if float(np.mean(signatures[other] == sig)) >= threshold:
+                    match = other
+                    break
+            if match is not None:
+                break
+        if match is not None:
+            dup_of[row] = match
+            continue
+
+        signatures[row] = sig
+        for b, bk in enumerate(band_keys):
+            buckets[b].setdefault(bk, []).append(row)
+    return dup_of
+
+
+def overlap_at_k(reference: Sequence[Sequence[str]], candidate: Sequence[Sequence[str]]) -> float:
+    """Mean fraction of each reference top-k list that the candidate list also returned.
+
+    Repeated ids in a reference list (e.g. a chunk and its dropped duplicate,
+    both mapped to the kept id) count once.
+    """
+    fractions = [len(set(ref) & set(cand)) / len(set(ref)) for ref, cand in zip(reference, candidate) if ref]
+    return float(np.mean(fractions)) if fractions else 1.0
@@ -1,16 +1,26 @@
 from __future__ import annotations
 
+import hashlib
+import logging
 import pickle
+import re
+import threading
+import time
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any
+from typing import Any, Protocol, Sequence
 
 import numpy as np
+import scipy.sparse as sp
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
 
+from app.core.cache import TTLCache
 from app.core.config import settings
 from app.models.schemas import Citation
+from app.rag import store
+
+logger = logging.getLogger(__name__)
 
 
 @dataclass
@@ -21,41 +31,210 @@ class DocChunk:
     metadata: dict[str, Any]
 
 
+class Retriever(Protocol):
+    """What the chat flow needs from a retrieval engine.
+
+    ``search`` returns, per query row, ``(chunk_row, score)`` pairs best first,
+    with scores in [0, 1]. ``should_escalate`` compares the best one against
+    the backend's own threshold (``guardrails.rag_min_score()``): a cosine and
+    a normalized BM25 score are not on the same scale.
+    """
+
+    chunks: Sequence[DocChunk]
+    version: str
+
+    def encode(self, texts: Sequence[str]) -> Any:
+        """Sparse query rows (one per text) in this engine's term space."""
+        ...
+
+    def search(self, qv: Any, top_k: int) -> list[list[tuple[int, float]]]:
+        ...
+
+
 @dataclass
 class RagIndex:
-    vectorizer: TfidfVectorizer
+    """TF-IDF cosine retriever."""
+
+    vectorizer: TfidfVectorizer  # or store.MappedVectorizer for memory-mapped indexes
     matrix: Any  # sparse
-    chunks: list[DocChunk]
+    chunks: Sequence[DocChunk]  # list, or store.ChunkStore for memory-mapped indexes
+    # Content hash of the index this was loaded from (set by load_index).
+    version: str = ""
+
+    def encode(self, texts: Sequence[str]) -> Any:
+        return self.vectorizer.transform(list(texts))
+
+    def search(self, qv: Any, top_k: int) -> list[list[tuple[int, float]]]:
+        # Match the stored dtype (float32 for compacted indexes) so the product
+        # never upcasts the whole matrix.
+        scores = _score(self, sp.csr_matrix(qv, dtype=self.matrix.dtype))
+        out = []
+        for r in range(scores.shape[0]):
+            lo, hi = scores.indptr[r], scores.indptr[r + 1]
+            out.append(_top_k(scores.indices[lo:hi], scores.data[lo:hi], top_k))
+        return out
+
+
+def index_path(backend: str | None = None) -> str:
+    """Default on-disk location of the index for ``backend`` (TIER1_RAG_BACKEND)."""
+    backend = (backend or settings.rag_backend).lower()
+    if backend == "bm25":
+        return settings.rag_bm25_index_path
+    if backend == "hashed":
+        return settings.rag_hashed_index_path
+    if backend == "tfidf":
+        return settings.rag_index_path
+    raise ValueError(f"Unknown RAG backend: {backend!r} (expected tfidf, bm25 or hashed)")
+
+
+def serving_path(path: str | None = None) -> Path:
+    """The index to serve: ``path``, else the configured backend's index.
+
+    A fresh checkout ships only the legacy pickle (``rag_legacy_index_path``),
+    so with the tfidf backend that file is served until ``ingest_kb.py`` has
+    written the index directory.
+    """
+    if path:
+        return Path(path)
+    p = Path(index_path())
+    if not p.exists() and settings.rag_backend.lower() == "tfidf":
+        legacy = Path(settings.rag_legacy_index_path)
+        if legacy.is_file():
+            return legacy
+    return p
+
 
+def load_index(path: str | None = None) -> Retriever:
+    """Load the index at ``path`` (default: ``serving_path()``).
 
-def load_index(path: str | None = None) -> RagIndex:
-    p = Path(path or settings.rag_index_path)
+    A directory is the memory-mapped format written by ``scripts/ingest_kb.py``
+    (see ``app.rag.store``); a file is a legacy pickled ``RagIndex``.
+    """
+    p = serving_path(path)
     if not p.exists():
         raise FileNotFoundError(
             f"RAG index not found at {p.resolve()}. Run: python scripts/ingest_kb.py"
         )
-    with p.open("rb") as f:
-        return pickle.load(f)
+    if p.is_dir():
+        return store.open_index(p)
+    raw = p.read_bytes()
+    index: RagIndex = pickle.loads(raw)
+    index.matrix = prepare_matrix(index.matrix)
+    index.version = hashlib.sha256(raw).hexdigest()[:12]
+    return index
 
 
-def retrieve(index: RagIndex, query: str, top_k: int | None = None) -> tuple[list[Citation], float]:
-    """Return (citations, best_score)."""
-    k = top_k or settings.rag_top_k
-    qv = index.vectorizer.transform([query])
-    sims = cosine_similarity(qv, index.matrix).ravel()
+class ResidentIndex:
+    """Process-wide RAG index, loaded once and hot-swapped when the file changes.
+
+    Callers grab a reference via ``get()`` and keep using it for the whole
+    request, so a reload never changes the index underneath an in-flight turn;
+    the old object is simply dropped once nobody references it any more.
+    The file is stat'ed at most every ``rag_reload_check_s`` seconds.
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._index: Retriever | None = None
+        self._signature: tuple[int, int] | None = None
+        self._checked_at = 0.0
+
+    def _path(self) -> Path:
+        return serving_path(self.path)
+
+    def _stat(self) -> tuple[int, int] | None:
+        p = self._path()
+        if p.is_dir():
+            # Writers swap versions by replacing CURRENT, so that's the file to watch.
+            p = p / store.CURRENT_FILE
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def get(self) -> Retriever:
+        index = self._index
+        now = time.monotonic()
+        if index is not None and now - self._checked_at < settings.rag_reload_check_s:
+            return index
+        with self._lock:
+            self._checked_at = now
+            sig = self._stat()
+            if self._index is not None and (sig is None or sig == self._signature):
+                # A missing file keeps serving the last good index.
+                return self._index
+            return self._load(sig)
+
+    def reload(self) -> Retriever:
+        """Force a reload regardless of the file signature."""
+        with self._lock:
+            self._checked_at = time.monotonic()
+            return self._load(self._stat())
+
+    def _load(self, sig: tuple[int, int] | None) -> Retriever:
+        path = self._path()
+        index = load_index(str(path))
+        previous = self._index.version if self._index is not None else None
+        if index.version != previous:
+            logger.info("RAG index loaded: version=%s (previous=%s)", index.version, previous)
+            if self.path is None and path != Path(index_path()):
+                logger.warning("Serving the legacy index %s; run scripts/ingest_kb.py to build %s", path, index_path())
+            # Entries for the old version can never hit again; free them now.
+            retrieval_cache.clear()
+            context_cache.clear()
+        self._index = index
+        self._signature = sig
+        return index
+
+    @property
+    def version(self) -> str | None:
+        return self._index.version if self._index is not None else None
+
+
+resident_index = ResidentIndex()
+
+
+def get_index() -> Retriever:
+    """Return the resident index, reloading it if the index file changed."""
+    return resident_index.get()
+
+
+def prepare_matrix(matrix: Any) -> Any:
+    """Return ``matrix`` as L2-normalized CSC, the layout the scoring kernel expects.
 
-    if sims.size == 0:
-        return [], 0.0
+    Indexes written by ``app.rag.store`` are already in this form; this is for
+    legacy pickles and freshly fitted matrices.
+    """
+    return sp.csc_matrix(normalize(matrix, norm="l2"))
 
-    order = np.argsort(-sims)[:k]
-    best = float(sims[order[0]]) if len(order) else 0.0
 
+def _score(index: RagIndex, qv: Any) -> Any:
+    """Cosine scores of query rows ``qv`` against every chunk, as sparse rows.
+
+    Chunk rows and query vectors are unit-length, so cosine similarity is a
+    single sparse product. With the matrix stored column-major, ``matrix.T``
+    is a free CSR view whose rows are term postings, so only the query's
+    non-zero columns are ever touched and only matching chunks get a score.
+    """
+    return sp.csr_matrix(qv @ index.matrix.T)
+
+
+def _top_k(rows: np.ndarray, scores: np.ndarray, k: int) -> list[tuple[int, float]]:
+    keep = scores > 0
+    rows, scores = rows[keep], scores[keep]
+    if scores.size > k:
+        part = np.argpartition(-scores, k - 1)[:k]
+        rows, scores = rows[part], scores[part]
+    order = np.argsort(-scores, kind="stable")
+    return [(int(rows[i]), float(scores[i])) for i in order]
+
+
+def _citations(index: Retriever, hits: list[tuple[int, float]]) -> tuple[list[Citation], float]:
     citations: list[Citation] = []
-    for i in order:
-        score = float(sims[i])
-        if score <= 0:
-            continue
-        ch = index.chunks[int(i)]
+    for i, score in hits:
+        ch = index.chunks[i]
         snippet = ch.text.strip().replace("\n", " ")
         if len(snippet) > 240:
             snippet = snippet[:240].rstrip() + "..."
@@ -64,6 +243,103 @@ def retrieve(index: RagIndex, query: str, top_k: int | None = None) -> tuple[lis
                 source_id=ch.source_id,
                 title=ch.title,
                 snippet=f"[{score:.2f}] {snippet}",
+                score=score,
             )
         )
+    best = hits[0][1] if hits else 0.0
     return citations, best
+
+
+retrieval_cache: TTLCache[tuple[str, str, str, int], tuple[list[Citation], float]] = TTLCache(
+    settings.rag_cache_size, settings.rag_cache_ttl_s
+)
+_WS = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """Cache key form of a query: case and whitespace don't change TF-IDF/BM25 scores."""
+    return _WS.sub(" ", query).strip().lower()
+
+
+@dataclass(frozen=True)
+class QueryContext:
+    """A session's collected fields, rendered and encoded against one index version."""
+
+    text: str  # "k: v" lines, sorted by key
+    version: str
+    vector: Any  # 1 x n_features sparse row from ``index.encode``
+
+
+# session_id -> QueryContext; re-encoded only when the fields or the index version change.
+context_cache: TTLCache[str, QueryContext] = TTLCache(settings.rag_context_cache_size, settings.rag_cache_ttl_s)
+
+
+def context_text(collected: dict[str, Any]) -> str:
+    return "\n".join(f"{k}: {v}" for k, v in sorted(collected.items()))
+
+
+def session_context(index: Retriever, session_id: str, collected: dict[str, Any]) -> QueryContext | None:
+    """Return the encoded collected-fields context for ``session_id``, reusing last turn's vector."""
+    text = context_text(collected)
+    if not text:
+        return None
+    ctx = context_cache.get(session_id) if index.version else None
+    if ctx is None or ctx.text != text or ctx.version != index.version:
+        ctx = QueryContext(text=text, version=index.version, vector=sp.csr_matrix(index.encode([text])))
+        if index.version:
+            context_cache.put(session_id, ctx)
+    return ctx
+
+
+def combine_query(message_vec: Any, context_vec: Any) -> Any:
+    """``rag_message_weight * unit(message) + rag_context_weight * unit(context)``, L2-normalized.
+
+    Normalizing each part first makes the weights mean the same thing however
+    long the message or the context is; normalizing the sum keeps cosine
+    scores in [0, 1].
+    """
+    msg = normalize(sp.csr_matrix(message_vec, dtype=np.float64), norm="l2")
+    ctx = normalize(sp.csr_matrix(context_vec, dtype=np.float64), norm="l2")
+    return normalize(settings.rag_message_weight * msg + settings.rag_context_weight * ctx, norm="l2")
+
+
+def retrieve(
+    index: Retriever, query: str, top_k: int | None = None, *, context: QueryContext | None = None
+) -> tuple[list[Citation], float]:
+    """Return (citations, best_score).
+
+    With ``context`` (see ``session_context``), the message vector is blended
+    with the session's cached context vector instead of re-encoding the
+    message and every collected field as one string.
+
+    Results are cached per (normalized query, context, index version, k), so
+    bursts of the same question (outages) skip encoding and scoring. A rebuilt
+    index has a new version and therefore never serves stale results. Indexes
+    without a version (built in memory) are not cached.
+    """
+    k = top_k or settings.rag_top_k
+    ctx_text = context.text if context is not None else ""
+    key = (normalize_query(query), ctx_text, index.version, k) if index.version else None
+    if key is not None:
+        cached = retrieval_cache.get(key)
+        if cached is not None:
+            return list(cached[0]), cached[1]
+    qv = index.encode([query])
+    if context is not None:
+        qv = combine_query(qv, context.vector)
+    citations, best = _citations(index, index.search(qv, k)[0])
+    if key is not None:
+        retrieval_cache.put(key, (citations, best))
+    return list(citations), best
+
+
+def retrieve_many(index: Retriever, queries: Sequence[str], top_k: int | None = None) -> list[tuple[list[Citation], float]]:
+    """Batched ``retrieve`` for offline evaluation and replay jobs.
+
+    The whole batch is encoded and scored in one call (for TF-IDF, one sparse
+    matrix multiply).
+    """
+    k = top_k or settings.rag_top_k
+    if not queries:
+        return []
+    return [_citations(index, hits) for hits in index.search(index.encode(list(queries)), k)]
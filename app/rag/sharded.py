@@ -0,0 +1,234 @@
+"""Sharded TF-IDF index built on a stateless hashing vectorizer.
+
+There is no vocabulary to fit, store or hold in memory: terms are hashed
+straight into ``n_features`` columns, and only the IDF vector is global.
+Chunks are split into N contiguous shards, each its own directory of
+memory-mapped arrays (same layout as ``app.rag.store``), so the KB can grow
+past what one matrix comfortably holds. Queries are scored against every
+shard concurrently on a thread pool (scipy's sparse products release the
+GIL) and the per-shard top-k lists are merged into a global top-k.
+
+Merging by raw score is only valid because every shard scores on the same
+scale: one global IDF and L2-normalized rows, so a score is a cosine no
+matter which shard produced it. Sharding is therefore limited to this cosine
+backend; ``open_sharded`` refuses anything else. Per-shard statistics (a
+shard-local IDF, or BM25 scores divided by each shard's own query bound)
+would make the shard scores incomparable.
+"""
+from __future__ import annotations
+
+import heapq
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Iterable, Sequence
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+
+from app.core.config import settings
+from app.rag import store
+from app.rag.index import DocChunk, _top_k
+
+DEFAULT_PARAMS: dict[str, Any] = {
+    "lowercase": True,
+    "stop_words": "english",
+    "ngram_range": [1, 2],
+    "alternate_sign": False,
+    "norm": None,
+}
+
+_pool: ThreadPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+
+def _search_pool() -> ThreadPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=settings.rag_search_threads, thread_name_prefix="rag-shard")
+        return _pool
+
+
+def make_vectorizer(params: dict[str, Any]) -> HashingVectorizer:
+    kwargs = dict(params)
+    kwargs["ngram_range"] = tuple(kwargs.get("ngram_range", (1, 1)))
+    return HashingVectorizer(**kwargs)
+
+
+@dataclass
+class Shard:
+    matrix: Any  # L2-normalized CSC, rows = this shard's chunks
+    chunks: store.ChunkStore
+    offset: int  # global row of this shard's first chunk
+
+    def search(self, qv: Any, top_k: int) -> list[list[tuple[int, float]]]:
+        scores = sp.csr_matrix(sp.csr_matrix(qv, dtype=self.matrix.dtype) @ self.matrix.T)
+        out = []
+        for r in range(scores.shape[0]):
+            lo, hi = scores.indptr[r], scores.indptr[r + 1]
+            hits = _top_k(scores.indices[lo:hi], scores.data[lo:hi], top_k)
+            out.append([(self.offset + row, score) for row, score in hits])
+        return out
+
+
+class ShardedChunks(Sequence[DocChunk]):
+    """Global row -> chunk view over all shards."""
+
+    def __init__(self, shards: list[Shard]):
+        self._shards = shards
+        self._offsets = [s.offset for s in shards]
+        self._len = sum(len(s.chunks) for s in shards)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def _locate(self, i: int) -> tuple[Shard, int]:
+        i = int(i)
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError(i)
+        s = self._shards[int(np.searchsorted(self._offsets, i, side="right")) - 1]
+        return s, i - s.offset
+
+    def __getitem__(self, i):  # type: ignore[override]
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        shard, row = self._locate(i)
+        return shard.chunks[row]
+
+    def field(self, name: str, i: int) -> str:
+        shard, row = self._locate(i)
+        return shard.chunks.field(name, row)
+
+    def texts(self) -> Iterable[str]:
+        for s in self._shards:
+            yield from s.chunks.texts()
+
+
+@dataclass
+class ShardedIndex:
+    vectorizer: HashingVectorizer
+    idf: np.ndarray
+    shards: list[Shard]
+    version: str = ""
+
+    def __post_init__(self) -> None:
+        self.chunks = ShardedChunks(self.shards)
+
+    def encode(self, texts: Sequence[str]) -> Any:
+        return _tfidf(self.vectorizer.transform(list(texts)), self.idf)
+
+    def search(self, qv: Any, top_k: int) -> list[list[tuple[int, float]]]:
+        # Shard scores are cosines on one scale (see the module docstring), so they merge as-is.
+        qv = sp.csr_matrix(qv)
+        if len(self.shards) == 1:
+            per_shard = [self.shards[0].search(qv, top_k)]
+        else:
+            pool = _search_pool()
+            per_shard = list(pool.map(lambda s: s.search(qv, top_k), self.shards))
+        out = []
+        for r in range(qv.shape[0]):
+            merged = heapq.nlargest(top_k, (hit for hits in per_shard for hit in hits[r]), key=lambda h: h[1])
+            out.append(merged)
+        return out
+
+
+def _tfidf(tf: Any, idf: np.ndarray) -> Any:
+    x = sp.csr_matrix(tf, dtype=np.float64)
+    x.data *= idf[x.indices]
+    x.eliminate_zeros()
+    return normalize(x, norm="l2")
+
+
+def _texts(chunks: Sequence[DocChunk], lo: int, hi: int) -> Iterable[str]:
+    if isinstance(chunks, store.ChunkStore):
+        return (chunks.field("text", i) for i in range(lo, hi))
+    return (chunks[i].text for i in range(lo, hi))
+
+
+def write_sharded(
+    root: str | Path,
+    chunks: Sequence[DocChunk],
+    *,
+    n_shards: int = 4,
+    n_features: int = 2**21,
+    keep: int = 3,
+    dtype: str = "float64",
+) -> str:
+    """Hash, weight and write ``chunks`` as ``n_shards`` shards. Returns the version id.
+
+    Two passes, one shard in memory at a time: raw term counts are spooled to
+    disk while document frequencies are summed, then each shard is reloaded,
+    IDF-weighted, normalized and written.
+    """
+    params = {**DEFAULT_PARAMS, "n_features": int(n_features)}
+    hv = make_vectorizer(params)
+    n = len(chunks)
+    n_shards = max(1, min(int(n_shards), n or 1))
+    bounds = np.linspace(0, n, n_shards + 1).astype(np.int64)
+
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    scratch = Path(tempfile.mkdtemp(prefix=".shards-", dir=root))
+    try:
+        df = np.zeros(n_features, dtype=np.int64)
+        for i in range(n_shards):
+            tf = sp.csr_matrix(hv.transform(_texts(chunks, int(bounds[i]), int(bounds[i + 1]))))
+            df += np.bincount(tf.indices, minlength=n_features)
+            sp.save_npz(scratch / f"{i}.npz", tf)
+        idf = (np.log((1.0 + n) / (1.0 + df)) + 1.0).astype(np.float64)
+        # Features no chunk contains can't match; zeroing them keeps unseen query
+        # n-grams from diluting the query norm (a fitted vocabulary drops them too).
+        idf[df == 0] = 0.0
+
+        def fill(w: store.VersionWriter) -> dict[str, Any]:
+            w.save("idf", idf)
+            for i in range(n_shards):
+                lo, hi = int(bounds[i]), int(bounds[i + 1])
+                sw = w.subdir(f"shard-{i:03d}")
+                sw.save_sparse(sp.csc_matrix(_tfidf(sp.load_npz(scratch / f"{i}.npz"), idf), dtype=dtype))
+                sw.save_chunks([chunks[j] for j in range(lo, hi)])
+            return {
+                "kind": "hashed",
+                "n_rows": n,
+                "n_features": int(n_features),
+                "shards": [int(b) for b in bounds[:-1]],
+                "layout": "csc",
+                "normalized": True,
+                "dtype": dtype,
+                "vectorizer": params,
+            }
+
+        return store.write_version(root, fill, keep=keep)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def open_sharded(dirpath: Path, meta: dict[str, Any]) -> ShardedIndex:
+    if meta.get("kind") != "hashed" or not meta.get("normalized"):
+        # ShardedIndex.search merges raw scores; that needs cosines under one global IDF.
+        raise ValueError(f"{dirpath}: only globally weighted, L2-normalized (cosine) indexes can be sharded")
+    n_features = int(meta["n_features"])
+    shards = []
+    for i, offset in enumerate(meta["shards"]):
+        d = dirpath / f"shard-{i:03d}"
+        chunks = store.ChunkStore(d)
+        matrix = sp.csc_matrix(
+            (store.load_array(d, "data"), store.load_array(d, "indices"), store.load_array(d, "indptr")),
+            shape=(len(chunks), n_features),
+            copy=False,
+        )
+        shards.append(Shard(matrix=matrix, chunks=chunks, offset=int(offset)))
+    return ShardedIndex(
+        vectorizer=make_vectorizer(meta["vectorizer"]),
+        idf=store.load_array(dirpath, "idf"),
+        shards=shards,
+        version=meta["version"],
+    )
@@ -0,0 +1,464 @@
+"""Pickle-free, memory-mapped on-disk format for the RAG index.
+
+Layout (one directory per index version, selected by ``CURRENT``); shown for
+the TF-IDF kind, BM25 indexes (``app.rag.bm25``) share the vocabulary and
+chunk files and store postings instead of the matrix::
+
+    data/rag_index/
+      CURRENT                  name of the live version directory
+      <version>/
+        meta.json              kind, shape, dtype and vectorizer (analyzer) params
+        data.npy indices.npy indptr.npy   L2-normalized chunk x term matrix, stored
+                               column-major (CSC) so each term's postings are
+                               contiguous and scoring touches only query columns
+        idf.npy                IDF weight per column
+        vocab.npy vocab_off.npy vocab_col.npy
+                               UTF-8 terms sorted bytewise, concatenated, with
+                               offsets and the matrix column of each term
+        chunk_<field>.npy chunk_<field>_off.npy
+                               columnar chunk store: one UTF-8 blob per field
+                               (source_id, title, text, metadata) plus offsets
+
+Every array is opened with ``np.load(mmap_mode="r")``, so opening an index is
+near-instant and all uvicorn workers share the same page-cache pages instead
+of each holding a private, unpickled copy.
+
+Writers build a new version directory next to the live one and then replace
+``CURRENT`` atomically; readers that already mapped the old version keep
+working until they drop it.
+"""
+from __future__ import annotations
+
+import bisect
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from collections import Counter
+from pathlib import Path
+from typing import Any, Callable, Iterable, Sequence
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+FORMAT_VERSION = 1
+CURRENT_FILE = "CURRENT"
+CHUNK_FIELDS = ("source_id", "title", "text", "metadata")
+
+# TfidfVectorizer params that affect transform(); everything else only matters when fitting.
+_ANALYZER_PARAMS = (
+    "analyzer",
+    "lowercase",
+    "strip_accents",
+    "stop_words",
+    "token_pattern",
+    "ngram_range",
+    "binary",
+    "norm",
+    "use_idf",
+    "sublinear_tf",
+)
+
+
+class _BlobColumn(Sequence[bytes]):
+    """Variable-length byte strings stored as one blob plus offsets."""
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self._blob = blob
+        self._off = offsets
+
+    def __len__(self) -> int:
+        return len(self._off) - 1
+
+    def __getitem__(self, i):  # type: ignore[override]
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self._blob[int(self._off[i]) : int(self._off[i + 1])].tobytes()
+
+    def str(self, i: int) -> str:
+        return self[i].decode("utf-8")
+
+
+def _load(dirpath: Path, name: str) -> np.ndarray:
+    return np.load(dirpath / f"{name}.npy", mmap_mode="r")
+
+
+def _open_column(dirpath: Path, name: str) -> _BlobColumn:
+    return _BlobColumn(_load(dirpath, name), _load(dirpath, f"{name}_off"))
+
+
+class MappedVocabulary:
+    """Term -> column lookup by binary search over the memory-mapped sorted terms."""
+
+    def __init__(self, terms: _BlobColumn, cols: np.ndarray):
+        self._terms = terms
+        self._cols = cols
+
+    def __len__(self) -> int:
+        return len(self._terms)
+
+    def to_dict(self) -> dict[str, int]:
+        return {self._terms[i].decode("utf-8"): int(self._cols[i]) for i in range(len(self._terms))}
+
+    def get(self, term: str) -> int | None:
+        key = term.encode("utf-8")
+        i = bisect.bisect_left(self._terms, key)
+        if i < len(self._terms) and self._terms[i] == key:
+            return int(self._cols[i])
+        return None
+
+
+class MappedVectorizer:
+    """Stand-in for a fitted TfidfVectorizer backed by memory-mapped vocab/IDF.
+
+    Tokenization is delegated to an *unfitted* TfidfVectorizer built from the
+    stored params (the analyzer is stateless), so queries are tokenized
+    exactly like the ingest corpus was.
+    """
+
+    def __init__(self, params: dict[str, Any], vocabulary: MappedVocabulary, idf: np.ndarray, n_features: int):
+        self.params = params
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.n_features = n_features
+        kwargs = dict(params)
+        if kwargs.get("ngram_range") is not None:
+            kwargs["ngram_range"] = tuple(kwargs["ngram_range"])
+        self._analyze = TfidfVectorizer(**kwargs).build_analyzer()
+
+    # Fitted-TfidfVectorizer attributes, so an opened index can be rewritten by write_index().
+    def get_params(self) -> dict[str, Any]:
+        return dict(self.params)
+
+    @property
+    def idf_(self) -> np.ndarray:
+        return np.asarray(self.idf)
+
+    @property
+    def vocabulary_(self) -> dict[str, int]:
+        return self.vocabulary.to_dict()
+
+    def transform(self, texts: Iterable[str]) -> sp.csr_matrix:
+        data: list[float] = []
+        indices: list[int] = []
+        indptr = [0]
+        for text in texts:
+            counts: Counter[int] = Counter()
+            for term in self._analyze(text):
+                col = self.vocabulary.get(term)
+                if col is not None:
+                    counts[col] += 1
+            cols = sorted(counts)
+            tf = np.array([counts[c] for c in cols], dtype=np.float64)
+            if self.params.get("binary"):
+                tf[:] = 1.0
+            elif self.params.get("sublinear_tf"):
+                tf = np.log(tf) + 1.0
+            if self.params.get("use_idf", True) and cols:
+                tf *= self.idf[cols]
+            if self.params.get("norm") == "l2" and cols:
+                tf /= np.linalg.norm(tf)
+            elif self.params.get("norm") == "l1" and cols:
+                tf /= np.abs(tf).sum()
+            data.extend(tf.tolist())
+            indices.extend(cols)
+            indptr.append(len(indices))
+        return sp.csr_matrix(
+            (np.asarray(data, dtype=np.float64), np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int32)),
+            shape=(len(indptr) - 1, self.n_features),
+        )
+
+
+class ChunkStore(Sequence[Any]):
+    """Read-only, columnar list of DocChunk backed by memory-mapped blobs."""
+
+    def __init__(self, dirpath: Path):
+        self._cols = {f: _open_column(dirpath, f"chunk_{f}") for f in CHUNK_FIELDS}
+
+    def __len__(self) -> int:
+        return len(self._cols["source_id"])
+
+    def __getitem__(self, i):  # type: ignore[override]
+        from app.rag.index import DocChunk
+
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        return DocChunk(
+            source_id=self._cols["source_id"].str(i),
+            title=self._cols["title"].str(i),
+            text=self._cols["text"].str(i),
+            metadata=json.loads(self._cols["metadata"].str(i) or "{}"),
+        )
+
+    def field(self, name: str, i: int) -> str:
+        """Read one field without materializing the whole chunk."""
+        return self._cols[name].str(int(i))
+
+    def texts(self) -> Iterable[str]:
+        col = self._cols["text"]
+        return (col.str(i) for i in range(len(self)))
+
+
+def iter_texts(chunks: Sequence[Any]) -> Iterable[str]:
+    """Chunk texts, streamed straight from the blob for on-disk chunk stores."""
+    if isinstance(chunks, ChunkStore):
+        return chunks.texts()
+    return (c.text for c in chunks)
+
+
+class ChunkSpool(ChunkStore):
+    """Append-only, on-disk chunk buffer for streaming ingest.
+
+    Chunks are appended to one raw file per field while ingest runs, so
+    memory stays bounded by the offsets (8 bytes per chunk per field) no
+    matter how large the KB is. After ``close()`` it reads back like a
+    ``ChunkStore`` (e.g. to feed the vectorizer), and ``VersionWriter``
+    copies it into an index version without materializing the texts.
+    """
+
+    def __init__(self, dirpath: Path):
+        self.dir = Path(dirpath)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self._files = {f: (self.dir / f"{f}.bin").open("wb") for f in CHUNK_FIELDS}
+        self._off: dict[str, list[int]] = {f: [0] for f in CHUNK_FIELDS}
+        self._cols = {}
+
+    def append(self, chunk: Any) -> None:
+        values = (chunk.source_id, chunk.title, chunk.text, json.dumps(chunk.metadata or {}))
+        for f, value in zip(CHUNK_FIELDS, values):
+            b = value.encode("utf-8")
+            self._files[f].write(b)
+            self._off[f].append(self._off[f][-1] + len(b))
+
+    def __len__(self) -> int:
+        return len(self._off["source_id"]) - 1
+
+    def close(self) -> None:
+        for f, fh in self._files.items():
+            fh.close()
+            size = self._off[f][-1]
+            blob = np.memmap(self.dir / f"{f}.bin", dtype=np.uint8, mode="r") if size else np.empty(0, dtype=np.uint8)
+            self._cols[f] = _BlobColumn(blob, np.asarray(self._off[f], dtype=np.int64))
+
+    def write_to(self, w: "VersionWriter") -> None:
+        for f in CHUNK_FIELDS:
+            w.save_blob(f"chunk_{f}", self.dir / f"{f}.bin", np.asarray(self._off[f], dtype=np.int64))
+
+    def remove(self) -> None:
+        self._cols = {}
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class VersionWriter:
+    """Writes the arrays of one index version into a scratch directory, hashing as it goes."""
+
+    def __init__(self, dirpath: Path):
+        self.dir = dirpath
+        self._h = hashlib.sha256()
+        self._prefix = ""
+
+    def subdir(self, name: str) -> "VersionWriter":
+        """Writer for a sub-directory (e.g. one shard) that feeds the same version hash."""
+        w = VersionWriter(self.dir / name)
+        w.dir.mkdir()
+        w._h = self._h
+        w._prefix = f"{self._prefix}{name}/"
+        return w
+
+    def save(self, name: str, arr: np.ndarray) -> None:
+        arr = np.ascontiguousarray(arr)
+        self._h.update(f"{self._prefix}{name}".encode())
+        self._h.update(arr.tobytes())
+        np.save(self.dir / f"{name}.npy", arr)
+
+    def save_column(self, name: str, values: Iterable[str]) -> None:
+        encoded = [v.encode("utf-8") for v in values]
+        off = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=off[1:])
+        self.save(name, np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        self.save(f"{name}_off", off)
+
+    def save_vocabulary(self, vocabulary: dict[str, int]) -> None:
+        items = sorted(vocabulary.items(), key=lambda kv: kv[0].encode("utf-8"))
+        self.save_column("vocab", [t for t, _ in items])
+        self.save("vocab_col", np.array([c for _, c in items], dtype=np.int32))
+
+    def save_blob(self, name: str, raw_path: Path, offsets: np.ndarray) -> None:
+        """Stream a raw byte file into ``name.npy`` (hashed like ``save_column``)."""
+        size = raw_path.stat().st_size
+        out = np.lib.format.open_memmap(self.dir / f"{name}.npy", mode="w+", dtype=np.uint8, shape=(size,))
+        self._h.update(f"{self._prefix}{name}".encode())
+        pos = 0
+        with raw_path.open("rb") as f:
+            while block := f.read(1 << 20):
+                self._h.update(block)
+                out[pos : pos + len(block)] = np.frombuffer(block, dtype=np.uint8)
+                pos += len(block)
+        out.flush()
+        del out
+        self.save(f"{name}_off", offsets)
+
+    def save_chunks(self, chunks: Sequence[Any]) -> None:
+        if isinstance(chunks, ChunkSpool):
+            chunks.write_to(self)
+            return
+        self.save_column("chunk_source_id", [c.source_id for c in chunks])
+        self.save_column("chunk_title", [c.title for c in chunks])
+        self.save_column("chunk_text", [c.text for c in chunks])
+        self.save_column("chunk_metadata", [json.dumps(c.metadata or {}) for c in chunks])
+
+    def save_sparse(self, m: sp.spmatrix) -> None:
+        m.sort_indices()
+        self.save("data", m.data)
+        # Same dtype for indices/indptr so scipy can wrap the maps without upcasting copies.
+        idx_dtype = np.int32 if m.nnz < np.iinfo(np.int32).max else np.int64
+        self.save("indices", m.indices.astype(idx_dtype, copy=False))
+        self.save("indptr", m.indptr.astype(idx_dtype, copy=False))
+
+    def digest(self) -> str:
+        return self._h.hexdigest()[:12]
+
+
+def write_version(root: str | Path, fill: Callable[[VersionWriter], dict[str, Any]], keep: int = 3) -> str:
+    """Build a new version directory under ``root`` and make it current.
+
+    ``fill`` writes the arrays and returns the kind-specific part of
+    ``meta.json``. Returns the version id (a hash of everything written).
+    """
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    tmp = root / f".tmp-{uuid.uuid4().hex}"
+    tmp.mkdir()
+    try:
+        w = VersionWriter(tmp)
+        meta = fill(w)
+        version = w.digest()
+        meta = {"format": FORMAT_VERSION, "version": version, **meta}
+        (tmp / "meta.json").write_text(json.dumps(meta, indent=2), encoding="utf-8")
+
+        final = root / version
+        if final.exists():
+            shutil.rmtree(tmp)  # identical content already on disk
+        else:
+            tmp.rename(final)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    _set_current(root, version)
+    _prune(root, keep=keep, current=version)
+    return version
+
+
+def vectorizer_params(vectorizer: TfidfVectorizer) -> dict[str, Any]:
+    params = vectorizer.get_params()
+    out = {k: params[k] for k in _ANALYZER_PARAMS if k in params}
+    if isinstance(out.get("stop_words"), (set, frozenset)):
+        out["stop_words"] = sorted(out["stop_words"])
+    if out.get("ngram_range") is not None:
+        out["ngram_range"] = list(out["ngram_range"])
+    return out
+
+
+def write_index(
+    root: str | Path,
+    vectorizer: TfidfVectorizer,
+    matrix: Any,
+    chunks: Sequence[Any],
+    keep: int = 3,
+    dtype: str | None = None,
+) -> str:
+    """Write a TF-IDF index version under ``root`` and make it current. Returns the version id.
+
+    ``dtype`` (e.g. ``"float32"``) sets the stored weight type; by default the
+    matrix's own dtype is kept.
+    """
+
+    def fill(w: VersionWriter) -> dict[str, Any]:
+        # Rows are unit-length, so cosine similarity is a plain sparse dot product.
+        m = sp.csc_matrix(normalize(matrix, norm="l2", copy=True), dtype=dtype or matrix.dtype)
+        w.save_sparse(m)
+        w.save("idf", np.asarray(vectorizer.idf_, dtype=np.float64))
+        w.save_vocabulary(vectorizer.vocabulary_)
+        w.save_chunks(chunks)
+        return {
+            "kind": "tfidf",
+            "n_rows": int(m.shape[0]),
+            "n_features": int(m.shape[1]),
+            "dtype": str(m.data.dtype),
+            "layout": "csc",
+            "normalized": True,
+            "vectorizer": vectorizer_params(vectorizer),
+        }
+
+    return write_version(root, fill, keep=keep)
+
+
+def _set_current(root: Path, version: str) -> None:
+    tmp = root / f".{CURRENT_FILE}.{uuid.uuid4().hex}"
+    tmp.write_text(version + "\n", encoding="utf-8")
+    os.replace(tmp, root / CURRENT_FILE)
+
+
+def _prune(root: Path, *, keep: int, current: str) -> None:
+    # Old versions may still be mapped by running workers; unlinking is safe on POSIX.
+    versions = [p for p in root.iterdir() if p.is_dir() and not p.name.startswith(".") and p.name != current]
+    versions.sort(key=lambda p: p.stat().st_mtime, reverse=True)
+    for p in versions[max(keep - 1, 0) :]:
+        shutil.rmtree(p, ignore_errors=True)
+
+
+def current_version(root: str | Path) -> str:
+    p = Path(root) / CURRENT_FILE
+    if not p.exists():
+        raise FileNotFoundError(f"RAG index not found at {p.resolve()}. Run: python scripts/ingest_kb.py")
+    return p.read_text(encoding="utf-8").strip()
+
+
+def load_array(dirpath: Path, name: str) -> np.ndarray:
+    return _load(dirpath, name)
+
+
+def open_vocabulary(dirpath: Path) -> MappedVocabulary:
+    return MappedVocabulary(_open_column(dirpath, "vocab"), _load(dirpath, "vocab_col"))
+
+
+def open_index(root: str | Path):
+    """Memory-map the current index version under ``root``.
+
+    Returns a ``RagIndex``, ``Bm25Index`` or ``ShardedIndex`` depending on
+    the stored kind.
+    """
+    version = current_version(root)
+    d = Path(root) / version
+    meta = json.loads((d / "meta.json").read_text(encoding="utf-8"))
+    if meta.get("format") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported RAG index format {meta.get('format')!r} in {d}")
+
+    kind = meta.get("kind", "tfidf")
+    if kind == "bm25":
+        from app.rag.bm25 import open_bm25
+
+        return open_bm25(d, meta)
+    if kind == "hashed":
+        from app.rag.sharded import open_sharded
+
+        return open_sharded(d, meta)
+    if kind != "tfidf":
+        raise ValueError(f"Unknown RAG index kind {kind!r} in {d}")
+
+    from app.rag.index import RagIndex
+
+    shape = (meta["n_rows"], meta["n_features"])
+    fmt = sp.csc_matrix if meta.get("layout", "csr") == "csc" else sp.csr_matrix
+    matrix = fmt((_load(d, "data"), _load(d, "indices"), _load(d, "indptr")), shape=shape, copy=False)
+    if not meta.get("normalized"):
+        matrix = sp.csc_matrix(normalize(matrix, norm="l2"))
+    vectorizer = MappedVectorizer(meta["vectorizer"], open_vocabulary(d), _load(d, "idf"), meta["n_features"])
+    return RagIndex(vectorizer=vectorizer, matrix=matrix, chunks=ChunkStore(d), version=version)  # type: ignore[arg-type]
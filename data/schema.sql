@@ -86,6 +86,7 @@ CREATE TABLE IF NOT EXISTS sessions (
   status               TEXT NOT NULL DEFAULT 'open', -- open|closed
   collected_json       TEXT NOT NULL,
   steps_attempted_json TEXT NOT NULL,
+  version              INTEGER NOT NULL DEFAULT 1, -- bumped on every save (optimistic concurrency)
   created_at           TEXT NOT NULL DEFAULT (datetime('now')),
   updated_at           TEXT NOT NULL DEFAULT (datetime('now')),
   FOREIGN KEY (org_id) REFERENCES orgs(org_id) ON DELETE CASCADE,
@@ -93,6 +94,11 @@ CREATE TABLE IF NOT EXISTS sessions (
 );
 CREATE INDEX IF NOT EXISTS idx_sessions_org_status ON sessions(org_id, status);
 CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id);
+-- Admin listing: keyset pagination on (updated_at, session_id), covering the listed columns.
+CREATE INDEX IF NOT EXISTS idx_sessions_org_status_updated
+  ON sessions(org_id, status, updated_at, session_id, user_id, turns, category, created_at);
+-- Maintenance: idle open sessions to close, closed sessions to archive (app/core/maintenance.py).
+CREATE INDEX IF NOT EXISTS idx_sessions_status_updated ON sessions(status, updated_at);
 
 -- Messages (chat transcript)
 CREATE TABLE IF NOT EXISTS messages (
@@ -130,3 +136,72 @@ CREATE TABLE IF NOT EXISTS tickets (
 );
 CREATE INDEX IF NOT EXISTS idx_tickets_org_status ON tickets(org_id, status);
 CREATE INDEX IF NOT EXISTS idx_tickets_session ON tickets(session_id);
+-- Admin listing/export: keyset pagination on (created_at, ticket_id), with or without a status filter.
+CREATE INDEX IF NOT EXISTS idx_tickets_org_status_created ON tickets(org_id, status, created_at, ticket_id);
+CREATE INDEX IF NOT EXISTS idx_tickets_org_created ON tickets(org_id, created_at, ticket_id);
+
+-- KB chunks cited by messages/tickets, stored once (chunk_id: hash of source_id, title, snippet).
+CREATE TABLE IF NOT EXISTS kb_chunks (
+  chunk_id   TEXT PRIMARY KEY,
+  source_id  TEXT NOT NULL,
+  title      TEXT NOT NULL,
+  snippet    TEXT NOT NULL, -- without the per-hit "[score] " prefix
+  created_at TEXT NOT NULL DEFAULT (datetime('now'))
+) WITHOUT ROWID;
+
+-- Citation links (replace messages/tickets.citations_json, which stays '[]' for new rows).
+CREATE TABLE IF NOT EXISTS message_citations (
+  message_id TEXT NOT NULL,
+  rank       INTEGER NOT NULL,
+  chunk_id   TEXT NOT NULL,
+  score      REAL,
+  PRIMARY KEY (message_id, rank),
+  FOREIGN KEY (message_id) REFERENCES messages(message_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS ticket_citations (
+  ticket_id  TEXT NOT NULL,
+  rank       INTEGER NOT NULL,
+  chunk_id   TEXT NOT NULL,
+  score      REAL,
+  PRIMARY KEY (ticket_id, rank),
+  FOREIGN KEY (ticket_id) REFERENCES tickets(ticket_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+-- Finds kb_chunks rows nothing links to any more (pruned by maintenance).
+CREATE INDEX IF NOT EXISTS idx_message_citations_chunk ON message_citations(chunk_id);
+CREATE INDEX IF NOT EXISTS idx_ticket_citations_chunk ON ticket_citations(chunk_id);
+-- Rows still carrying inline citations, for the migration in app/core/maintenance.py (empty once done).
+CREATE INDEX IF NOT EXISTS idx_messages_inline_citations ON messages(message_id) WHERE citations_json != '[]';
+CREATE INDEX IF NOT EXISTS idx_tickets_inline_citations ON tickets(ticket_id) WHERE citations_json != '[]';
+
+-- Full-text search (FTS5, external content: the text is stored once, in tickets/messages).
+-- rowids are the implicit rowids of the content tables; after a full VACUUM (which may renumber
+-- them) run INSERT INTO <name>_fts(<name>_fts) VALUES('rebuild').
+CREATE VIRTUAL TABLE IF NOT EXISTS tickets_fts USING fts5(
+  summary, rendered_text, content='tickets', tokenize='porter unicode61'
+);
+CREATE TRIGGER IF NOT EXISTS tickets_fts_ai AFTER INSERT ON tickets BEGIN
+  INSERT INTO tickets_fts(rowid, summary, rendered_text) VALUES (new.rowid, new.summary, new.rendered_text);
+END;
+CREATE TRIGGER IF NOT EXISTS tickets_fts_ad AFTER DELETE ON tickets BEGIN
+  INSERT INTO tickets_fts(tickets_fts, rowid, summary, rendered_text)
+  VALUES ('delete', old.rowid, old.summary, old.rendered_text);
+END;
+CREATE TRIGGER IF NOT EXISTS tickets_fts_au AFTER UPDATE OF summary, rendered_text ON tickets BEGIN
+  INSERT INTO tickets_fts(tickets_fts, rowid, summary, rendered_text)
+  VALUES ('delete', old.rowid, old.summary, old.rendered_text);
+  INSERT INTO tickets_fts(rowid, summary, rendered_text) VALUES (new.rowid, new.summary, new.rendered_text);
+END;
+
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+  content, content='messages', tokenize='porter unicode61'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+  INSERT INTO messages_fts(rowid, content) VALUES (new.rowid, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+  INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+  INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+  INSERT INTO messages_fts(rowid, content) VALUES (new.rowid, new.content);
+END;
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""Concurrent /chat throughput benchmark against the in-process app (mock LLM).
+
+Runs the same workload with DB calls made inline on the event loop
+(TIER1_SQLITE_ASYNC=false, the old behavior) and on the DB executor, and
+prints requests/sec and latency percentiles for each.
+
+``--contention-ms`` adds a background writer that repeatedly holds the
+database write lock, the way another uvicorn worker or a batch job sharing the
+org DB file does; inline, every chat that has to wait for that lock stalls
+the whole event loop.
+
+``--stream`` instead compares time to first token of /chat (the whole answer)
+and /chat/stream, served by uvicorn on a local port so responses really stream.
+
+Example:
+  python scripts/bench_chat.py --requests 400 --concurrency 50 --llm-latency 0.05 --contention-ms 20
+  python scripts/bench_chat.py --stream --requests 100 --concurrency 10 --llm-latency 1.0
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import httpx
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from app.core.config import settings  # noqa: E402
+from app.core.db import close_pools, connect, init_schema  # noqa: E402
+from app.main import app  # noqa: E402
+
+MESSAGE = "\n".join(
+    [
+        "My VPN keeps failing to connect from home",
+        "os: Windows 11",
+        "device_type: company laptop",
+        "network_type: home wifi",
+        "error_message: 809",
+        "mfa_working: yes",
+    ]
+)
+
+
+async def _run(n_requests: int, concurrency: int) -> tuple[float, list[float]]:
+    transport = httpx.ASGITransport(app=app)
+    sem = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+
+        async def one(i: int) -> None:
+            async with sem:
+                t0 = time.perf_counter()
+                r = await client.post("/chat", json={"org_id": "bench-org", "user_id": f"user-{i % 50}", "message": MESSAGE})
+                r.raise_for_status()
+                latencies.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(n_requests)))
+        return time.perf_counter() - t0, latencies
+
+
+async def _run_ttft(base_url: str, path: str, n_requests: int, concurrency: int) -> tuple[float, list[float]]:
+    """Time until the first byte of the answer: a token event for /chat/stream, the body for /chat."""
+    sem = asyncio.Semaphore(concurrency)
+    ttfts: list[float] = []
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+
+        async def one(i: int) -> None:
+            async with sem:
+                body = {"org_id": "bench-org", "user_id": f"user-{i % 50}", "message": MESSAGE}
+                t0 = time.perf_counter()
+                async with client.stream("POST", path, json=body) as r:
+                    r.raise_for_status()
+                    first = None
+                    async for line in r.aiter_lines():
+                        if first is None and (path == "/chat" or line.startswith("event: token")):
+                            first = time.perf_counter() - t0
+                    ttfts.append(first if first is not None else time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(n_requests)))
+        return time.perf_counter() - t0, ttfts
+
+
+def _bench_stream(args: argparse.Namespace) -> None:
+    import uvicorn
+
+    settings.sqlite_path = args.db or str(Path(tempfile.mkdtemp(prefix="pin-bench-")) / "pin.db")
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        for label, path in (("/chat", "/chat"), ("/chat/stream", "/chat/stream")):
+            asyncio.run(_run_ttft(base_url, path, 5, 5))  # warm up
+            elapsed, ttfts = asyncio.run(_run_ttft(base_url, path, args.requests, args.concurrency))
+            _report(f"{label} ttft", elapsed, ttfts)
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+def _hold_write_lock(path: str, hold_s: float, stop: threading.Event) -> None:
+    conn = connect(path)
+    try:
+        while not stop.is_set():
+            conn.execute("BEGIN IMMEDIATE")
+            time.sleep(hold_s)
+            conn.commit()
+            time.sleep(hold_s)
+    finally:
+        conn.close()
+
+
+def _report(label: str, elapsed: float, latencies: list[float]) -> None:
+    lat = sorted(latencies)
+    p = lambda q: lat[min(len(lat) - 1, int(q * len(lat)))] * 1000  # noqa: E731
+    print(
+        f"{label:<18} {len(lat) / elapsed:8.1f} req/s   "
+        f"p50 {p(0.50):7.1f}ms  p95 {p(0.95):7.1f}ms  p99 {p(0.99):7.1f}ms  mean {statistics.mean(lat) * 1000:7.1f}ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark concurrent /chat turns with the mock LLM")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Mock LLM response time in seconds")
+    parser.add_argument("--db", default=None, help="SQLite file to use (default: a fresh temp file per mode)")
+    parser.add_argument(
+        "--contention-ms",
+        type=float,
+        default=0.0,
+        help="Hold the DB write lock for this long, every other interval, from a second connection",
+    )
+    parser.add_argument("--stream", action="store_true", help="Compare time to first token of /chat and /chat/stream")
+    args = parser.parse_args()
+
+    settings.llm_provider = "mock"
+    settings.mock_llm_latency_s = args.llm_latency
+    if args.stream:
+        _bench_stream(args)
+        return
+    for label, use_executor in (("inline sqlite3", False), ("db executor", True)):
+        settings.sqlite_async = use_executor
+        settings.sqlite_path = args.db or str(Path(tempfile.mkdtemp(prefix="pin-bench-")) / "pin.db")
+        init_schema()
+        asyncio.run(_run(10, 5))  # warm up: index load, connections, statement cache
+        stop = threading.Event()
+        holder = None
+        if args.contention_ms > 0:
+            holder = threading.Thread(
+                target=_hold_write_lock, args=(settings.sqlite_path, args.contention_ms / 1000, stop), daemon=True
+            )
+            holder.start()
+        try:
+            elapsed, latencies = asyncio.run(_run(args.requests, args.concurrency))
+        finally:
+            stop.set()
+            if holder is not None:
+                holder.join()
+        _report(label, elapsed, latencies)
+        close_pools()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Local stand-in for an OpenAI-compatible chat completions endpoint (load tests, client checks).
+
+Answers every request with a canned completion after an optional delay (streamed word by word
+as server-sent events when the request has ``"stream": true``). It also counts the TCP
+connections it accepted, which shows whether the API reuses its connections.
+
+Example:
+  python scripts/fake_openai.py --port 8001 --latency-ms 300
+  TIER1_LLM_PROVIDER=openai TIER1_OPENAI_API_KEY=x TIER1_OPENAI_BASE_URL=http://127.0.0.1:8001/v1 \\
+    uvicorn app.main:app
+  curl localhost:8001/stats
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import re
+import time
+import uuid
+from typing import Any, AsyncIterator
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+
+def create_app(*, latency_s: float = 0.0) -> FastAPI:
+    app = FastAPI(title="fake-openai")
+    stats = {"requests": 0, "connections": 0}
+    seen: set[tuple[str, int]] = set()
+
+    @app.middleware("http")
+    async def count_connections(request: Request, call_next: Any) -> Any:
+        if request.client is not None:
+            peer = (request.client.host, request.client.port)
+            if peer not in seen:  # a new client port = a new TCP connection
+                seen.add(peer)
+                stats["connections"] += 1
+        return await call_next(request)
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(body: dict[str, Any]) -> Any:
+        stats["requests"] += 1
+        user = next((m.get("content", "") for m in reversed(body.get("messages", [])) if m.get("role") == "user"), "")
+        content = f"(FAKE) 1. Restart the client. 2. Reconnect. ({len(user)} chars in)"
+        head = {"id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "created": int(time.time()), "model": body.get("model", "fake")}
+        if body.get("stream"):
+            return StreamingResponse(_events(head, content), media_type="text/event-stream")
+        if latency_s > 0:
+            await asyncio.sleep(latency_s)
+        return {
+            **head,
+            "object": "chat.completion",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        }
+
+    async def _events(head: dict[str, Any], content: str) -> AsyncIterator[str]:
+        words = re.findall(r"\s*\S+\s*", content)
+        first = {**head, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"role": "assistant"}}]}
+        yield f"data: {json.dumps(first)}\n\n"
+        for word in words:
+            if latency_s > 0:
+                await asyncio.sleep(latency_s / len(words))
+            chunk = {**head, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": word}}]}
+            yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    @app.get("/stats")
+    def get_stats() -> dict[str, int]:
+        return stats
+
+    return app
+
+
+def main() -> None:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="delay before each completion")
+    args = parser.parse_args()
+    uvicorn.run(create_app(latency_s=args.latency_ms / 1000.0), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
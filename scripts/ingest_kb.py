@@ -6,14 +6,29 @@ sys.path.insert(0, str(_Path(__file__).resolve().parents[1]))
 
 
 import argparse
+import hashlib
+import json
+import os
 import pickle
-from dataclasses import asdict
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Any, Iterable, Iterator, Sequence
 
-from sklearn.feature_extraction.text import TfidfVectorizer
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
 
 from app.core.config import settings
-from app.rag.index import DocChunk, RagIndex
+from app.rag.bm25 import build_bm25, write_bm25
+from app.rag.compact import find_duplicates, overlap_at_k
+from app.rag.index import DocChunk, RagIndex, index_path, prepare_matrix, retrieve_many
+from app.rag.sharded import write_sharded
+from app.rag.store import ChunkSpool, iter_texts, open_index, write_index
 
 
 def chunk_text(text: str, max_chars: int = 1600, overlap: int = 200) -> list[str]:
@@ -41,52 +56,471 @@ def chunk_text(text: str, max_chars: int = 1600, overlap: int = 200) -> list[str
     return chunks
 
 
-def main() -> None:
-    parser = argparse.ArgumentParser(description="Build TF-IDF RAG index from knowledge/*.md")
-    parser.add_argument("--kb", default=settings.kb_dir, help="KB directory")
-    parser.add_argument("--out", default=settings.rag_index_path, help="Output pickle path")
-    args = parser.parse_args()
+MANIFEST_FILE = "manifest.json"
 
-    kb_dir = Path(args.kb)
-    if not kb_dir.exists():
-        raise SystemExit(f"KB dir not found: {kb_dir.resolve()}")
 
-    files = sorted(kb_dir.glob("**/*.md"))
-    if not files:
-        raise SystemExit(f"No markdown files found under: {kb_dir.resolve()}")
-
-    chunks: list[DocChunk] = []
-    for fp in files:
-        title = fp.stem.replace("_", " ")
-        text = fp.read_text(encoding="utf-8", errors="ignore")
-        for idx, ch in enumerate(chunk_text(text)):
-            chunks.append(
-                DocChunk(
-                    source_id=f"{fp.as_posix()}#{idx}",
-                    title=title,
-                    text=ch,
-                    metadata={"path": fp.as_posix()},
-                )
-            )
+class StageTimer:
+    """Accumulates wall-clock seconds per pipeline stage."""
+
+    def __init__(self) -> None:
+        self.seconds: dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        self.seconds.setdefault(name, 0.0)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def add(self, name: str, seconds: float) -> None:
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def report(self, n_chunks: int, total_s: float) -> str:
+        lines = ["Stage timings:"]
+        for name, sec in self.seconds.items():
+            lines.append(f"  {name:<16} {sec:8.2f}s")
+        rate = n_chunks / total_s if total_s > 0 else 0.0
+        lines.append(f"  {'total':<16} {total_s:8.2f}s  ({rate:,.0f} chunks/s)")
+        return "\n".join(lines)
+
+
+def discover(kb_dir: Path) -> Iterator[Path]:
+    yield from sorted(kb_dir.glob("**/*.md"))
+
+
+def file_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def chunk_file(fp: Path, text: str) -> list[DocChunk]:
+    title = fp.stem.replace("_", " ")
+    return [
+        DocChunk(
+            source_id=f"{fp.as_posix()}#{idx}",
+            title=title,
+            text=ch,
+            metadata={"path": fp.as_posix()},
+        )
+        for idx, ch in enumerate(chunk_text(text))
+    ]
+
+
+@dataclass
+class LoadedFile:
+    path: str
+    digest: str
+    chunks: list[DocChunk] | None  # None when the digest matched and chunking was skipped
+    read_s: float
+    chunk_s: float
+
+
+def load_file(path: str, known_digest: str | None = None) -> LoadedFile:
+    """Read, hash and chunk one file (runs in the worker pool)."""
+    t0 = time.perf_counter()
+    data = Path(path).read_bytes()
+    digest = file_digest(data)
+    t1 = time.perf_counter()
+    chunks = None
+    if digest != known_digest:
+        chunks = chunk_file(Path(path), data.decode("utf-8", errors="ignore"))
+    return LoadedFile(path, digest, chunks, t1 - t0, time.perf_counter() - t1)
+
 
-    corpus = [c.text for c in chunks]
+def load_files(paths: Iterable[Path], known: dict[str, str], workers: int) -> Iterator[LoadedFile]:
+    """Fan ``load_file`` out over a process pool, yielding results in input order.
+
+    At most ``workers * 4`` files are in flight, so memory stays bounded
+    however many files the KB has.
+    """
+    if workers <= 1:
+        for p in paths:
+            yield load_file(p.as_posix(), known.get(p.as_posix()))
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending: deque = deque()
+        for p in paths:
+            pending.append(pool.submit(load_file, p.as_posix(), known.get(p.as_posix())))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def fit_tfidf(chunks: Sequence[DocChunk], min_df: float = 1, max_df: float = 1.0):
     vectorizer = TfidfVectorizer(
         lowercase=True,
         stop_words="english",
         max_features=150_000,
         ngram_range=(1, 2),
+        min_df=min_df,
+        max_df=max_df,
     )
-    matrix = vectorizer.fit_transform(corpus)
+    matrix = vectorizer.fit_transform(iter_texts(chunks))
+    return vectorizer, matrix
+
+
+@dataclass
+class BuildOptions:
+    backend: str = "tfidf"
+    shards: int = 4  # hashed backend only
+    hash_features: int = 2**21  # hashed backend only
+    # Compaction
+    dedupe: bool = False
+    near_dup_threshold: float = 0.9
+    min_df: float = 1  # tfidf/bm25: drop terms in fewer chunks (int) or a smaller fraction (float)
+    max_df: float = 1.0  # tfidf/bm25: drop terms in more chunks than this
+    dtype: str = "float32"  # stored weights (tfidf/hashed)
+
+
+def write_backend(out_path: Path, opts: BuildOptions, chunks: Sequence[DocChunk], timer: StageTimer) -> str:
+    """Full fit + write of ``chunks`` for ``opts.backend``. Returns the version id."""
+    if opts.backend == "hashed":
+        # Hashing has no fit step; tokenize+weight+write happen shard by shard.
+        with timer.stage("tokenize+write"):
+            return write_sharded(
+                out_path, chunks, n_shards=opts.shards, n_features=opts.hash_features, dtype=opts.dtype
+            )
+    if opts.backend == "bm25":
+        with timer.stage("tokenize+fit"):
+            counter = CountVectorizer(lowercase=True, stop_words="english", min_df=opts.min_df, max_df=opts.max_df)
+            index = build_bm25(chunks, vectorizer=counter)
+        with timer.stage("write"):
+            return write_bm25(out_path, index)
+    with timer.stage("tokenize+fit"):
+        vectorizer, matrix = fit_tfidf(chunks, opts.min_df, opts.max_df)
+    with timer.stage("write"):
+        return write_index(out_path, vectorizer, matrix, chunks, dtype=opts.dtype)
+
+
+def dedupe(out_path: Path, spool: ChunkSpool, opts: BuildOptions, timer: StageTimer) -> tuple[ChunkSpool, dict[int, int]]:
+    """Drop exact and near-duplicate chunks. Returns (kept chunks, duplicate row -> kept row)."""
+    with timer.stage("dedupe"):
+        dup_of = find_duplicates(spool.texts(), threshold=opts.near_dup_threshold)
+        if not dup_of:
+            return spool, {}
+        kept = _spool(out_path)
+        for i in range(len(spool)):
+            if i not in dup_of:
+                kept.append(spool[i])
+        kept.close()
+    print(f"Dedupe: dropped {len(dup_of)} duplicate chunks ({len(spool)} -> {len(kept)})")
+    return kept, dup_of
+
+
+def _matrix_bytes(m: Any) -> int:
+    return int(m.data.nbytes + m.indices.nbytes + m.indptr.nbytes)
+
+
+def check_compaction(out_path: Path, all_chunks: Sequence[DocChunk], dup_of: dict[int, int], probes: int = 200) -> None:
+    """Compare the compacted index just written against an uncompacted in-memory build.
+
+    Prints sizes and the top-k overlap on probe queries taken from chunk
+    openings. A reference hit on a dropped duplicate counts as found when
+    the chunk it duplicates is returned.
+    """
+    ref_vec, ref_matrix = fit_tfidf(all_chunks)
+    ref = RagIndex(vectorizer=ref_vec, matrix=prepare_matrix(ref_matrix), chunks=all_chunks)
+    new = open_index(out_path)
+
+    rows = np.random.default_rng(0).choice(len(all_chunks), size=min(probes, len(all_chunks)), replace=False)
+    queries = [" ".join(all_chunks[int(r)].text.split()[:20]) for r in rows]
+    canonical = {all_chunks[d].source_id: all_chunks[k].source_id for d, k in dup_of.items()}
+    ref_ids = [[canonical.get(c.source_id, c.source_id) for c in cits] for cits, _ in retrieve_many(ref, queries)]
+    new_ids = [[c.source_id for c in cits] for cits, _ in retrieve_many(new, queries)]
+
+    print("Compaction check (vs. uncompacted float64 build):")
+    print(f"  chunks      {len(all_chunks):>12,} -> {len(new.chunks):,}")
+    print(f"  vocabulary  {len(ref_vec.vocabulary_):>12,} -> {len(new.vectorizer.vocabulary):,} terms")
+    print(f"  matrix      {_matrix_bytes(ref.matrix) / 1e6:>10.2f}MB -> {_matrix_bytes(new.matrix) / 1e6:.2f}MB")
+    print(f"  top-{settings.rag_top_k} overlap on {len(queries)} probe queries: {overlap_at_k(ref_ids, new_ids):.1%}")
+
+
+def load_manifest(out_path: Path) -> dict[str, Any] | None:
+    p = out_path / MANIFEST_FILE
+    if not p.exists():
+        return None
+    return json.loads(p.read_text(encoding="utf-8"))
+
 
-    out_path = Path(args.out)
-    out_path.parent.mkdir(parents=True, exist_ok=True)
+def write_manifest(out_path: Path, manifest: dict[str, Any]) -> None:
+    tmp = out_path / f".{MANIFEST_FILE}.tmp"
+    tmp.write_text(json.dumps(manifest, indent=2, sort_keys=True), encoding="utf-8")
+    os.replace(tmp, out_path / MANIFEST_FILE)
 
-    index = RagIndex(vectorizer=vectorizer, matrix=matrix, chunks=chunks)
-    with out_path.open("wb") as f:
-        pickle.dump(index, f)
 
-    print(f"Indexed {len(chunks)} chunks from {len(files)} files")
-    print(f"Wrote: {out_path.resolve()}")
+def _spool(out_path: Path) -> ChunkSpool:
+    return ChunkSpool(out_path / f".spool-{uuid.uuid4().hex}")
+
+
+def full_build(
+    out_path: Path, opts: BuildOptions, kb_dir: Path, workers: int, timer: StageTimer, check: bool = False
+) -> tuple[str, int, int]:
+    """Re-chunk every file and refit from scratch. Returns (version, n_chunks, n_files).
+
+    Chunks stream from the worker pool into an on-disk spool and the
+    vectorizer reads them back from there, so chunk texts are never all in
+    memory at once; the fitted vocabulary and matrix (and the chunk ids for
+    the manifest) still are.
+    """
+    files: dict[str, Any] = {}
+    spool = _spool(out_path)
+    try:
+        with timer.stage("read+chunk"):
+            for lf in load_files(discover(kb_dir), {}, workers):
+                assert lf.chunks is not None
+                for c in lf.chunks:
+                    spool.append(c)
+                files[lf.path] = {"sha256": lf.digest, "chunks": [c.source_id for c in lf.chunks]}
+                timer.add("  read (cpu)", lf.read_s)
+                timer.add("  chunk (cpu)", lf.chunk_s)
+        spool.close()
+        if not files:
+            raise SystemExit(f"No markdown files found under: {kb_dir.resolve()}")
+        kept, dup_of = dedupe(out_path, spool, opts, timer) if opts.dedupe else (spool, {})
+        try:
+            version = write_backend(out_path, opts, kept, timer)
+            if check:
+                check_compaction(out_path, spool, dup_of)
+            n_chunks = len(kept)
+        finally:
+            if kept is not spool:
+                kept.remove()
+    finally:
+        spool.remove()
+
+    write_manifest(
+        out_path,
+        {"backend": opts.backend, "version": version, "files": files, "fitted_rows": n_chunks, "stale_rows": 0},
+    )
+    return version, n_chunks, len(files)
+
+
+def incremental_build(
+    out_path: Path, opts: BuildOptions, kb_dir: Path, workers: int, timer: StageTimer, compact_ratio: float
+) -> tuple[str, int, int] | None:
+    """Re-chunk only added/changed files and splice them into the current index.
+
+    Rows of changed/deleted files are dropped and new rows are appended. For
+    TF-IDF the new rows are vectorized with the existing vocabulary and IDF;
+    once appended+dropped rows exceed ``compact_ratio`` of the fitted rows the
+    index is compacted with a full refit instead. BM25 statistics are cheap to
+    recount and the hashed index has nothing to fit, so those always rebuild
+    from the spliced chunks (but still only re-chunk what changed).
+
+    This saves the read/chunk and fit work, not the write: every run still
+    writes a complete new index version (all kept rows are copied), so I/O is
+    O(KB) per run. ``--dedupe`` is not supported here (``main`` rejects it).
+
+    Returns None when there is no usable previous build (caller falls back to
+    a full build).
+    """
+    manifest = load_manifest(out_path)
+    try:
+        previous = open_index(out_path)
+    except (FileNotFoundError, ValueError):
+        return None
+    backend = opts.backend
+    if not manifest or manifest.get("backend") != backend or manifest.get("version") != previous.version:
+        return None
+
+    old_files: dict[str, Any] = manifest["files"]
+    known = {p: v["sha256"] for p, v in old_files.items()}
+    seen: set[str] = set()
+    changed: dict[str, Any] = {}
+    new_spool = _spool(out_path)
+    spool = _spool(out_path)
+    try:
+        with timer.stage("read+chunk"):
+            for lf in load_files(discover(kb_dir), known, workers):
+                seen.add(lf.path)
+                timer.add("  read (cpu)", lf.read_s)
+                timer.add("  chunk (cpu)", lf.chunk_s)
+                if lf.chunks is None:
+                    continue
+                for c in lf.chunks:
+                    new_spool.append(c)
+                changed[lf.path] = {"sha256": lf.digest, "chunks": [c.source_id for c in lf.chunks]}
+        new_spool.close()
+        if not seen:
+            raise SystemExit(f"No markdown files found under: {kb_dir.resolve()}")
+        deleted = set(old_files) - seen
+        dirty = set(changed) | deleted
+        if not dirty:
+            print("KB unchanged; index is up to date")
+            return previous.version, len(previous.chunks), len(seen)
+
+        keep_rows = [
+            i for i in range(len(previous.chunks)) if previous.chunks.field("source_id", i).rsplit("#", 1)[0] not in dirty
+        ]
+        dropped = len(previous.chunks) - len(keep_rows)
+        for i in keep_rows:
+            spool.append(previous.chunks[i])
+        for i in range(len(new_spool)):
+            spool.append(new_spool[i])
+        spool.close()
+        print(f"Incremental: {len(changed)} added/changed, {len(deleted)} deleted; -{dropped} +{len(new_spool)} chunks")
+
+        stale = int(manifest.get("stale_rows", 0)) + dropped + len(new_spool)
+        fitted = int(manifest.get("fitted_rows", 0)) or 1
+        if backend != "tfidf" or stale / fitted > compact_ratio:
+            if backend == "tfidf":
+                print(f"Compacting: {stale} rows changed since the last fit (> {compact_ratio:.0%}); refitting IDF")
+            version = write_backend(out_path, opts, spool, timer)
+            stale, fitted = 0, len(spool)
+        else:
+            with timer.stage("tokenize"):
+                kept = sp.csr_matrix(previous.matrix)[keep_rows]
+                added = previous.vectorizer.transform(new_spool.texts())
+                matrix = sp.vstack([kept, added], format="csr")
+            with timer.stage("write"):
+                version = write_index(out_path, previous.vectorizer, matrix, spool, dtype=str(previous.matrix.dtype))
+        n_chunks = len(spool)
+    finally:
+        new_spool.remove()
+        spool.remove()
+
+    files_out = {p: v for p, v in old_files.items() if p not in dirty}
+    files_out.update(changed)
+    write_manifest(
+        out_path,
+        {
+            "backend": backend,
+            "version": version,
+            "files": dict(sorted(files_out.items())),
+            "fitted_rows": fitted,
+            "stale_rows": stale,
+        },
+    )
+    return version, n_chunks, len(seen)
+
+
+def _df_bound(value: str) -> float:
+    """argparse type for --min-df/--max-df: an int is a chunk count, a float a fraction."""
+    return float(value) if "." in value else int(value)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Build the RAG index (TF-IDF, BM25 or sharded hashing) from knowledge/*.md")
+    parser.add_argument("--kb", default=settings.kb_dir, help="KB directory")
+    parser.add_argument(
+        "--backend",
+        choices=["tfidf", "bm25", "hashed"],
+        default=settings.rag_backend,
+        help="Retrieval engine to build for (default: TIER1_RAG_BACKEND)",
+    )
+    parser.add_argument("--out", default=None, help="Output index directory (or .pkl path with --format pickle)")
+    parser.add_argument(
+        "--format",
+        choices=["mmap", "pickle"],
+        default="mmap",
+        help="mmap: memory-mapped directory shared by all workers (default); pickle: legacy single file",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=(
+            "Only re-chunk files whose content hash changed since the last build (see manifest.json). "
+            "Still writes a complete new index version each run. tfidf reuses the fitted vocabulary/IDF "
+            "until --compact-ratio; bm25 and hashed always refit. Cannot be combined with --dedupe"
+        ),
+    )
+    parser.add_argument(
+        "--compact-ratio",
+        type=float,
+        default=0.25,
+        help="With --incremental: refit from scratch once this fraction of rows changed since the last fit",
+    )
+    parser.add_argument("--compact", action="store_true", help="With --incremental: force a full refit")
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=4,
+        help="With --backend hashed: number of shard files to split the chunks into",
+    )
+    parser.add_argument(
+        "--hash-features",
+        type=int,
+        default=2**21,
+        help="With --backend hashed: number of hash buckets (more buckets = fewer term collisions)",
+    )
+    parser.add_argument("--dedupe", action="store_true", help="Drop exact and near-duplicate chunks (MinHash) before fitting")
+    parser.add_argument(
+        "--near-dup-threshold",
+        type=float,
+        default=0.9,
+        help="With --dedupe: estimated shingle Jaccard similarity at which chunks count as duplicates",
+    )
+    parser.add_argument("--min-df", type=_df_bound, default=1, help="Prune terms in fewer chunks (int) or fraction (float)")
+    parser.add_argument("--max-df", type=_df_bound, default=1.0, help="Prune terms in more chunks (int) or fraction (float)")
+    parser.add_argument(
+        "--dtype",
+        choices=["float32", "float64"],
+        default="float32",
+        help="Stored TF-IDF weight type (tfidf/hashed)",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="tfidf full builds: print size and top-k overlap against an uncompacted reference build",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Processes used to read and chunk files (default: CPU count; 1 = no pool)",
+    )
+    args = parser.parse_args()
+
+    if args.incremental and args.dedupe:
+        parser.error("--dedupe needs a full build; it cannot be combined with --incremental")
+
+    kb_dir = Path(args.kb)
+    if not kb_dir.exists():
+        raise SystemExit(f"KB dir not found: {kb_dir.resolve()}")
+
+    out_path = Path(args.out or index_path(args.backend))
+    if args.format == "pickle":
+        if args.backend != "tfidf" or args.incremental:
+            raise SystemExit("--format pickle only supports a full tfidf build")
+        files = list(discover(kb_dir))
+        if not files:
+            raise SystemExit(f"No markdown files found under: {kb_dir.resolve()}")
+        chunks = [c for fp in files for c in chunk_file(fp, fp.read_text(encoding="utf-8", errors="ignore"))]
+        vectorizer, matrix = fit_tfidf(chunks)
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        with out_path.open("wb") as f:
+            pickle.dump(RagIndex(vectorizer=vectorizer, matrix=matrix, chunks=chunks), f)
+        print(f"Indexed {len(chunks)} chunks from {len(files)} files")
+        print(f"Wrote: {out_path.resolve()}")
+        return
+
+    opts = BuildOptions(
+        backend=args.backend,
+        shards=args.shards,
+        hash_features=args.hash_features,
+        dedupe=args.dedupe,
+        near_dup_threshold=args.near_dup_threshold,
+        min_df=args.min_df,
+        max_df=args.max_df,
+        dtype=args.dtype,
+    )
+    timer = StageTimer()
+    t0 = time.perf_counter()
+    result = None
+    if args.incremental and not args.compact:
+        result = incremental_build(out_path, opts, kb_dir, args.workers, timer, args.compact_ratio)
+        if result is None:
+            print("No compatible previous build; doing a full build")
+    if result is None:
+        result = full_build(out_path, opts, kb_dir, args.workers, timer, check=args.check and opts.backend == "tfidf")
+    version, n_chunks, n_files = result
+    total_s = time.perf_counter() - t0
+
+    print(f"Indexed {n_chunks} chunks from {n_files} files ({args.backend}, workers={args.workers})")
+    print(f"Wrote: {out_path.resolve()} (version {version})")
+    print(timer.report(n_chunks, total_s))
 
 
 if __name__ == "__main__":
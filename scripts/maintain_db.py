@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""Run database maintenance once: close idle sessions, archive old closed ones, vacuum/analyze.
+
+For cron, when the API runs with TIER1_MAINTENANCE_INTERVAL_S=0.
+
+Example:
+  python scripts/maintain_db.py
+  python scripts/maintain_db.py --db /var/pin/acme/pin.db --idle-ttl-s 3600 --archive-after-days 30
+  python scripts/maintain_db.py --db data/pin.db --vacuum-full   # one-off, takes the write lock
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from app.core.config import settings  # noqa: E402
+from app.core.db import FTS_TABLES, close_pools, connection  # noqa: E402
+from app.core.maintenance import maintenance_paths, run_maintenance  # noqa: E402
+
+
+def vacuum_full(path: str) -> None:
+    """Rewrite ``path`` with incremental auto-vacuum enabled (databases created before it was the default)."""
+    with connection(path) as conn:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        # VACUUM may renumber the implicit rowids the FTS indexes point at.
+        for table in FTS_TABLES:
+            conn.execute(f"INSERT INTO {table}({table}) VALUES('rebuild')")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Close idle sessions, archive old transcripts, vacuum/analyze")
+    parser.add_argument("--db", action="append", help="SQLite file (repeatable; default: every live database)")
+    parser.add_argument("--idle-ttl-s", type=float, default=None, help="override TIER1_SESSION_IDLE_TTL_S")
+    parser.add_argument("--archive-after-days", type=float, default=None, help="override TIER1_ARCHIVE_AFTER_DAYS")
+    parser.add_argument("--archive-dir", default=None, help="override TIER1_ARCHIVE_DIR")
+    parser.add_argument("--vacuum-full", action="store_true", help="full VACUUM instead of the incremental one")
+    args = parser.parse_args()
+
+    if args.idle_ttl_s is not None:
+        settings.session_idle_ttl_s = args.idle_ttl_s
+    if args.archive_after_days is not None:
+        settings.archive_after_days = args.archive_after_days
+    if args.archive_dir:
+        settings.archive_dir = args.archive_dir
+    paths = args.db or maintenance_paths()
+    t0 = time.perf_counter()
+    try:
+        for path, counts in run_maintenance(paths).items():
+            if args.vacuum_full:
+                vacuum_full(path)
+            print(path, " ".join(f"{k}={v}" for k, v in counts.items()))
+    finally:
+        close_pools()
+    print(f"Done in {time.perf_counter() - t0:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
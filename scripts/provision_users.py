@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Bulk-provision an org's departments and users from a CSV/LDAP export.
+
+Example:
+  python scripts/provision_users.py --org acme --org-name "Acme Corp" --csv users.csv
+  python scripts/provision_users.py --db /var/pin/acme/pin.db --org acme --csv ad_export.csv
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from app.core.config import settings  # noqa: E402
+from app.core.db import close_pools, init_schema, org_db_path, use_org_db  # noqa: E402
+from app.core.provision import ProvisionError, provision, read_roster  # noqa: E402
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load departments and users into an org database")
+    parser.add_argument("--csv", required=True, help="CSV with user_id/uid, first_name/givenName, ... columns")
+    parser.add_argument("--org", required=True, help="org_id the users belong to")
+    parser.add_argument("--org-name", default=None)
+    parser.add_argument(
+        "--db",
+        default=None,
+        help="SQLite file (default: the org's file under TIER1_ORG_DB_DIR in per-org mode, else TIER1_SQLITE_PATH)",
+    )
+    parser.add_argument("--schema", default="data/schema.sql")
+    args = parser.parse_args()
+
+    if args.db:
+        settings.sqlite_path = args.db
+        settings.sqlite_routing = "single"
+    path = org_db_path(args.org)
+    init_schema(args.schema, path=path)
+    t0 = time.perf_counter()
+    try:
+        with open(args.csv, newline="", encoding="utf-8-sig") as f:
+            roster = read_roster(f)
+        with use_org_db(args.org):
+            counts = provision(args.org, roster, org_name=args.org_name)
+    except ProvisionError as e:
+        raise SystemExit(f"{args.csv}: {e}")
+    finally:
+        close_pools()
+    print(
+        f"Provisioned {counts['users']} users and {counts['departments']} departments "
+        f"for {args.org} in {time.perf_counter() - t0:.2f}s -> {path}"
+    )
+
+
+if __name__ == "__main__":
+    main()
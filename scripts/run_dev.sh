@@ -1,4 +1,4 @@
 #!/usr/bin/env bash
 set -euo pipefail
-python scripts/ingest_kb.py
+python scripts/ingest_kb.py --incremental
 exec uvicorn app.main:app --reload --port 8000
@@ -0,0 +1,17 @@
+import pytest
+
+from app.core import db
+from app.core.config import settings
+from app.core.message_log import message_log
+from app.llm.cache import answer_cache
+
+
+@pytest.fixture
+def org_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "sqlite_path", str(tmp_path / "org.db"))
+    monkeypatch.setattr(settings, "admin_token", "test-admin")
+    db.init_schema()
+    yield tmp_path / "org.db"
+    answer_cache.clear()
+    message_log.close()
+    db.close_pools()
@@ -0,0 +1,565 @@
+import threading
+
+import pytest
+
+from app.core import db
+from app.core.config import settings
+from app.core.message_log import message_log
+
+ADMIN = {"authorization": "Bearer test-admin"}
+
+
+def test_pool_reuses_connection_per_thread_and_rolls_back(org_db):
+    from app.core.repository import ensure_org
+
+    with db.connection() as a, db.connection() as b:
+        assert a is b
+    other = []
+    t = threading.Thread(target=lambda: other.append(db.get_pool().connection().__enter__()))
+    t.start()
+    t.join()
+    assert other[0] is not a
+    assert db.get_pool().stats()["opened"] == 2
+
+    ensure_org("acme")
+    with pytest.raises(RuntimeError):
+        with db.connection() as conn:
+            conn.execute("INSERT INTO orgs(org_id, name) VALUES('globex', 'Globex')")
+            raise RuntimeError("boom")
+    with db.connection() as conn:
+        assert [r["org_id"] for r in conn.execute("SELECT org_id FROM orgs")] == ["acme"]
+
+
+def test_pool_reopens_connection_that_fails_health_check(org_db, monkeypatch):
+    pool = db.get_pool()
+    pool.health_check_s = 0.0
+    with pool.connection() as conn:
+        pass
+    conn.close()  # simulate a dead handle
+    with pool.connection() as fresh:
+        assert fresh is not conn
+        fresh.execute("SELECT 1")
+    assert pool.reopened == 1
+
+
+def test_unit_of_work_commits_once_or_not_at_all(org_db):
+    from app.core.session import load_session, new_session
+    from app.core.uow import unit_of_work
+
+    with pytest.raises(RuntimeError):
+        with unit_of_work() as uow:
+            uow.ensure_org("acme")
+            uow.ensure_user(org_id="acme", user_id="u1")
+            raise RuntimeError("LLM down")
+    with db.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM orgs").fetchone()[0] == 0
+
+    with unit_of_work() as uow:
+        uow.ensure_org("acme")
+        uow.ensure_user(org_id="acme", user_id="u1")
+        state = new_session(org_id="acme", user_id="u1", save=False)
+        uow.save_session(state)
+        uow.insert_message(session_id=state.session_id, role="user", content="vpn down")
+        state.turns = 1
+        uow.save_session(state)
+        assert uow.pending == 4
+    assert load_session(state.session_id).turns == 1
+    assert message_log.flush()
+    with db.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 1
+
+
+def test_async_repository_runs_off_the_event_loop(org_db):
+    import asyncio
+
+    from app.core import aio
+
+    def where() -> str:
+        return threading.current_thread().name
+
+    async def go():
+        await aio.ensure_org("acme")
+        await aio.ensure_user(org_id="acme", user_id="u1")
+        state = await aio.new_session(org_id="acme", user_id="u1")
+        loaded = await aio.load_session(state.session_id)
+        names = await asyncio.gather(db.db_executor.write(where), db.db_executor.read(where))
+        return loaded, names
+
+    loaded, (writer, reader) = asyncio.run(go())
+    assert loaded.user_id == "u1"
+    assert writer.startswith("db-writer") and reader.startswith("db-reader")
+
+
+def test_message_log_group_commits_and_flushes(org_db, monkeypatch):
+    from app.core.message_log import MessageLog
+    from app.core.repository import ensure_org, ensure_user
+    from app.core.session import new_session
+
+    ensure_org("acme")
+    ensure_user(org_id="acme", user_id="u1")
+    sid = new_session(org_id="acme", user_id="u1").session_id
+    log = MessageLog(max_queue=8, batch=50, flush_ms=20)
+    for i in range(100):  # more than max_queue: producers block instead of dropping
+        log.append(session_id=sid, role="user", content=f"line {i}")
+    log.append(session_id="no-such-session", role="user", content="orphan")
+    assert log.flush()
+    log.close()
+    with db.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM messages WHERE session_id=?", (sid,)).fetchone()[0] == 100
+    assert log.written == 100 and log.failed == 1 and log.batches < 100
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_message_log_survives_non_sqlite_errors_and_restarts_a_dead_writer(org_db, monkeypatch):
+    from app.core import repository
+    from app.core.message_log import MessageLog
+    from app.core.session import new_session
+
+    repository.ensure_org("acme")
+    repository.ensure_user(org_id="acme", user_id="u1")
+    sid = new_session(org_id="acme", user_id="u1").session_id
+    real_rows = repository.citation_rows
+
+    def citation_rows(message_id, citations):
+        if any("boom" in c for c in citations):
+            raise TypeError("not a citation")
+        return real_rows(message_id, citations)
+
+    monkeypatch.setattr(repository, "citation_rows", citation_rows)
+    log = MessageLog(max_queue=8, batch=50, flush_ms=20)
+    log.append(session_id=sid, role="user", content="before")
+    log.append(session_id=sid, role="assistant", content="bad", citations=[{"boom": 1}])
+    log.append(session_id=sid, role="user", content="after")
+    assert log.flush(timeout=5)
+    assert log.written == 2 and log.failed == 1 and log._thread.is_alive()
+
+    # Even an error that ends the thread only costs its own batch.
+    real_write = log._write
+    monkeypatch.setattr(log, "_write", lambda batch: (_ for _ in ()).throw(SystemExit()))
+    log.append(session_id=sid, role="user", content="lost")
+    log._thread.join(5)
+    assert not log._thread.is_alive()
+    monkeypatch.setattr(log, "_write", real_write)
+    log.append(session_id=sid, role="user", content="revived")
+    assert log.flush(timeout=5)
+    log.close()
+    with db.connection() as conn:
+        rows = [r[0] for r in conn.execute("SELECT content FROM messages WHERE session_id=? ORDER BY rowid", (sid,))]
+    assert rows == ["before", "after", "revived"] and log.failed == 2
+
+
+def test_session_cache_write_through_and_optimistic_concurrency(org_db):
+    from app.core import session as sessions
+    from app.core.repository import ensure_org, ensure_user
+
+    ensure_org("acme")
+    ensure_user(org_id="acme", user_id="u1")
+    state = sessions.new_session(org_id="acme", user_id="u1")
+    assert state.version == 1
+
+    mine = sessions.load_session(state.session_id)
+    key = (str(org_db), state.session_id)
+    assert mine == state and mine is not sessions.session_cache.get(key)
+    mine.turns += 1
+    assert mine.dirty_columns() == {"turns": 1}
+    sessions.save_session(mine)
+
+    # Another worker (no shared cache) saves the same session in between.
+    theirs = sessions.load_session(state.session_id)
+    sessions.session_cache.clear()
+    mine = sessions.load_session(state.session_id)
+    theirs.collected["os"] = "Windows"
+    sessions.save_session(theirs)
+    sessions.session_cache.put(key, mine.copy())  # this worker's now-stale entry
+
+    assert sessions.load_session(state.session_id).collected == {"os": "Windows"}  # version probe misses
+    mine.turns += 1
+    with pytest.raises(sessions.StaleSessionError):
+        sessions.save_session(mine)
+
+
+def test_init_schema_adds_missing_columns(tmp_path, monkeypatch):
+    import sqlite3
+
+    path = tmp_path / "old.db"
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE sessions (session_id TEXT PRIMARY KEY, org_id TEXT NOT NULL, user_id TEXT NOT NULL,"
+                 " turns INTEGER NOT NULL, category TEXT, status TEXT NOT NULL DEFAULT 'open',"
+                 " collected_json TEXT NOT NULL, steps_attempted_json TEXT NOT NULL,"
+                 " created_at TEXT NOT NULL DEFAULT (datetime('now')), updated_at TEXT NOT NULL DEFAULT (datetime('now')))")
+    conn.execute("INSERT INTO sessions(session_id, org_id, user_id, turns, collected_json, steps_attempted_json)"
+                 " VALUES('s1', 'acme', 'u1', 2, '{}', '[]')")
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(settings, "sqlite_path", str(path))
+    db.init_schema()
+    try:
+        with db.connection() as c:
+            assert c.execute("SELECT version FROM sessions WHERE session_id='s1'").fetchone()[0] == 1
+    finally:
+        db.close_pools()
+
+
+def test_provision_and_identity_cache_skip_upserts(org_db):
+    from fastapi.testclient import TestClient
+
+    from app.core import repository
+    from app.core.uow import UnitOfWork
+    from app.main import app
+
+    repository.identity_cache.clear()
+    uow = UnitOfWork()
+    uow.ensure_org("acme")
+    uow.ensure_user(org_id="acme", user_id="jdoe")
+    assert uow.pending == 2
+
+    export = "uid,givenName,sn,mail,departmentNumber,department\njdoe,Jane,Doe,jdoe@acme.test,7,Finance\nrroe,Rick,Roe,,7,Finance\n"
+    r = TestClient(app, headers=ADMIN).post(
+        "/admin/provision?org_id=acme", content=export, headers={"content-type": "text/csv"}
+    )
+    assert r.status_code == 200 and r.json() == {"orgs": 1, "departments": 1, "users": 2}
+
+    uow = UnitOfWork()
+    uow.ensure_org("acme")
+    uow.ensure_user(org_id="acme", user_id="rroe")
+    assert uow.pending == 0
+    with db.connection() as conn:
+        row = conn.execute("SELECT first_name, dept_id FROM users WHERE user_id='jdoe'").fetchone()
+    assert tuple(row) == ("Jane", 7)
+
+    bad = TestClient(app, headers=ADMIN).post("/admin/provision?org_id=acme", content="name\nx\n")
+    assert bad.status_code == 400
+
+
+def test_provision_writes_user_profiles_through_to_every_shard(org_db, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    from app.core import repository
+    from app.main import app
+
+    monkeypatch.setattr(settings, "session_shards", 3)
+    repository.identity_cache.clear()
+    client = TestClient(app, headers=ADMIN)
+    # jdoe chats first: their session's shard gets a bare user row.
+    assert client.post("/chat", json={"org_id": "acme", "user_id": "jdoe", "message": "vpn is down"}).status_code == 200
+
+    export = "uid,givenName,sn,mail,departmentNumber,department\njdoe,Jane,Doe,jdoe@acme.test,7,Finance\nrroe,Rick,Roe,,7,Finance\n"
+    r = client.post("/admin/provision?org_id=acme", content=export, headers={"content-type": "text/csv"})
+    assert r.status_code == 200
+
+    # rroe chats after provisioning, with a cold identity cache: the upsert keeps the profile.
+    repository.identity_cache.clear()
+    client.post("/chat", json={"org_id": "acme", "user_id": "rroe", "message": "vpn is down"})
+    assert message_log.flush()
+    for path in [str(org_db), *db.session_db_paths()]:
+        with db.connection(path) as conn:
+            rows = conn.execute("SELECT user_id, first_name, email, dept_id FROM users ORDER BY user_id").fetchall()
+            assert [tuple(r) for r in rows] == [("jdoe", "Jane", "jdoe@acme.test", 7), ("rroe", "Rick", None, 7)]
+            assert conn.execute("SELECT dept_name FROM departments").fetchall()[0][0] == "Finance"
+    assert sorted(s["user_id"] for s in repository.list_open_sessions("acme")) == ["jdoe", "rroe"]
+
+
+def test_per_org_routing_creates_files_and_bounds_open_dbs(tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    from app.core.session import load_session, new_session
+    from app.main import app
+
+    monkeypatch.setattr(settings, "sqlite_routing", "per_org")
+    monkeypatch.setattr(settings, "org_db_dir", str(tmp_path / "orgs"))
+    monkeypatch.setattr(settings, "sqlite_max_open_dbs", 2)
+    try:
+        client = TestClient(app)
+        for org in ("acme", "globex", "initech"):
+            r = client.post("/chat", json={"org_id": org, "user_id": f"{org}-user", "message": "vpn is down"})
+            assert r.status_code == 200
+        assert client.post("/chat", json={"org_id": "../etc", "message": "hi"}).status_code == 400
+        assert message_log.flush()
+        assert sorted(p.name for p in (tmp_path / "orgs").glob("*.db")) == ["acme.db", "globex.db", "initech.db"]
+        assert len(db._pools) <= 2
+
+        with db.use_org_db("acme"):
+            sid = new_session(org_id="acme", user_id="acme-user").session_id
+            with db.connection() as conn:
+                assert conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 2
+        with db.use_org_db("globex"):
+            with pytest.raises(KeyError):
+                load_session(sid)
+            with db.connection() as conn:
+                assert [r[0] for r in conn.execute("SELECT user_id FROM users")] == ["globex-user"]
+    finally:
+        message_log.close()
+        db.close_pools()
+
+
+def test_sharded_sessions_route_and_scatter_gather(org_db, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    from app.core import repository
+    from app.core.session import load_session
+    from app.main import app
+
+    monkeypatch.setattr(settings, "session_shards", 4)
+    client = TestClient(app)
+    sids = []
+    for i in range(12):
+        r = client.post("/chat", json={"org_id": "acme", "user_id": f"u{i}", "message": "vpn is down"})
+        assert r.status_code == 200
+    assert message_log.flush()
+
+    shards = db.session_db_paths()
+    assert len(shards) == 4 and str(org_db) not in shards
+    per_shard = []
+    for path in shards:
+        with db.connection(path) as conn:
+            rows = conn.execute("SELECT session_id FROM sessions").fetchall()
+            sids += [r[0] for r in rows]
+            per_shard.append(len(rows))
+            for (sid,) in rows:
+                assert db.session_db_path(sid) == path
+                n = conn.execute("SELECT COUNT(*) FROM messages WHERE session_id=?", (sid,)).fetchone()[0]
+                assert n == 2
+    assert sum(per_shard) == 12 and sum(1 for n in per_shard if n) > 1
+
+    listed = repository.list_open_sessions("acme", limit=5)
+    assert len(listed) == 5
+    assert [r["updated_at"] for r in listed] == sorted((r["updated_at"] for r in listed), reverse=True)
+    assert load_session(sids[0]).session_id == sids[0]
+
+
+def test_admin_listing_keyset_pages_and_ndjson_export(org_db, monkeypatch):
+    import json
+
+    from fastapi.testclient import TestClient
+
+    from app.core import repository
+    from app.core.session import new_session
+    from app.main import app
+
+    monkeypatch.setattr(settings, "session_shards", 2)
+    sids = set()
+    for path in db.session_db_paths():
+        with db.use_db(path):
+            repository.ensure_org("acme")
+            repository.ensure_user(org_id="acme", user_id="u1")
+    for i in range(7):
+        sid = new_session(org_id="acme", user_id="u1").session_id
+        sids.add(sid)
+        with db.connection(db.session_db_path(sid)) as conn:
+            # two rows per timestamp, so ties are broken by session_id
+            conn.execute("UPDATE sessions SET updated_at=? WHERE session_id=?", (f"2024-01-0{1 + i // 2}", sid))
+
+    client = TestClient(app, headers=ADMIN)
+    seen, cursor = [], None
+    while True:
+        params = {"org_id": "acme", "limit": 3, **({"cursor": cursor} if cursor else {})}
+        body = client.get("/admin/sessions", params=params).json()
+        seen += [(r["updated_at"], r["session_id"]) for r in body["items"]]
+        cursor = body["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == sorted(seen, reverse=True) and {s for _, s in seen} == sids
+
+    r = client.get("/admin/sessions", params={"org_id": "acme", "limit": 2, "format": "ndjson"})
+    assert r.headers["content-type"].startswith("application/x-ndjson")
+    assert [tuple(json.loads(line)[k] for k in ("updated_at", "session_id")) for line in r.text.splitlines()] == seen
+
+    assert client.get("/admin/sessions", params={"org_id": "acme", "cursor": "not-a-cursor"}).status_code == 400
+    assert client.get("/admin/tickets", params={"org_id": "acme", "since": "2024-01-01"}).json() == {
+        "items": [],
+        "next_cursor": None,
+    }
+
+
+def test_fts_search_tickets_and_transcripts(org_db):
+    from fastapi.testclient import TestClient
+
+    from app.core import repository
+    from app.core.session import new_session
+    from app.main import app
+
+    repository.ensure_org("acme")
+    repository.ensure_user(org_id="acme", user_id="u1")
+    sid = new_session(org_id="acme", user_id="u1").session_id
+    repository.insert_message(session_id=sid, role="user", content="VPN fails with error 809 since Monday")
+    repository.insert_message(session_id=sid, role="user", content="printer jammed again")
+    ticket = dict(org_id="acme", user_id="u1", session_id=sid, impact="high", urgency="high", escalation_reason="x")
+    t1 = repository.insert_ticket(
+        **ticket, summary="VPN error 809", category="network", rendered_text="User cannot connect to VPN"
+    )
+    repository.insert_ticket(**ticket, summary="Printer jam", category="hardware", rendered_text="error on tray 2")
+
+    hits = repository.search("acme", "error 809", scope="messages")
+    assert [h["snippet"] for h in hits] == ["VPN fails with [error] [809] since Monday"]
+    assert repository.search("acme", "errors")[0]["ticket_id"] == t1  # stemmed; a summary hit ranks first
+    assert repository.search("acme", "error", category="hardware")[0]["summary"] == "Printer jam"
+    assert repository.search("acme", "error", until="2000-01-01") == []
+    assert repository.search("globex", "error") == []
+
+    with db.connection() as conn:  # triggers keep the index in sync
+        conn.execute("UPDATE tickets SET summary='Wi-Fi drops' WHERE ticket_id=?", (t1,))
+        conn.execute("DELETE FROM messages WHERE content LIKE 'printer%'")
+    assert [h["summary"] for h in repository.search("acme", "wi-fi")] == ["Wi-Fi drops"]
+    assert repository.search("acme", "printer", scope="messages") == []
+
+    client = TestClient(app, headers=ADMIN)
+    r = client.get("/admin/search", params={"org_id": "acme", "q": "809", "scope": "messages"})
+    assert r.status_code == 200 and r.json()["items"][0]["session_id"] == sid
+    assert client.get("/admin/search", params={"org_id": "acme", "q": "AND (", "raw": True}).status_code == 400
+
+
+def test_fts_search_across_session_shards_is_newest_first(org_db, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    from app.core import repository
+    from app.core.provision import provision, read_roster_text
+    from app.core.session import new_session
+    from app.main import app
+
+    monkeypatch.setattr(settings, "session_shards", 3)
+    provision("acme", read_roster_text("user_id\nu1\n"))  # org/user rows in every shard
+    stamps = {}
+    for i in range(9):
+        sid = new_session(org_id="acme", user_id="u1").session_id
+        # Short and long hits spread over the shards, each scored against its own shard's statistics.
+        text = "vpn error 809" if i % 2 else "vpn error 809 " + "and the laptop fan is loud " * 20
+        mid = repository.insert_message(session_id=sid, role="user", content=text)
+        stamps[mid] = f"2024-06-{i + 1:02d} 10:00:00"
+        with db.connection(db.session_db_path(sid)) as conn:
+            conn.execute("UPDATE messages SET created_at=? WHERE message_id=?", (stamps[mid], mid))
+
+    hits = repository.search("acme", "809", scope="messages", limit=4)
+    assert [h["message_id"] for h in hits] == sorted(stamps, key=stamps.get, reverse=True)[:4]
+    assert len({db.session_db_path(h["session_id"]) for h in hits}) > 1
+    assert repository.search_order(db.session_db_paths()) == "recent"
+    # One database: relevance order, as before.
+    assert repository.search_order([str(org_db)]) == "relevance"
+
+    r = TestClient(app, headers=ADMIN).get("/admin/search", params={"org_id": "acme", "q": "809", "scope": "messages"})
+    assert r.json()["order"] == "recent" and len(r.json()["items"]) == 9
+
+
+def test_init_schema_backfills_fts_index(tmp_path, monkeypatch):
+    import sqlite3
+
+    from app.core import repository
+
+    path = tmp_path / "old.db"
+    conn = sqlite3.connect(path)
+    schema = open("data/schema.sql").read()
+    conn.executescript(schema[: schema.index("-- Full-text search")])
+    conn.execute("INSERT INTO orgs(org_id, name) VALUES('acme', 'acme')")
+    conn.execute("INSERT INTO users(user_id, org_id) VALUES('u1', 'acme')")
+    conn.execute(
+        "INSERT INTO tickets(ticket_id, org_id, user_id, summary, category, escalation_reason, rendered_text)"
+        " VALUES('t1', 'acme', 'u1', 'disk full', 'hardware', 'x', 'C: drive is full')"
+    )
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(settings, "sqlite_path", str(path))
+    try:
+        db.init_schema()
+        assert [h["ticket_id"] for h in repository.search("acme", "drive")] == ["t1"]
+    finally:
+        db.close_pools()
+
+
+def test_maintenance_closes_idle_sessions_and_archives_old_ones(org_db, monkeypatch):
+    from app.core import repository
+    from app.core.maintenance import archive_files, load_archived_session, run_maintenance
+    from app.core.session import load_session, new_session
+
+    monkeypatch.setattr(settings, "archive_dir", str(org_db.parent / "archive"))
+    monkeypatch.setattr(settings, "maintenance_batch", 2)
+    repository.ensure_org("acme")
+    repository.ensure_user(org_id="acme", user_id="u1")
+    old, idle, live = (new_session(org_id="acme", user_id="u1").session_id for _ in range(3))
+    for sid in (old, idle):
+        cite = {"source_id": f"kb-{sid}", "title": "VPN", "snippet": "Reinstall the client.", "score": 0.5}
+        repository.insert_message(session_id=sid, role="user", content="VPN error 809 " * 50, citations=[cite])
+    ticket = dict(org_id="acme", user_id="u1", impact="high", urgency="high", escalation_reason="x")
+    repository.insert_ticket(**ticket, session_id=old, summary="VPN 809", category="network", rendered_text="details")
+    with db.connection() as conn:
+        conn.execute("UPDATE sessions SET status='closed', updated_at='2024-03-05 10:00:00' WHERE session_id=?", (old,))
+        conn.execute("UPDATE sessions SET updated_at=datetime('now', '-2 days') WHERE session_id=?", (idle,))
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+    counts = run_maintenance()[str(org_db)]
+    assert (counts["closed"], counts["archived_sessions"], counts["archived_messages"]) == (1, 1, 1)
+    assert counts["archived_tickets"] == 1
+    assert counts["pruned_chunks"] == 1  # the archived message's chunk; the idle one is still cited
+    with db.connection() as conn:
+        assert [r[0] for r in conn.execute("SELECT source_id FROM kb_chunks")] == [f"kb-{idle}"]
+    assert load_session(idle).status == "closed" and load_session(live).status == "open"
+    with pytest.raises(KeyError):
+        load_session(old)
+    with db.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM tickets").fetchone()[0] == 0
+    assert repository.search("acme", "809", scope="messages")[0]["session_id"] == idle
+
+    assert [p.rsplit("/", 1)[1] for p in archive_files(str(org_db))] == ["org.2024-03.db"]
+    archived = load_archived_session(old)
+    assert archived["session"]["status"] == "closed"
+    assert archived["messages"][0]["content"] == "VPN error 809 " * 50
+    assert archived["tickets"][0]["rendered_text"] == "details"
+    assert load_archived_session(live) is None
+    assert run_maintenance()[str(org_db)]["archived_sessions"] == 0
+
+    from fastapi.testclient import TestClient
+
+    from app.main import app
+
+    client = TestClient(app)
+    gone = client.post("/chat", json={"message": "hi", "org_id": "acme", "user_id": "u1", "session_id": old})
+    assert gone.status_code == 404
+    closed = client.post("/chat", json={"message": "hi", "org_id": "acme", "user_id": "u1", "session_id": idle})
+    assert closed.status_code == 409 and load_session(idle).turns == 0
+
+
+def test_citations_stored_once_and_rehydrated(org_db):
+    import json
+
+    from app.core import repository
+    from app.core.maintenance import migrate_inline_citations
+    from app.core.session import new_session
+
+    repository.ensure_org("acme")
+    repository.ensure_user(org_id="acme", user_id="u1")
+    sid = new_session(org_id="acme", user_id="u1").session_id
+    cites = [
+        {"source_id": "kb/vpn#0", "title": "VPN", "snippet": "[0.83] Reset the VPN profile.", "score": 0.8312},
+        {"source_id": "kb/wifi#2", "title": "Wi-Fi", "snippet": "[0.41] Forget the network.", "score": 0.41},
+    ]
+    first = repository.insert_message(session_id=sid, role="assistant", content="a", citations=cites)
+    queued = message_log.append(session_id=sid, role="assistant", content="b", citations=cites[:1])
+    assert message_log.flush()
+    with db.connection() as conn:  # a row written before normalization
+        conn.execute(
+            "INSERT INTO messages(message_id, session_id, role, content, citations_json) VALUES('old', ?, 'assistant', 'c', ?)",
+            (sid, json.dumps([{k: v for k, v in cites[1].items() if k != "score"}])),
+        )
+
+    assert migrate_inline_citations(str(org_db)) == 1
+    with db.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM kb_chunks").fetchone()[0] == 2
+        assert conn.execute("SELECT COUNT(*) FROM message_citations").fetchone()[0] == 4
+        assert conn.execute("SELECT COUNT(*) FROM messages WHERE citations_json != '[]'").fetchone()[0] == 0
+
+    transcript = {m["message_id"]: m["citations"] for m in repository.list_messages(sid)}
+    assert transcript[first] == cites
+    assert [c["snippet"] for c in transcript["old"]] == ["[0.41] Forget the network."]
+    assert transcript[queued] == cites[:1]
+
+
+def test_admin_api_requires_the_configured_token(org_db, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    from app.main import app
+
+    client = TestClient(app)
+    assert client.get("/admin/sessions", params={"org_id": "acme"}).status_code == 401
+    assert client.get("/admin/sessions", params={"org_id": "acme"}, headers={"x-admin-token": "nope"}).status_code == 401
+    assert client.get("/admin/sessions", params={"org_id": "acme"}, headers={"x-admin-token": "test-admin"}).status_code == 200
+    assert client.get("/admin/rag/status", headers=ADMIN).status_code == 200
+    monkeypatch.setattr(settings, "admin_token", None)
+    assert client.get("/admin/rag/status", headers=ADMIN).status_code == 403  # no token configured: admin API off
@@ -0,0 +1,249 @@
+import asyncio
+import importlib.util
+import socket
+import threading
+import time
+from pathlib import Path
+
+import uvicorn
+
+from app.core.message_log import message_log
+from app.llm.cache import answer_cache
+from app.llm.providers import OpenAICompatibleLLM
+from app.policies.guardrails import StreamGuard, check_response
+
+ADMIN = {"authorization": "Bearer test-admin"}
+
+
+def _fake_server():
+    spec = importlib.util.spec_from_file_location("fake_openai", Path(__file__).parents[1] / "scripts" / "fake_openai.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(module.create_app(), host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, f"http://127.0.0.1:{port}"
+
+
+def test_openai_provider_reuses_pooled_connections():
+    server, url = _fake_server()
+    llm = OpenAICompatibleLLM(api_key="x", model="fake", base_url=url + "/v1")
+
+    async def run():
+        for _ in range(5):
+            assert (await llm.chat([{"role": "user", "content": "vpn"}])).startswith("(FAKE)")
+        await asyncio.gather(*(llm.chat([{"role": "user", "content": "hi"}]) for _ in range(4)))
+        stats = llm.stats()
+        served = (await llm.client.get(url + "/stats")).json()
+        await llm.aclose()
+        return stats, served
+
+    try:
+        stats, served = asyncio.run(run())
+    finally:
+        server.should_exit = True
+    assert stats["requests"] == 9 and stats["errors"] == 0 and stats["in_flight"] == 0
+    # sequential calls share one connection; the concurrent burst opens at most 3 more
+    assert stats["connects"] == served["connections"] <= 4
+    assert stats["pool"]["connections"] == stats["pool"]["idle"] == stats["connects"]
+
+
+def test_openai_provider_streams_sse_deltas():
+    server, url = _fake_server()
+    llm = OpenAICompatibleLLM(api_key="x", model="fake", base_url=url + "/v1")
+    messages = [{"role": "user", "content": "vpn"}]
+
+    async def run():
+        pieces = [p async for p in llm.stream(messages)]
+        whole = await llm.chat(messages)
+        stream = llm.stream(messages)
+        first = await stream.__anext__()  # a caller that stops early (guardrail) closes the response
+        await stream.aclose()
+        stats = llm.stats()
+        await llm.aclose()
+        return pieces, whole, first, stats
+
+    try:
+        pieces, whole, first, stats = asyncio.run(run())
+    finally:
+        server.should_exit = True
+    assert len(pieces) > 5 and "".join(pieces) == whole and first == pieces[0]
+    assert stats["streams"] == 2 and stats["avg_ttft_s"] is not None and stats["in_flight"] == 0
+
+
+def test_stream_guard_catches_phrases_split_across_pieces():
+    text = "Step 1: never Disable Anti" + "virus software. " + "x" * 10
+    guard = StreamGuard()
+    results = [guard.feed(p) for p in ("Step 1: never Disable Anti", "virus software. ", "x" * 10)]
+    assert [r.ok for r in results] == [True, False, False]
+    assert results[1].reason == check_response(text).reason
+
+    long = StreamGuard()
+    assert long.feed("a" * 4999).ok and not long.feed("bb").ok
+
+
+def test_chat_stream_emits_tokens_and_converts_guardrail_trips_to_tickets(org_db, monkeypatch):
+    import json
+
+    from fastapi.testclient import TestClient
+
+    from app.core import repository
+    from app.main import app
+
+    fields = "\nos: Windows\ndevice_type: laptop\nnetwork_type: home wifi\nerror_message: 809\nmfa_working: yes"
+
+    def events(message):
+        r = TestClient(app).post("/chat/stream", json={"message": "my vpn is down" + message + fields})
+        assert r.headers["content-type"].startswith("text/event-stream")
+        out = []
+        for block in r.text.strip().split("\n\n"):
+            event, data = block.split("\n", 1)
+            out.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+        return out
+
+    ok = events("")
+    names = [e for e, _ in ok]
+    assert names[0] == "session" and names[-1] == "done" and names.count("token") > 5
+    done = ok[-1][1]
+    assert done["type"] == "answer" and done["message"] == "".join(d["text"] for e, d in ok if e == "token")
+
+    tripped = events(" can I bypass it")
+    names = [e for e, _ in tripped]
+    assert "abort" in names and names[-1] == "done"
+    shown = "".join(d["text"] for e, d in tripped if e == "token")
+    assert "bypass" not in shown.lower()  # the offending piece is never sent
+    assert tripped[-1][1]["type"] == "ticket"
+    assert "Banned phrase detected: bypass" in tripped[-1][1]["ticket"]["escalation_reason"]
+
+    assert message_log.flush()
+    sid = tripped[0][1]["session_id"]
+    assert [m["role"] for m in repository.list_messages(sid)] == ["user", "assistant"]
+    assert repository.list_tickets("demo-org", "created")[0]["session_id"] == sid
+
+    # Any other failure still ends the stream with a terminal event, and the turn is rolled back.
+    import app.main as main
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("disk on fire")
+
+    monkeypatch.setattr(main, "_finish_turn", broken)
+    failed = events(" again")
+    assert failed[0][0] == "session" and failed[-1] == ("error", {"status": 500, "detail": "Internal server error"})
+    assert message_log.flush()
+    assert repository.list_messages(failed[0][1]["session_id"]) == []
+
+
+def test_answer_cache_is_off_by_default_and_prompt_keeps_the_message(org_db, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    from app.llm import providers
+    from app.main import app
+
+    prompts = []
+    real_chat = providers.MockLLM.chat
+
+    async def counting_chat(self, messages, **kwargs):
+        prompts.append(messages[-1]["content"])
+        return await real_chat(self, messages, **kwargs)
+
+    monkeypatch.setattr(providers.MockLLM, "chat", counting_chat)
+    client = TestClient(app)
+    message = "my vpn fails with error 809 on windows since the Oslo trip"
+    fields = "\nos: Windows\ndevice_type: laptop\nnetwork_type: home wifi\nerror_message: 809\nmfa_working: yes"
+    body = {"message": message + fields, "context": {"user_email": "alice@acme.test", "hostname": "LT-042"}}
+    for _ in range(2):
+        r = client.post("/chat", json=body)
+        assert r.status_code == 200 and r.json()["type"] == "answer"
+
+    assert not answer_cache.enabled and len(prompts) == 2
+    for prompt in prompts:
+        assert message in prompt
+        assert "- user_email: alice@acme.test" in prompt and "- hostname: LT-042" in prompt
+
+
+def test_answer_cache_serves_same_prompt_and_survives_restart(org_db, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    from app.llm import cache, providers
+    from app.main import app
+
+    calls = []
+    real_chat = providers.MockLLM.chat
+
+    async def counting_chat(self, messages, **kwargs):
+        calls.append(messages)
+        return await real_chat(self, messages, **kwargs)
+
+    monkeypatch.setattr(providers.MockLLM, "chat", counting_chat)
+    monkeypatch.setattr(answer_cache.memory, "max_size", 64)
+    client = TestClient(app, headers=ADMIN)
+
+    def ask(fields):
+        r = client.post("/chat", json={"message": "my vpn is down\n" + fields})
+        assert r.status_code == 200
+        return r.json()
+
+    fields = "os: Windows\ndevice_type: laptop\nnetwork_type: home wifi\nerror_message: 809\nmfa_working: yes"
+    first = ask(fields)
+    # Another user asking exactly the same question: served from the cache.
+    second = ask(fields)
+    assert first["type"] == second["type"] == "answer"
+    assert second["message"] == first["message"] and len(calls) == 1
+    ask(fields.replace("809", "691"))  # different error code: a different question for the model
+    assert len(calls) == 2
+    stats = client.get("/admin/llm/cache").json()
+    assert stats["hits"] == 1 and stats["stores"] == 2
+
+    source_id = first["citations"][0]["source_id"]
+    r = client.delete("/admin/llm/cache", params={"source_id": source_id})
+    assert r.json()["purged"] == 2 and r.json()["size"] == 0
+    ask(fields)
+    assert len(calls) == 3
+
+    # Persisted answers outlive the process; purge reaches them too.
+    path = str(org_db.parent / "llm_cache.db")
+    answer = cache.CachedAnswer("Restart the client.", "vpn", ("kb-1", "kb-2"), "v1", "MockLLM:")
+    cache.AnswerCache(8, 60, persist=True, path=path).put("k", answer)
+    restarted = cache.AnswerCache(8, 60, persist=True, path=path)
+    assert restarted.get("k") == answer and restarted.stats()["disk_hits"] == 1
+    assert restarted.purge(source_id="kb-2") == 1
+    assert cache.AnswerCache(8, 60, persist=True, path=path).get("k") is None
+
+
+def test_answer_cache_never_replays_one_users_message_or_org_to_another(org_db, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    from app.llm import providers
+    from app.main import app
+
+    prompts = []
+    real_chat = providers.MockLLM.chat
+
+    async def counting_chat(self, messages, **kwargs):
+        prompts.append(messages[-1]["content"])
+        return await real_chat(self, messages, **kwargs)
+
+    monkeypatch.setattr(providers.MockLLM, "chat", counting_chat)
+    monkeypatch.setattr(answer_cache.memory, "max_size", 64)
+    client = TestClient(app)
+    fields = "\nos: Windows\ndevice_type: laptop\nnetwork_type: home wifi\nerror_message: 809\nmfa_working: yes"
+
+    def ask(org_id, user_id, email, message):
+        body = {"org_id": org_id, "user_id": user_id, "message": message + fields, "context": {"user_email": email}}
+        r = client.post("/chat", json=body)
+        assert r.status_code == 200 and r.json()["type"] == "answer"
+        return r.json()["message"]
+
+    message = "my vpn is down since the Oslo trip"
+    ask("acme", "alice", "ops@acme.test", message)
+    ask("globex", "bob", "ops@acme.test", message)
+    assert len(prompts) == 2  # same prompt, different org: a fresh answer
+    ask("acme", "carol", "carol@acme.test", message)
+    assert len(prompts) == 3  # same org, but the prompt carries carol's details
+    assert "carol@acme.test" in prompts[-1] and message in prompts[-1]
+    ask("acme", "dave", "ops@acme.test", message)
+    assert len(prompts) == 3  # same org and exactly the same prompt as alice's turn
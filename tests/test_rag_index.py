@@ -0,0 +1,408 @@
+import importlib.util
+import os
+import pickle
+import sys
+from pathlib import Path
+
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from app.core.config import settings
+from app.rag.index import DocChunk, RagIndex, ResidentIndex, retrieve
+
+
+def _write_index(path, texts):
+    vec = TfidfVectorizer()
+    matrix = vec.fit_transform(texts)
+    chunks = [DocChunk(source_id=f"doc#{i}", title="doc", text=t, metadata={}) for i, t in enumerate(texts)]
+    with open(path, "wb") as f:
+        pickle.dump(RagIndex(vectorizer=vec, matrix=matrix, chunks=chunks), f)
+
+
+def _ingest():
+    """scripts/ingest_kb.py as a module (registered so worker processes can unpickle its functions)."""
+    if "ingest_kb" not in sys.modules:
+        spec = importlib.util.spec_from_file_location("ingest_kb", Path(__file__).parents[1] / "scripts" / "ingest_kb.py")
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["ingest_kb"] = module
+        spec.loader.exec_module(module)
+    return sys.modules["ingest_kb"]
+
+
+KB = {
+    "vpn.md": "VPN error 809 on Windows: allow UDP 500 and 4500, then reconnect the client.",
+    "email.md": "Outlook keeps prompting for a password: clear cached credentials and sign in again.",
+    "wifi.md": "Wi-Fi drops every hour on the third floor: forget the network and rejoin.",
+    "printer.md": "\n".join(f"Printer step {i}: check tray {i % 4}, toner level and paper jam sensor." for i in range(60)),
+}
+
+
+def _write_kb(kb_dir, files):
+    kb_dir.mkdir(exist_ok=True)
+    for name, text in files.items():
+        (kb_dir / name).write_text(text, encoding="utf-8")
+
+
+def _by_source(index):
+    return {index.chunks[i].source_id: i for i in range(len(index.chunks))}
+
+
+def test_resident_index_hot_reload(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "rag_reload_check_s", 0.0)
+    p = tmp_path / "idx.pkl"
+    _write_index(p, ["vpn error 809 on windows", "outlook keeps asking for password"])
+    resident = ResidentIndex(str(p))
+
+    first = resident.get()
+    assert resident.get() is first
+    citations, best = retrieve(first, "vpn 809")
+    assert citations[0].source_id == "doc#0" and best > 0
+
+    _write_index(p, ["printer jams", "wifi drops every hour", "vpn error 809 on windows"])
+    os.utime(p, ns=(1, 1))
+    second = resident.get()
+    assert second is not first
+    assert second.version != first.version
+    # The old reference stays usable for requests that were already in flight.
+    assert retrieve(first, "vpn 809")[0][0].source_id == "doc#0"
+    assert retrieve(second, "vpn 809")[0][0].source_id == "doc#2"
+
+
+def test_resident_index_serves_legacy_pickle_until_the_directory_is_built(tmp_path, monkeypatch):
+    from app.rag.store import write_index
+
+    monkeypatch.setattr(settings, "rag_reload_check_s", 0.0)
+    monkeypatch.setattr(settings, "rag_backend", "tfidf")
+    monkeypatch.setattr(settings, "rag_index_path", str(tmp_path / "rag_index"))
+    monkeypatch.setattr(settings, "rag_legacy_index_path", str(tmp_path / "rag_index.pkl"))
+    _write_index(tmp_path / "rag_index.pkl", ["vpn error 809 on windows", "outlook keeps asking for password"])
+    resident = ResidentIndex()
+    legacy = resident.get()
+    assert retrieve(legacy, "vpn 809")[0][0].source_id == "doc#0"
+
+    texts = ["printer jams", "vpn error 809 on windows"]
+    vec = TfidfVectorizer()
+    chunks = [DocChunk(source_id=f"new#{i}", title="doc", text=t, metadata={}) for i, t in enumerate(texts)]
+    version = write_index(tmp_path / "rag_index", vec, vec.fit_transform(texts), chunks)
+    assert resident.get().version == version  # ingest ran: switched to the directory
+    assert retrieve(resident.get(), "vpn 809")[0][0].source_id == "new#1"
+
+
+def test_mapped_index_matches_fitted_vectorizer(tmp_path):
+    from app.rag.store import open_index, write_index
+
+    texts = ["VPN error 809 on Windows laptops", "Outlook keeps prompting for a password", "Wi-Fi drops on the 3rd floor"]
+    vec = TfidfVectorizer(stop_words="english", ngram_range=(1, 2))
+    matrix = vec.fit_transform(texts)
+    chunks = [DocChunk(source_id=f"doc#{i}", title="doc", text=t, metadata={"i": i}) for i, t in enumerate(texts)]
+
+    version = write_index(tmp_path / "idx", vec, matrix, chunks)
+    mapped = open_index(tmp_path / "idx")
+
+    assert mapped.version == version
+    assert mapped.chunks[2] == chunks[2]
+    q = "outlook password prompt on windows"
+    assert abs(mapped.vectorizer.transform([q]) - vec.transform([q])).max() < 1e-12
+    original = RagIndex(vectorizer=vec, matrix=matrix, chunks=chunks)
+    assert retrieve(mapped, q) == retrieve(original, q)
+
+
+def test_top_k_kernel_matches_brute_force_and_batch():
+    import numpy as np
+    from sklearn.metrics.pairwise import cosine_similarity
+
+    from app.rag.index import prepare_matrix, retrieve_many
+
+    texts = [f"vpn error {i % 7} on device {i % 11} network {i % 5}" for i in range(60)]
+    vec = TfidfVectorizer()
+    raw = vec.fit_transform(texts)
+    chunks = [DocChunk(source_id=f"doc#{i}", title="doc", text=t, metadata={}) for i, t in enumerate(texts)]
+    index = RagIndex(vectorizer=vec, matrix=prepare_matrix(raw), chunks=chunks)
+
+    queries = ["error 3 device 4", "network 2", "nothing matches here"]
+    batch = retrieve_many(index, queries, top_k=5)
+    for q, (citations, best) in zip(queries, batch):
+        assert (citations, best) == retrieve(index, q, top_k=5)
+        sims = cosine_similarity(vec.transform([q]), raw).ravel()
+        assert abs(best - sims.max()) < 1e-9
+        expected = sorted(np.round(sims[sims > 0], 9), reverse=True)[:5]
+        got = [float(c.snippet[1:5]) for c in citations]
+        assert got == [float(f"{s:.2f}") for s in expected]
+
+
+def test_bm25_max_score_matches_exhaustive(tmp_path):
+    import numpy as np
+    import scipy.sparse as sp
+
+    from app.rag.bm25 import build_bm25, write_bm25
+    from app.rag.store import open_index
+
+    rng = np.random.default_rng(0)
+    words = [f"term{i}" for i in range(40)]
+    chunks = [
+        DocChunk(source_id=f"doc#{i}", title="doc", text=" ".join(rng.choice(words, 30)), metadata={})
+        for i in range(300)
+    ]
+    index = build_bm25(chunks)
+    write_bm25(tmp_path / "bm25", index)
+    mapped = open_index(tmp_path / "bm25")
+
+    impacts = sp.csc_matrix(
+        (index.post_w, index.post_docs, index.post_ptr), shape=(len(chunks), index.max_w.size)
+    )
+    for q in ["term1 term2 term3", "term5 term5 term30", "term7"]:
+        qv = index.encode([q])
+        exact = np.asarray((impacts @ qv.T).todense()).ravel()
+        bound = float((qv.data * index.max_w[qv.indices]).sum())
+        expected = np.sort(exact)[::-1][:5] / bound
+        for idx in (index, mapped):
+            hits = idx.search(idx.encode([q]), 5)[0]
+            assert np.allclose([s for _, s in hits], expected, atol=1e-6)
+            assert all(abs(exact[row] / bound - s) < 1e-6 for row, s in hits)
+
+
+def test_escalation_threshold_follows_the_backend_score_scale(monkeypatch):
+    from app.policies.guardrails import should_escalate
+
+    monkeypatch.setattr(settings, "rag_min_score", 0.12)
+    monkeypatch.setattr(settings, "rag_bm25_min_score", 0.5)
+    monkeypatch.setattr(settings, "rag_backend", "tfidf")
+    assert should_escalate(1, 0.3) == (False, None)
+    monkeypatch.setattr(settings, "rag_backend", "bm25")
+    assert should_escalate(1, 0.3)[0]  # a weak BM25 match, though above the cosine threshold
+    assert should_escalate(1, 0.8) == (False, None)
+
+
+def test_sharded_hashing_index_matches_vocabulary_tfidf(tmp_path):
+    import json
+
+    import pytest
+
+    from app.rag.index import prepare_matrix
+    from app.rag.sharded import open_sharded, write_sharded
+    from app.rag.store import open_index
+
+    texts = [f"ticket {i} mentions error{i} and device{i % 13} on site{i % 7}" for i in range(90)]
+    chunks = [DocChunk(source_id=f"doc#{i}", title="doc", text=t, metadata={}) for i, t in enumerate(texts)]
+    vec = TfidfVectorizer(stop_words="english", ngram_range=(1, 2))
+    exact = RagIndex(vectorizer=vec, matrix=prepare_matrix(vec.fit_transform(texts)), chunks=chunks)
+
+    write_sharded(tmp_path / "hashed", chunks, n_shards=4)
+    sharded = open_index(tmp_path / "hashed")
+    assert len(sharded.shards) == 4 and len(sharded.chunks) == 90
+    assert sharded.chunks[47] == chunks[47]
+
+    for q in ["error42 device3", "device5 site2 unseen-term", "error7"]:
+        got, got_best = retrieve(sharded, q)
+        want, want_best = retrieve(exact, q)
+        assert [c.source_id for c in got][:1] == [c.source_id for c in want][:1]
+        assert abs(got_best - want_best) < 1e-6
+
+    # Merging raw shard scores needs cosines under the global IDF; other scorings are refused.
+    version_dir = tmp_path / "hashed" / (tmp_path / "hashed" / "CURRENT").read_text().strip()
+    meta = json.loads((version_dir / "meta.json").read_text())
+    for bad in ({**meta, "normalized": False}, {**meta, "kind": "bm25"}):
+        with pytest.raises(ValueError):
+            open_sharded(version_dir, bad)
+
+
+def test_find_duplicates_exact_and_near():
+    from app.rag.compact import find_duplicates
+
+    base = " ".join(f"step{i} restart the vpn client and sign in again" for i in range(12))
+    texts = [
+        base,
+        "Completely different article about printer toner.",
+        base.upper(),  # exact after normalization
+        base + " thanks",  # near duplicate
+        "Another unrelated note on password resets and MFA enrollment.",
+    ]
+    assert find_duplicates(texts, threshold=0.8) == {2: 0, 3: 0}
+
+
+def test_retrieval_cache_keys_on_version_and_bounds():
+    from app.core.cache import TTLCache
+    from app.rag import index as rag_index
+
+    now = [0.0]
+    cache = TTLCache(2, ttl_s=10, clock=lambda: now[0])
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)  # evicts "b", the least recently used
+    assert cache.get("b") is None and cache.get("a") == 1
+    now[0] = 11
+    assert cache.get("a") is None
+    assert (cache.hits, cache.evictions, cache.expirations) == (2, 1, 1)
+
+    texts = ["reset your vpn token", "email quota is full"]
+    vec = TfidfVectorizer()
+    chunks = [DocChunk(source_id=f"kb#{i}", title="kb", text=t, metadata={}) for i, t in enumerate(texts)]
+    index = RagIndex(vectorizer=vec, matrix=vec.fit_transform(texts), chunks=chunks, version="v1")
+    rag_index.retrieval_cache.clear()
+    first = retrieve(index, "VPN  token")
+    hits = rag_index.retrieval_cache.hits
+    assert retrieve(index, "vpn token ") == first
+    assert rag_index.retrieval_cache.hits == hits + 1
+    index.version = "v2"
+    retrieve(index, "vpn token")
+    assert rag_index.retrieval_cache.hits == hits + 1
+
+
+def test_session_context_vector_is_reused_and_weighted(monkeypatch):
+    from app.rag import index as rag_index
+
+    texts = ["vpn error 809 on windows", "outlook password prompt loop on macos"]
+    vec = TfidfVectorizer()
+    chunks = [DocChunk(source_id=f"kb#{i}", title="kb", text=t, metadata={}) for i, t in enumerate(texts)]
+    index = RagIndex(vectorizer=vec, matrix=vec.fit_transform(texts), chunks=chunks, version="v1")
+    rag_index.context_cache.clear()
+
+    ctx = rag_index.session_context(index, "s1", {"os": "macOS", "app": "outlook"})
+    assert rag_index.session_context(index, "s1", {"app": "outlook", "os": "macOS"}) is ctx
+    assert rag_index.session_context(index, "s1", {"os": "Windows"}) is not ctx
+
+    monkeypatch.setattr(settings, "rag_context_weight", 0.0)
+    only_msg, best = retrieve(index, "error 809", context=ctx)
+    assert only_msg[0].source_id == "kb#0"
+    monkeypatch.setattr(settings, "rag_context_weight", 3.0)
+    rag_index.retrieval_cache.clear()
+    assert retrieve(index, "error 809", context=ctx)[0][0].source_id == "kb#1"
+
+
+def test_incremental_tfidf_splices_changes_and_compacts_like_a_full_build(tmp_path):
+    import numpy as np
+    import scipy.sparse as sp
+
+    from app.rag.store import current_version, open_index
+
+    ingest = _ingest()
+    kb, out = tmp_path / "kb", tmp_path / "idx"
+    _write_kb(kb, KB)
+    opts = ingest.BuildOptions()
+    ingest.full_build(out, opts, kb, 1, ingest.StageTimer())
+    first = open_index(out)
+
+    # Nothing changed: no new version.
+    assert ingest.incremental_build(out, opts, kb, 1, ingest.StageTimer(), 10.0) == (first.version, len(first.chunks), 4)
+    assert current_version(out) == first.version
+
+    _write_kb(kb, {"email.md": "Outlook crashes on start: repair the Office install from settings."})
+    (kb / "wifi.md").unlink()
+    version, n_chunks, n_files = ingest.incremental_build(out, opts, kb, 1, ingest.StageTimer(), 10.0)
+    spliced = open_index(out)
+    ingest.full_build(tmp_path / "ref", opts, kb, 1, ingest.StageTimer())
+    ref = open_index(tmp_path / "ref")
+
+    rows, ref_rows, first_rows = _by_source(spliced), _by_source(ref), _by_source(first)
+    assert version == spliced.version != first.version and (n_chunks, n_files) == (len(ref.chunks), 3)
+    assert set(rows) == set(ref_rows) and not any("wifi.md" in s for s in rows)
+    assert all(spliced.chunks[rows[s]] == ref.chunks[ref_rows[s]] for s in rows)
+    manifest = ingest.load_manifest(out)
+    assert manifest["files"] == ingest.load_manifest(tmp_path / "ref")["files"]
+    assert manifest["fitted_rows"] == len(first.chunks) and manifest["stale_rows"] == 3  # -email -wifi +email
+    # Below the compaction ratio the fitted vocabulary/IDF is reused: kept rows are copied as they were,
+    # and the edited article is vectorized with the old vocabulary.
+    m, m0 = sp.csr_matrix(spliced.matrix), sp.csr_matrix(first.matrix)
+    vpn = next(s for s in rows if "vpn.md" in s)
+    assert (m[rows[vpn]] != m0[first_rows[vpn]]).nnz == 0
+    email = next(s for s in rows if "email.md" in s)
+    expected = first.vectorizer.transform([spliced.chunks[rows[email]].text]).toarray().ravel()
+    assert np.allclose(m[rows[email]].toarray().ravel(), expected, atol=1e-6)
+    assert retrieve(spliced, "outlook crashes repair office")[0][0].source_id == email
+
+    # Past the ratio the index is refit from scratch and matches a full build row for row.
+    _write_kb(kb, {"vpn.md": "VPN error 691: the password expired; reset it in the portal."})
+    ingest.incremental_build(out, opts, kb, 1, ingest.StageTimer(), 0.0)
+    ingest.full_build(tmp_path / "ref", opts, kb, 1, ingest.StageTimer())
+    compacted, ref = open_index(out), open_index(tmp_path / "ref")
+    assert ingest.load_manifest(out)["stale_rows"] == 0
+    assert compacted.vectorizer.vocabulary_ == ref.vectorizer.vocabulary_
+    m, mr = sp.csr_matrix(compacted.matrix), sp.csr_matrix(ref.matrix)
+    ref_rows = _by_source(ref)
+    for s, i in _by_source(compacted).items():
+        assert abs(m[i] - mr[ref_rows[s]]).max() < 1e-6
+
+
+def test_incremental_bm25_refits_from_the_spliced_chunks(tmp_path):
+    from app.rag.store import open_index
+
+    ingest = _ingest()
+    kb, out = tmp_path / "kb", tmp_path / "idx"
+    _write_kb(kb, KB)
+    opts = ingest.BuildOptions(backend="bm25")
+    ingest.full_build(out, opts, kb, 1, ingest.StageTimer())
+    # A build for another backend is not a usable base: the caller falls back to a full build.
+    assert ingest.incremental_build(out, ingest.BuildOptions(), kb, 1, ingest.StageTimer(), 10.0) is None
+
+    _write_kb(kb, {"email.md": "Outlook crashes on start: repair the Office install from settings."})
+    (kb / "printer.md").unlink()
+    ingest.incremental_build(out, opts, kb, 1, ingest.StageTimer(), 10.0)
+    ingest.full_build(tmp_path / "ref", opts, kb, 1, ingest.StageTimer())
+    spliced, ref = open_index(out), open_index(tmp_path / "ref")
+
+    assert ingest.load_manifest(out)["stale_rows"] == 0  # always a full refit
+    assert sorted(_by_source(spliced)) == sorted(_by_source(ref))
+    for q in ["outlook crashes", "vpn error 809", "wifi third floor", "printer toner"]:
+        got, got_best = retrieve(spliced, q)
+        want, want_best = retrieve(ref, q)
+        assert [c.source_id for c in got] == [c.source_id for c in want]
+        assert abs(got_best - want_best) < 1e-9
+
+
+def test_parallel_load_files_matches_the_serial_path(tmp_path):
+    ingest = _ingest()
+    kb = tmp_path / "kb"
+    _write_kb(kb, {**KB, **{f"article_{i}.md": f"Article {i}: restart service {i % 5}.\n" * 90 for i in range(12)}})
+    paths = list(ingest.discover(kb))
+    known = {paths[0].as_posix(): ingest.file_digest(paths[0].read_bytes())}
+
+    def run(workers):
+        return [(lf.path, lf.digest, lf.chunks) for lf in ingest.load_files(paths, known, workers)]
+
+    serial = run(1)
+    assert [p for p, _, _ in serial] == [p.as_posix() for p in paths]
+    assert serial[0][2] is None and all(chunks for _, _, chunks in serial[1:])  # known digest: not re-chunked
+    assert run(2) == serial  # more files than workers * 4: exercises the bounded in-flight queue
+
+
+def test_compaction_prunes_by_df_stores_float32_and_reports_overlap(tmp_path, capsys):
+    import numpy as np
+    import scipy.sparse as sp
+
+    from app.rag.store import open_index
+
+    ingest = _ingest()
+    kb = tmp_path / "kb"
+    articles = {f"kb_{i}.md": f"Ticket note {i}: restart router{i % 3} then check uplink{i} status." for i in range(10)}
+    _write_kb(kb, articles)
+
+    def build(out, **opts):
+        ingest.full_build(tmp_path / out, ingest.BuildOptions(**opts), kb, 1, ingest.StageTimer())
+        return open_index(tmp_path / out)
+
+    full = build("full", dtype="float64")
+    vocab = full.vectorizer.vocabulary_
+    assert "uplink3" in vocab and "ticket" in vocab
+    pruned = build("pruned", min_df=2, max_df=0.5)
+    kept = pruned.vectorizer.vocabulary_
+    assert "uplink3" not in kept  # in a single chunk: below --min-df
+    assert "ticket" not in kept and "note" not in kept  # in every chunk: above --max-df
+    assert "router1" in kept and 0 < len(kept) < len(vocab)
+
+    small = build("small")  # float32 is the default
+    assert small.matrix.dtype == np.float32 and full.matrix.dtype == np.float64
+    norms = np.sqrt(np.asarray(sp.csr_matrix(small.matrix).multiply(small.matrix).sum(axis=1)).ravel())
+    assert np.allclose(norms, 1.0, atol=1e-6)
+    q = "restart router2 uplink5"
+    (got, got_best), (want, want_best) = retrieve(small, q), retrieve(full, q)
+    assert got[0].source_id == want[0].source_id and abs(got_best - want_best) < 1e-6
+
+    # A copied article is dropped by --dedupe; --check counts a hit on the copy as a hit on the original.
+    _write_kb(kb, {"kb_3_copy.md": articles["kb_3.md"]})
+    capsys.readouterr()
+    opts = ingest.BuildOptions(dedupe=True)
+    ingest.full_build(tmp_path / "deduped", opts, kb, 1, ingest.StageTimer(), check=True)
+    report = capsys.readouterr().out
+    assert "Dedupe: dropped 1 duplicate chunks (11 -> 10)" in report
+    assert "11 -> 10" in report.split("Compaction check")[1]
+    assert f"top-{settings.rag_top_k} overlap on 11 probe queries: 100.0%" in report